@@ -1,19 +1,140 @@
 from fastapi import APIRouter, Request, Response, HTTPException
-from fastapi.responses import StreamingResponse
-from app.services.proxy_service import proxy_service
-from app.schemas.openai import ChatCompletionRequest
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.services.proxy_service import ClosingStreamingResponse, proxy_service
+from app.schemas.openai import EmbeddingRequest
 from app.services.converter import converter
+from app.services.stream_parser import create_stream_parser
+from app.services.chunk_encoder import ChunkEncoder, DONE_FRAME, dumps_bytes, loads
+from app.services.model_cache import model_cache
+from app.services.key_pool import key_pool
+from app.services.response_cache import response_cache, merge_chunks
+from app.services.context_cache import context_cache
+from app.services.file_offload import file_offload
+from app.services.coalescer import coalescer
+from app.services.compression import compress_body
+from app.services.embedding_batcher import embedding_batcher
+from app.services.upstream_router import upstream_router
+from app.services.retry_policy import retry_policy
+from app.core.admission import tenant_of
+from app.core.config import settings
+from app.core.drain import drain_controller
+from app.core.metrics import registry, CONVERT_DURATION
+from app.core.tracing import span
+from typing import Any, Dict, List, Optional, Tuple
 import httpx
-import time
-import json
 
 router = APIRouter()
 
+_CONVERT_CHUNK = CONVERT_DURATION.labels("chunk")
+# 客户端通过请求头指定的合并写出窗口上限（毫秒）
+_MAX_FLUSH_MS = 100.0
+
+
+def _extract_api_key(request: Request) -> Optional[str]:
+    """依次从Bearer令牌、x-goog-api-key请求头和key查询参数中提取API密钥。"""
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        api_key = auth_header.split(" ")[1]
+        if api_key:
+            return api_key
+    return request.headers.get("x-goog-api-key") or request.query_params.get("key")
+
+
+def _resolve_upstream_key(request: Request) -> Tuple[Optional[str], bool]:
+    """
+    返回 (客户端密钥, 是否使用服务端密钥池)。
+    不使用密钥池且客户端未提供密钥时返回401。
+    """
+    api_key = _extract_api_key(request)
+    if key_pool.accepts(api_key):
+        return api_key, True
+    if not api_key:
+        raise HTTPException(status_code=401, detail="Missing API key")
+    return api_key, False
+
+
+async def _fetch_models(api_key: Optional[str], use_pool: bool) -> Dict[str, Any]:
+    headers = {} if use_pool else {"x-goog-api-key": api_key}
+    req = proxy_service.client.build_request("GET", "/v1beta/models", headers=headers)
+    response = await proxy_service.send(req, use_pool=use_pool)
+    await response.aread()
+    response.raise_for_status()
+    return response.json()
+
+
+def _cache_bypassed(request: Request) -> bool:
+    """客户端可通过 x-gapi-cache: bypass 或 Cache-Control: no-cache/no-store 跳过响应缓存。"""
+    if request.headers.get("x-gapi-cache", "").lower() == "bypass":
+        return True
+    cache_control = request.headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+
+def _flush_ms(request: Request, default: float) -> float:
+    """流式响应的合并写出窗口（毫秒）：SSE_COALESCE_HEADER 请求头优先于路由的默认值，0表示逐块写出。"""
+    value = request.headers.get(settings.SSE_COALESCE_HEADER)
+    if value is None:
+        return default
+    try:
+        return min(max(float(value), 0.0), _MAX_FLUSH_MS)
+    except ValueError:
+        return default
+
+
+def _cache_headers(cache_key: Optional[str]) -> Optional[Dict[str, str]]:
+    return {"x-gapi-cache": "miss"} if cache_key else None
+
+
+def _json_response(content: Dict[str, Any], request: Request, headers: Optional[Dict[str, str]] = None) -> Response:
+    """序列化JSON响应；较大的响应体按 RESPONSE_GZIP_MIN_BYTES 压缩。"""
+    body, content_encoding = compress_body(dumps_bytes(content), request.headers.get("accept-encoding"))
+    if settings.RESPONSE_GZIP_MIN_BYTES > 0:
+        headers = {**(headers or {}), "vary": "Accept-Encoding"}
+        if content_encoding:
+            headers["content-encoding"] = content_encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _cached_response(chunks: List[Dict[str, Any]], model: str, stream: bool, request: Request) -> Response:
+    """用缓存的上游分块构造响应；流式请求按原分块重放为SSE。"""
+    headers = {"x-gapi-cache": "hit"}
+    if not stream:
+        openai_response = converter.gemini_to_openai(merge_chunks(chunks), model)
+        return _json_response(openai_response, request, headers)
+
+    def replay():
+        encoder = ChunkEncoder(model)
+        for gemini_chunk in chunks:
+            yield encoder.encode(gemini_chunk)
+        yield DONE_FRAME
+
+    return StreamingResponse(replay(), media_type="text/event-stream", headers=headers)
+
+
+def _invalidate_upstream_refs(payload: Dict[str, Any], status_code: int, error: str):
+    """
+    引用的上下文缓存或上传文件已被上游删除或不可用时，从本地登记表移除，下次请求重新创建或上传。
+    只处理错误信息中提到的资源：参数错误等普通的400不影响仍然有效的缓存。
+    """
+    if status_code in (400, 403, 404):
+        if "cachedContent" in payload:
+            context_cache.invalidate(payload["cachedContent"], error)
+        file_offload.invalidate(payload, error)
+
+
 @router.get("/health")
 async def health_check():
+    # 排空（优雅关闭）期间返回503，让负载均衡不再转发新请求
+    if drain_controller.draining:
+        return JSONResponse(status_code=503, content={"status": "draining", "active": drain_controller.active})
     return {"status": "ok"}
 
 
+@router.get("/metrics")
+async def metrics():
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @router.get("/v1beta/models")
 async def list_models_gemini(request: Request):
     """
@@ -21,29 +142,35 @@ async def list_models_gemini(request: Request):
     代理请求并直接流式传输响应。
     """
     # 1. 提取API密钥
-    auth_header = request.headers.get("Authorization")
-    api_key = None
-    if auth_header and auth_header.startswith("Bearer "):
-        api_key = auth_header.split(" ")[1]
-    
-    if not api_key:
-        api_key = request.headers.get("x-goog-api-key")
-
-    if not api_key:
-        api_key = request.query_params.get("key")
-        
-    if not api_key:
-        raise HTTPException(status_code=401, detail="Missing API key")
+    api_key, use_pool = _resolve_upstream_key(request)
 
     # 2. 准备并发送请求到Gemini
     target_url = "/v1beta/models"
-    headers = {"x-goog-api-key": api_key}
+    headers = {} if use_pool else {"x-goog-api-key": api_key}
+    # 按客户端接受的编码向上游协商，上游的压缩响应可以原样转发
+    accept_encoding = request.headers.get("accept-encoding")
+    if accept_encoding and settings.PASSTHROUGH_COMPRESSED:
+        headers["accept-encoding"] = accept_encoding
     
     # 提取需要转发的查询参数（例如pageToken）
     params = dict(request.query_params)
     # 如果存在，从参数中移除key，因为它已通过请求头处理
     params.pop("key", None)
 
+    # 不带分页等参数的请求走缓存
+    if not params and model_cache.enabled:
+        try:
+            models = await model_cache.get(api_key or "", lambda: _fetch_models(api_key, use_pool))
+        except httpx.HTTPStatusError as exc:
+            return Response(
+                content=exc.response.content,
+                status_code=exc.response.status_code,
+                media_type=exc.response.headers.get("content-type")
+            )
+        except httpx.RequestError as exc:
+            raise HTTPException(status_code=502, detail=f"Proxy error: {exc}")
+        return models.gemini_data
+
     try:
         req = proxy_service.client.build_request(
             "GET",
@@ -52,21 +179,8 @@ async def list_models_gemini(request: Request):
             params=params
         )
         
-        response = await proxy_service.client.send(req, stream=True)
-        
-        # 过滤响应头
-        excluded_headers = {"content-encoding", "content-length", "transfer-encoding", "connection"}
-        headers = {
-            k: v for k, v in response.headers.items()
-            if k.lower() not in excluded_headers
-        }
-
-        return StreamingResponse(
-            response.aiter_bytes(),
-            status_code=response.status_code,
-            headers=headers,
-            background=None
-        )
+        response = await proxy_service.send(req, use_pool=use_pool)
+        return proxy_service.passthrough_response(response, request.headers.get("accept-encoding"))
     except httpx.RequestError as exc:
         raise HTTPException(status_code=502, detail=f"Proxy error: {exc}")
         
@@ -84,9 +198,16 @@ async def proxy_v1beta(path: str, request: Request):
     # 提取查询参数
     params = dict(request.query_params)
     
+    # 使用服务端密钥池时，丢弃客户端携带的密钥
+    use_pool = key_pool.accepts(_extract_api_key(request))
+    if use_pool:
+        headers.pop("authorization", None)
+        headers.pop("x-goog-api-key", None)
+        params.pop("key", None)
+
     # 检查是否需要将Authorization头转换为Gemini格式
     auth_header = request.headers.get("Authorization")
-    if auth_header and auth_header.startswith("Bearer "):
+    if not use_pool and auth_header and auth_header.startswith("Bearer "):
         api_key = auth_header.split(" ")[1]
         # 移除Authorization头并添加Gemini风格的身份验证
         headers.pop("authorization", None)
@@ -94,8 +215,15 @@ async def proxy_v1beta(path: str, request: Request):
         if "x-goog-api-key" not in headers:
             headers["x-goog-api-key"] = api_key
     
-    # 读取请求体
-    body = await request.body()
+    # 不原样转发压缩字节时，由httpx按自身支持的编码协商，保证能够解压
+    if not settings.PASSTHROUGH_COMPRESSED:
+        headers.pop("accept-encoding", None)
+
+    # 流式生成走流式连接池（如已配置）
+    streaming = ":streamGenerateContent" in path or params.get("alt") == "sse"
+
+    # 请求体：使用密钥池时可能需要换密钥重试，因此完整读取；否则流式转发
+    body = await proxy_service.request_body(request, headers, buffered=use_pool)
     
     try:
         req = proxy_service.client.build_request(
@@ -106,183 +234,216 @@ async def proxy_v1beta(path: str, request: Request):
             content=body
         )
         
-        response = await proxy_service.client.send(req, stream=True)
-        
-        # 过滤响应头
-        excluded_headers = {"content-encoding", "content-length", "transfer-encoding", "connection"}
-        headers = {
-            k: v for k, v in response.headers.items()
-            if k.lower() not in excluded_headers
-        }
-
-        return StreamingResponse(
-            response.aiter_bytes(),
-            status_code=response.status_code,
-            headers=headers,
-            background=None
-        )
+        response = await proxy_service.send(req, use_pool=use_pool, streaming=streaming)
+        flush_ms = _flush_ms(request, settings.PASSTHROUGH_COALESCE_MS) if streaming else 0.0
+        return proxy_service.passthrough_response(response, request.headers.get("accept-encoding"), flush_ms)
     except httpx.RequestError as exc:
         raise HTTPException(status_code=502, detail=f"Proxy error: {exc}")
 
 @router.post("/v1/chat/completions")
 async def chat_completions(request: Request):
-    # 1. 解析请求
+    # 1. 解析请求：默认只做最小结构检查，CHAT_REQUEST_VALIDATION=pydantic 时完整校验
     try:
-        body = await request.json()
-        openai_request = ChatCompletionRequest(**body)
+        with span("parse"):
+            body = loads(await request.body())
+            if settings.CHAT_REQUEST_VALIDATION == "pydantic":
+                openai_request = converter.validate_chat_request(body)
+            else:
+                openai_request = converter.check_chat_request(body)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid request: {e}")
+    stream = bool(openai_request.get("stream"))
+    # 非流式请求的截止时间预算（重试和对冲共用）
+    deadline = None if stream else retry_policy.deadline(request.headers.get(settings.DEADLINE_HEADER))
 
     # 2. 提取API密钥
-    auth_header = request.headers.get("Authorization")
-    api_key = None
-    if auth_header and auth_header.startswith("Bearer "):
-        api_key = auth_header.split(" ")[1]
-    
-    if not api_key:
-        api_key = request.headers.get("x-goog-api-key")
+    api_key, use_pool = _resolve_upstream_key(request)
 
-    if not api_key:
-        # 尝试查询参数
-        api_key = request.query_params.get("key")
-        
-    if not api_key:
-        raise HTTPException(status_code=401, detail="Missing API key")
-
-    # 3. 模型映射
-    model = openai_request.model
-    if model.startswith("gpt-"):
-        model = "gemini-1.5-flash" # 默认回退
+    # 3. 模型映射：按 MODEL_ROUTES 路由到上游目标，首选目标的模型用于响应和缓存键
+    requested_model = openai_request["model"]
+    model = upstream_router.primary_model(requested_model)
+    request.state.model = model
     
     # 4. 转换请求
     gemini_payload = await converter.openai_to_gemini(openai_request)
     
     # 5. 发送到Gemini
-    # 构建URL: https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}
+    # 每个目标的URL: {端点}/v1beta/models/{目标模型}:generateContent
     # 如果流式传输，使用streamGenerateContent
-    method = "streamGenerateContent" if openai_request.stream else "generateContent"
-    target_url = f"/v1beta/models/{model}:{method}"
+    method = "streamGenerateContent" if stream else "generateContent"
     
-    headers = {
-        "Content-Type": "application/json",
-        "x-goog-api-key": api_key
-    }
+    headers = {"Content-Type": "application/json"}
+    if not use_pool:
+        headers["x-goog-api-key"] = api_key
+
+    # 确定性请求的响应缓存
+    cache_key = None
+    if response_cache.enabled and response_cache.eligible(gemini_payload):
+        if _cache_bypassed(request):
+            response_cache.record_bypass()
+        else:
+            cache_key = response_cache.make_key(model, gemini_payload, None if use_pool else api_key)
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                return _cached_response(cached, model, stream, request)
+
+    async def upstream_chunks():
+        """向上游发送一次请求并逐个产出Gemini响应分块（非流式响应为单个分块），失败时抛出HTTPException。"""
+        # 大媒体改为引用上传的文件，长的稳定前缀改为引用上游上下文缓存
+        # （密钥池中的密钥各自属于不同项目，都不适用）
+        offloaded = gemini_payload
+        if not use_pool:
+            offloaded = await file_offload.apply(offloaded, api_key)
+        params = {"alt": "sse"} if stream and settings.UPSTREAM_SSE else None
+
+        async def send_upstream():
+            """发送一次上游请求（首字节前失败时按路由回退），返回非200时抛出HTTPException。"""
+            sent = {}
+
+            async def build_request(target, client):
+                # 上下文缓存与模型绑定，按目标模型分别处理
+                target_model = target.model or requested_model
+                payload = offloaded
+                if not use_pool:
+                    with span("context_cache"):
+                        payload = await context_cache.apply(offloaded, target_model, api_key)
+                sent["payload"] = payload
+                return client.build_request(
+                    "POST", f"/v1beta/models/{target_model}:{method}", json=payload, headers=headers, params=params
+                )
+
+            _, response = await upstream_router.send(requested_model, build_request, use_pool=use_pool, streaming=stream)
+            if response.status_code != 200:
+                try:
+                    error_content = await response.aread()
+                finally:
+                    await response.aclose()
+                _invalidate_upstream_refs(sent["payload"], response.status_code, error_content.decode(errors="replace"))
+                retry_after = response.headers.get("retry-after")
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=error_content.decode(),
+                    headers={"Retry-After": retry_after} if retry_after else None
+                )
+            return response
+
+        if not stream:
+            async def unary_attempt():
+                response = await send_upstream()
+                try:
+                    await response.aread()
+                    return response.json()
+                finally:
+                    await response.aclose()
+
+            # 在截止时间内重试或对冲
+            gemini_response = await retry_policy.call(unary_attempt, model, deadline)
+            if cache_key:
+                await response_cache.put(cache_key, [gemini_response])
+            yield gemini_response
+            return
+
+        response = await send_upstream()
+        collected = [] if cache_key else None
+        try:
+            parser = create_stream_parser(sse=settings.UPSTREAM_SSE)
+            async for chunk in response.aiter_text():
+                for gemini_chunk in parser.feed(chunk):
+                    if collected is not None:
+                        collected.append(gemini_chunk)
+                    yield gemini_chunk
+        finally:
+            await response.aclose()
+
+        if collected:
+            await response_cache.put(cache_key, collected)
+
+    # 相同请求并发时合并为一次上游调用
+    if coalescer.eligible(gemini_payload) and not _cache_bypassed(request):
+        coalesce_key = coalescer.make_key(method, model, gemini_payload, None if use_pool else api_key)
+        chunks = coalescer.subscribe(coalesce_key, upstream_chunks)
+    else:
+        chunks = upstream_chunks()
     
-    if openai_request.stream:
+    if stream:
         async def stream_generator():
-            async with proxy_service.client.stream("POST", target_url, json=gemini_payload, headers=headers, timeout=60.0) as response:
-                if response.status_code != 200:
-                    error_content = await response.aread()
-                    yield f"data: {json.dumps({'error': {'message': error_content.decode(), 'code': response.status_code}})}\n\n"
-                    return
-
-                buffer = ""
-                async for chunk in response.aiter_text():
-                    buffer += chunk
-                    while True:
-                        # 简单的JSON数组解析逻辑
-                        # 我们期望对象被包装在[ ... ]中
-                        # 我们寻找匹配的大括号
-                        try:
-                            # 这是一个简单的解析器，生产环境可能需要改进
-                            # 但现在，让我们尝试找到完整的JSON对象
-                            start = buffer.find('{')
-                            if start == -1:
-                                break
-                            
-                            # 找到对象的结尾（简单方式）
-                            # 我们需要计算大括号以确保正确
-                            brace_count = 0
-                            end = -1
-                            for i, char in enumerate(buffer[start:], start):
-                                if char == '{':
-                                    brace_count += 1
-                                elif char == '}':
-                                    brace_count -= 1
-                                    if brace_count == 0:
-                                        end = i + 1
-                                        break
-                            
-                            if end != -1:
-                                json_str = buffer[start:end]
-                                buffer = buffer[end:]
-                                
-                                try:
-                                    gemini_chunk = json.loads(json_str)
-                                    openai_chunk = converter.gemini_to_openai_chunk(gemini_chunk, model)
-                                    yield f"data: {json.dumps(openai_chunk)}\n\n"
-                                except json.JSONDecodeError:
-                                    # 不完整或无效，等待更多数据
-                                    # 但我们找到了匹配的大括号，所以它应该是有效的
-                                    pass
-                            else:
-                                break
-                        except Exception:
-                            break
-                            
-            yield "data: [DONE]\n\n"
-
-        return StreamingResponse(stream_generator(), media_type="text/event-stream")
+            encoder = ChunkEncoder(model)
+            try:
+                async for gemini_chunk in chunks:
+                    with _CONVERT_CHUNK.time(), span("encode"):
+                        frame = encoder.encode(gemini_chunk)
+                    yield frame
+            except HTTPException as exc:
+                yield ChunkEncoder.error(exc.detail, exc.status_code)
+                return
+            finally:
+                # 客户端断开时同样执行：关闭上游响应，或退出合并的调用
+                await chunks.aclose()
+            yield DONE_FRAME
 
-    try:
-        response = await proxy_service.client.post(
-            target_url,
-            json=gemini_payload,
-            headers=headers,
-            timeout=60.0
+        return ClosingStreamingResponse(
+            stream_generator(),
+            media_type="text/event-stream",
+            headers=_cache_headers(cache_key),
+            # 响应体未开始输出就结束（例如客户端在响应头发出前断开）时 stream_generator 的 finally 不会执行
+            on_close=chunks.aclose,
+            flush_ms=_flush_ms(request, settings.SSE_COALESCE_MS),
+            flush_bytes=settings.SSE_COALESCE_MAX_BYTES
         )
-        response.raise_for_status()
-        gemini_response = response.json()
-    except httpx.HTTPStatusError as exc:
-        raise HTTPException(status_code=exc.response.status_code, detail=exc.response.text)
+
+    try:
+        gemini_response = None
+        async for gemini_chunk in chunks:
+            gemini_response = gemini_chunk
+    except HTTPException:
+        raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
     # 6. 转换响应
-    openai_response = converter.gemini_to_openai(gemini_response, model)
+    with span("encode"):
+        openai_response = converter.gemini_to_openai(gemini_response, model)
     
-    return openai_response
+    return _json_response(openai_response, request, _cache_headers(cache_key))
+
+@router.post("/v1/embeddings")
+async def embeddings(request: Request):
+    # 1. 解析请求
+    try:
+        body = await request.json()
+        embedding_request = EmbeddingRequest(**body)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request: {e}")
+    if not embedding_request.input:
+        raise HTTPException(status_code=400, detail="Invalid request: input must not be empty")
+
+    # 2. 提取API密钥
+    api_key, use_pool = _resolve_upstream_key(request)
+
+    # 3. 模型映射
+    model = embedding_request.model
+    if model.startswith("text-embedding-3") or model.startswith("text-embedding-ada"):
+        model = "text-embedding-004" # 默认回退
+    request.state.model = model
+
+    # 4. 转换并交给批处理器，与其他并发请求合并为 batchEmbedContents 调用
+    gemini_requests = converter.openai_to_gemini_embeddings(embedding_request, model)
+    vectors = await embedding_batcher.embed(gemini_requests, model, api_key, use_pool, tenant_of(request.scope))
+
+    # 5. 转换响应
+    openai_response = converter.gemini_to_openai_embeddings(vectors, model, embedding_request.encoding_format)
+    return _json_response(openai_response, request)
 
 @router.get("/v1/models")
 async def list_models(request: Request):
     # 提取API密钥
-    auth_header = request.headers.get("Authorization")
-    api_key = None
-    if auth_header and auth_header.startswith("Bearer "):
-        api_key = auth_header.split(" ")[1]
-    
-    if not api_key:
-        api_key = request.headers.get("x-goog-api-key")
-
-    if not api_key:
-        api_key = request.query_params.get("key")
-        
-    if not api_key:
-        raise HTTPException(status_code=401, detail="Missing API key")
+    api_key, use_pool = _resolve_upstream_key(request)
 
-    target_url = "/v1beta/models"
-    headers = {"x-goog-api-key": api_key}
-    
     try:
-        response = await proxy_service.client.get(target_url, headers=headers, timeout=60.0)
-        response.raise_for_status()
-        gemini_data = response.json()
+        models = await model_cache.get(api_key or "", lambda: _fetch_models(api_key, use_pool))
+    except HTTPException:
+        raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
-        
-    openai_models = []
-    if "models" in gemini_data:
-        for model in gemini_data["models"]:
-            # model["name"]的格式类似"models/gemini-pro"
-            model_id = model["name"].replace("models/", "")
-            openai_models.append({
-                "id": model_id,
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "google"
-            })
-            
-    return {
-        "object": "list",
-        "data": openai_models
-    }
+
+    return models.openai_data
@@ -0,0 +1,259 @@
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+from urllib.parse import parse_qs
+import asyncio
+import hashlib
+import json
+import math
+import time
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.core.tracing import span
+
+ADMISSION_WAIT = registry.histogram("gapi_admission_wait_seconds", "请求在准入队列中的等待时间")
+ADMISSION_REJECTED = registry.counter("gapi_admission_rejected_total", "被准入控制拒绝的请求数", ("reason",))
+
+# 受准入控制的路径前缀（健康检查和指标不排队）
+_ADMITTED_PREFIXES = ("/v1/", "/v1beta/")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("future", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class _Tenant:
+    __slots__ = ("name", "weight", "active", "waiters", "vtime")
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.active = 0
+        self.waiters: Deque[_Waiter] = deque()
+        # 加权公平调度的虚拟时间：每获得一个名额前进 1/weight
+        self.vtime = 0.0
+
+
+class AdmissionController:
+    """
+    上游并发的准入控制。
+
+    全局并发和单租户并发各有上限；超出上限的请求进入该租户的有界等待队列，
+    名额释放时按加权公平调度（虚拟时间最小的租户优先）分配给各租户的队首请求。
+    队列已满或等待超过期限时立即拒绝，由中间件返回429和Retry-After。
+    """
+
+    def __init__(self, max_concurrency: int, tenant_concurrency: int, queue_size: int,
+                 queue_timeout: float, weights: Optional[Dict[str, float]] = None):
+        self.max_concurrency = max_concurrency
+        self.tenant_concurrency = tenant_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.weights = weights or {}
+        self._tenants: Dict[str, _Tenant] = {}
+        self._active = 0
+        self._vtime = 0.0
+        # 名额占用时长的指数移动平均，用于估算Retry-After
+        self._hold_ewma = 0.0
+
+    async def acquire(self, name: str) -> Tuple[_Tenant, float]:
+        """获取一个名额，返回 (租户, 获得名额的时间)；被拒绝时抛出 AdmissionRejected。"""
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            tenant = _Tenant(name, self.weights.get(name, 1.0))
+            self._tenants[name] = tenant
+
+        if self._active < self.max_concurrency and tenant.active < self.tenant_concurrency and not tenant.waiters:
+            self._grant(tenant)
+            ADMISSION_WAIT.observe(0.0)
+            return tenant, time.monotonic()
+
+        if len(tenant.waiters) >= self.queue_size:
+            self._forget(tenant)
+            ADMISSION_REJECTED.labels("queue_full").inc()
+            raise AdmissionRejected("queue_full", self.retry_after(tenant))
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future())
+        tenant.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            granted = waiter.future.done() and not waiter.future.cancelled()
+            if granted and isinstance(exc, asyncio.TimeoutError):
+                # 超时与分配同时发生，按已分配处理
+                pass
+            else:
+                if granted:
+                    self.release(tenant, time.monotonic())
+                else:
+                    tenant.waiters.remove(waiter)
+                    self._forget(tenant)
+                if isinstance(exc, asyncio.CancelledError):
+                    raise
+                ADMISSION_REJECTED.labels("timeout").inc()
+                raise AdmissionRejected("timeout", self.retry_after(tenant))
+
+        now = time.monotonic()
+        ADMISSION_WAIT.observe(now - waiter.enqueued_at)
+        return tenant, now
+
+    def release(self, tenant: _Tenant, granted_at: float):
+        tenant.active -= 1
+        self._active -= 1
+        self._hold_ewma += 0.1 * ((time.monotonic() - granted_at) - self._hold_ewma)
+        self._dispatch()
+        self._forget(tenant)
+
+    def reconfigure(self, max_concurrency: int, tenant_concurrency: int, queue_size: int,
+                    queue_timeout: float, weights: Dict[str, float]):
+        """调整上限和权重（热加载配置）；上限提高时立即给等待中的请求分配名额。"""
+        self.max_concurrency = max_concurrency
+        self.tenant_concurrency = tenant_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.weights = weights
+        for tenant in self._tenants.values():
+            tenant.weight = weights.get(tenant.name, 1.0)
+        self._dispatch()
+
+    def retry_after(self, tenant: _Tenant) -> int:
+        """按排在前面的请求数和平均占用时长粗略估算的重试等待秒数。"""
+        slots = max(1, min(self.tenant_concurrency, self.max_concurrency))
+        return max(1, math.ceil(self._hold_ewma * (len(tenant.waiters) + 1) / slots))
+
+    def _grant(self, tenant: _Tenant):
+        # 空闲后重新活跃的租户不能凭积累的虚拟时间插队
+        tenant.vtime = max(tenant.vtime, self._vtime) + 1.0 / tenant.weight
+        tenant.active += 1
+        self._active += 1
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency:
+            best = None
+            for tenant in self._tenants.values():
+                if tenant.waiters and tenant.active < self.tenant_concurrency:
+                    if best is None or tenant.vtime < best.vtime:
+                        best = tenant
+            if best is None:
+                return
+            waiter = best.waiters.popleft()
+            if waiter.future.done():
+                continue
+            self._vtime = max(self._vtime, best.vtime)
+            self._grant(best)
+            waiter.future.set_result(None)
+
+    def _forget(self, tenant: _Tenant):
+        if tenant.active == 0 and not tenant.waiters:
+            self._tenants.pop(tenant.name, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self._active,
+            "queued": sum(len(tenant.waiters) for tenant in self._tenants.values()),
+            "tenants": len(self._tenants),
+        }
+
+
+def _parse_weights(value: str) -> Dict[str, float]:
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() and weight.strip():
+            # 权重为0会除零，为负会让虚拟时间倒退，启动和热加载时都拒绝
+            if not float(weight) > 0:
+                raise ValueError(f"ADMISSION_TENANT_WEIGHTS 中租户 {name.strip()} 的权重必须大于0")
+            weights[name.strip()] = float(weight)
+    return weights
+
+
+admission_controller = AdmissionController(
+    max_concurrency=settings.ADMISSION_MAX_CONCURRENCY,
+    tenant_concurrency=settings.ADMISSION_TENANT_CONCURRENCY,
+    queue_size=settings.ADMISSION_QUEUE_SIZE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+    weights=_parse_weights(settings.ADMISSION_TENANT_WEIGHTS)
+)
+
+registry.callback(
+    "gapi_admission_active", "已获得准入名额的请求数",
+    lambda: {(): admission_controller.stats()["active"]}
+)
+registry.callback(
+    "gapi_admission_queue_depth", "准入队列中等待的请求数",
+    lambda: {(): admission_controller.stats()["queued"]}
+)
+registry.callback(
+    "gapi_admission_tenants", "有在途或排队请求的租户数",
+    lambda: {(): admission_controller.stats()["tenants"]}
+)
+
+
+def tenant_of(scope) -> str:
+    """租户标识：优先取租户请求头，否则取客户端API密钥的哈希，都没有时按客户端地址。"""
+    headers = dict(scope["headers"])
+    tenant = headers.get(settings.ADMISSION_TENANT_HEADER.lower().encode("latin-1"))
+    if tenant:
+        return tenant.decode("latin-1")
+
+    api_key = None
+    auth = headers.get(b"authorization", b"")
+    if auth.startswith(b"Bearer "):
+        api_key = auth[7:]
+    api_key = api_key or headers.get(b"x-goog-api-key")
+    if not api_key and scope.get("query_string"):
+        api_key = parse_qs(scope["query_string"].decode("latin-1")).get("key", [""])[0].encode("latin-1")
+    if api_key:
+        return "key:" + hashlib.sha256(api_key).hexdigest()[:12]
+
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "anonymous"
+
+
+class AdmissionMiddleware:
+    """
+    纯ASGI中间件：请求在整个处理期间（流式响应到最后一个字节）占用一个准入名额，
+    被拒绝时直接返回429。
+    """
+
+    def __init__(self, app, controller: AdmissionController = admission_controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(_ADMITTED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            with span("queue"):
+                tenant, granted_at = await self.controller.acquire(tenant_of(scope))
+        except AdmissionRejected as exc:
+            body = json.dumps({"detail": f"Too many requests ({exc.reason})"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(exc.retry_after).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(tenant, granted_at)
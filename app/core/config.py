@@ -1,7 +1,167 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     PORT: int = 8000
+
+    # 上游 Gemini API 地址（可指向本地模拟服务用于测试）
+    UPSTREAM_BASE_URL: str = "https://generativelanguage.googleapis.com"
+
+    # 上游连接池：连接数与保活连接数上限、保活时长、请求与建连超时（秒）。
+    # UPSTREAM_HTTP2 需要安装 h2（pip install httpx[http2]）；UPSTREAM_STREAM_MAX_CONNECTIONS 大于0时
+    # 流式请求使用独立的连接池；UPSTREAM_WARMUP_CONNECTIONS 为启动时预先建立的连接数
+    UPSTREAM_MAX_CONNECTIONS: int = 1000
+    UPSTREAM_MAX_KEEPALIVE: int = 100
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 30.0
+    UPSTREAM_TIMEOUT: float = 60.0
+    UPSTREAM_CONNECT_TIMEOUT: float = 10.0
+    UPSTREAM_HTTP2: bool = False
+    UPSTREAM_STREAM_MAX_CONNECTIONS: int = 0
+    UPSTREAM_WARMUP_CONNECTIONS: int = 0
+
+    # 多上游路由（/v1/chat/completions）：UPSTREAM_ENDPOINTS 为逗号分隔的 名称=地址（例如 "us=https://a,eu=https://b"），
+    # 端点 default 为 UPSTREAM_BASE_URL。MODEL_ROUTES 为分号分隔的规则 "模型通配符=目标|目标"，
+    # 目标格式为 "端点[:模型]"（省略模型表示请求的模型），使用第一条匹配的规则；未匹配的模型依次使用
+    # UPSTREAM_ENDPOINTS 中的所有端点。同一模型的多个端点按延迟与错误率选择，不同模型按顺序回退
+    UPSTREAM_ENDPOINTS: str = ""
+    MODEL_ROUTES: str = "gpt-*=default:gemini-1.5-flash"
+    # 端点健康检查：连续失败（连接错误或5xx）UPSTREAM_EJECT_FAILURES 次后摘除 UPSTREAM_EJECT_SECONDS 秒
+    # （连续摘除时翻倍）；配置了多个端点时每 UPSTREAM_HEALTH_CHECK_INTERVAL 秒主动检查一次（0表示关闭）
+    UPSTREAM_EJECT_FAILURES: int = 5
+    UPSTREAM_EJECT_SECONDS: float = 30.0
+    UPSTREAM_HEALTH_CHECK_INTERVAL: float = 10.0
+
+    # 非流式聊天补全的截止时间预算（秒）：客户端可用 DEADLINE_HEADER 请求头（毫秒）指定，最多 DEADLINE_MAX_SECONDS，
+    # 所有尝试（包括重试和对冲）共用这一预算，超过时返回504
+    DEADLINE_DEFAULT_SECONDS: float = 60.0
+    DEADLINE_MAX_SECONDS: float = 300.0
+    DEADLINE_HEADER: str = "x-gapi-deadline-ms"
+    # 重试：429/5xx 和连接错误最多尝试 RETRY_MAX_ATTEMPTS 次，退避为从 RETRY_BACKOFF_MS 起指数增长（上限
+    # RETRY_BACKOFF_MAX_MS）的随机抖动；重试次数不超过请求数的 RETRY_BUDGET_RATIO
+    RETRY_MAX_ATTEMPTS: int = 3
+    RETRY_BACKOFF_MS: float = 100.0
+    RETRY_BACKOFF_MAX_MS: float = 2000.0
+    RETRY_BUDGET_RATIO: float = 0.2
+    # 对冲请求：第一次尝试超过该模型近期耗时的 HEDGE_PERCENTILE 百分位仍未返回时再发起一次，取先返回的结果；
+    # 对冲数不超过请求数的 HEDGE_MAX_RATIO（会增加上游配额消耗，默认关闭）
+    HEDGE_ENABLED: bool = False
+    HEDGE_PERCENTILE: float = 95.0
+    HEDGE_MAX_RATIO: float = 0.05
+
+    # 服务端密钥池：逗号分隔的上游密钥；设置访问令牌后仅携带该令牌的请求使用密钥池，
+    # 否则所有请求都使用密钥池
+    GEMINI_API_KEYS: str = ""
+    KEY_POOL_ACCESS_TOKEN: Optional[str] = None
+    # 收到429后密钥的冷却时长（秒），单个密钥每分钟请求上限（0表示不限），单个请求最多尝试的密钥数
+    KEY_COOLDOWN_SECONDS: float = 60.0
+    KEY_RPM_LIMIT: int = 0
+    KEY_POOL_MAX_ATTEMPTS: int = 3
+
+    # /v1beta 透传时将客户端请求体流式转发给上游（使用密钥池时仍会完整读取以便重试）
+    PASSTHROUGH_STREAM_BODY: bool = True
+    # /v1beta 透传：上游响应已压缩且客户端接受该编码时原样转发压缩字节（关闭后总是解压再返回）
+    PASSTHROUGH_COMPRESSED: bool = True
+    # 非流式 /v1/chat/completions 与 /v1/embeddings 响应的gzip压缩：
+    # 响应体不小于 RESPONSE_GZIP_MIN_BYTES 且客户端接受gzip时压缩（0表示关闭）
+    RESPONSE_GZIP_MIN_BYTES: int = 0
+    RESPONSE_GZIP_LEVEL: int = 1
+
+    # 流式响应合并写出：第一个分块立即写出，之后的分块最多等待该毫秒数或累计到 SSE_COALESCE_MAX_BYTES 字节
+    # 再一起写出（0表示逐块写出）。SSE_COALESCE_MS 用于 /v1/chat/completions，PASSTHROUGH_COALESCE_MS 用于
+    # /v1beta 流式透传；客户端可用 SSE_COALESCE_HEADER 请求头（毫秒，最多100）按请求指定
+    SSE_COALESCE_MS: float = 0.0
+    PASSTHROUGH_COALESCE_MS: float = 0.0
+    SSE_COALESCE_MAX_BYTES: int = 16384
+    SSE_COALESCE_HEADER: str = "x-gapi-flush-ms"
+
+    # /v1/chat/completions 请求校验方式：fast 只做最小结构检查后直接转换原始JSON，
+    # pydantic 构建完整的 ChatCompletionRequest 模型（会做类型转换，开销随消息数增长）
+    CHAT_REQUEST_VALIDATION: str = "fast"
+
+    # 流式请求使用 alt=sse 帧格式（默认使用 JSON 数组格式）
+    UPSTREAM_SSE: bool = False
+
+    # 远程图像下载：单个请求的并发数、单张图像的耗时（秒）和大小（字节）上限
+    IMAGE_FETCH_CONCURRENCY: int = 8
+    IMAGE_FETCH_TIMEOUT: float = 15.0
+    IMAGE_MAX_BYTES: int = 20 * 1024 * 1024
+
+    # 多模态输入缓存：内存层字节上限（0表示关闭），可选的磁盘层目录及其字节上限
+    MEDIA_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    MEDIA_CACHE_DIR: Optional[str] = None
+    MEDIA_CACHE_DISK_MAX_BYTES: int = 4 * 1024 * 1024 * 1024
+    # 远程图像URL到缓存内容的映射有效期（秒），过期后重新下载，远程图像更新后最多延迟这么久生效
+    MEDIA_CACHE_URL_TTL: float = 3600.0
+
+    # 大媒体上传到 Files API：原始大小不小于 FILE_OFFLOAD_MIN_BYTES 的 inline_data 上传一次后改为 file_data 引用，
+    # 按（API密钥, 内容哈希）记录文件直到过期，最多登记 FILE_OFFLOAD_MAX_ENTRIES 个；
+    # 需要处理的媒体（如视频）最多等待 FILE_OFFLOAD_PROCESSING_TIMEOUT 秒。文件属于密钥所在项目，密钥池模式下不使用
+    FILE_OFFLOAD_ENABLED: bool = False
+    FILE_OFFLOAD_MIN_BYTES: int = 256 * 1024
+    FILE_OFFLOAD_MAX_ENTRIES: int = 4096
+    FILE_OFFLOAD_PROCESSING_TIMEOUT: float = 30.0
+
+    # 多轮对话历史的前缀转换缓存字节上限（0表示关闭）
+    HISTORY_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+
+    # 模型列表缓存：有效期（秒，0表示关闭）及过期后仍可返回旧数据并后台刷新的时长
+    MODEL_CACHE_TTL: float = 300.0
+    MODEL_CACHE_STALE_TTL: float = 3600.0
+
+    # 确定性补全（temperature=0）的响应缓存：内存层字节上限、有效期（秒），
+    # 可选的SQLite持久层路径及其字节上限
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    RESPONSE_CACHE_TTL: float = 3600.0
+    RESPONSE_CACHE_SQLITE_PATH: Optional[str] = None
+    RESPONSE_CACHE_SQLITE_MAX_BYTES: int = 1024 * 1024 * 1024
+
+    # 自动上下文缓存：稳定前缀（system_instruction、tools 及前 N 条 contents）估算超过
+    # CONTEXT_CACHE_MIN_TOKENS 时创建上游 cachedContents 并按名称引用
+    CONTEXT_CACHE_ENABLED: bool = False
+    CONTEXT_CACHE_MIN_TOKENS: int = 32768
+    CONTEXT_CACHE_TTL: int = 3600
+    CONTEXT_CACHE_LEADING_CONTENTS: int = 0
+    CONTEXT_CACHE_REFRESH_MARGIN: float = 300.0
+    CONTEXT_CACHE_MAX_ENTRIES: int = 256
+
+    # 相同补全请求的单飞合并：上游调用开始后多长时间（毫秒）内的相同请求可以加入；
+    # 默认只合并确定性请求（temperature=0）
+    COALESCE_ENABLED: bool = False
+    COALESCE_WINDOW_MS: int = 2000
+    COALESCE_DETERMINISTIC_ONLY: bool = True
+
+    # 准入控制：全局与单租户并发上限、每个租户的等待队列长度及最长等待时间（秒）。
+    # 租户按 ADMISSION_TENANT_HEADER 请求头区分（应由可信网关设置），否则按API密钥；
+    # 权重格式为 "tenant=2,other=0.5"，未列出的租户权重为1
+    ADMISSION_ENABLED: bool = False
+    ADMISSION_MAX_CONCURRENCY: int = 512
+    ADMISSION_TENANT_CONCURRENCY: int = 64
+    ADMISSION_QUEUE_SIZE: int = 128
+    ADMISSION_QUEUE_TIMEOUT: float = 10.0
+    ADMISSION_TENANT_HEADER: str = "x-tenant-id"
+    ADMISSION_TENANT_WEIGHTS: str = ""
+
+    # /v1/embeddings 微批处理：并发请求的文本合并为 batchEmbedContents 调用，
+    # 每批最多 EMBEDDING_BATCH_MAX_SIZE 条，第一条文本最多等待 EMBEDDING_BATCH_LINGER_MS 毫秒
+    EMBEDDING_BATCH_MAX_SIZE: int = 100
+    EMBEDDING_BATCH_LINGER_MS: float = 5.0
+
+    # 优雅关闭：收到 SIGTERM 后拒绝新请求、/health 返回503，最多等待该秒数让进行中的请求和流完成
+    # （0表示立即退出）。收到 SIGHUP 时重新读取配置（环境变量和 .env 文件）并热加载
+    DRAIN_GRACE_SECONDS: float = 30.0
+
+    # 启用 /metrics 指标采集
+    METRICS_ENABLED: bool = True
+
+    # 请求追踪：按比例采样API请求（带 TRACING_HEADER 请求头的请求总是采样），在 Server-Timing 响应头
+    # （流式响应为流末尾的SSE注释）中返回各阶段耗时。TRACING_EXPORTER 为 console 或 otlp 时
+    # 同时导出到 OpenTelemetry（需要 opentelemetry-sdk，otlp 另需 opentelemetry-exporter-otlp）
+    TRACING_ENABLED: bool = True
+    TRACING_SAMPLE_RATE: float = 0.01
+    TRACING_HEADER: str = "x-gapi-trace"
+    TRACING_EXPORTER: str = "none"
+    TRACING_SERVICE_NAME: str = "gemini-proxy"
     
     class Config:
         env_file = ".env"
@@ -0,0 +1,159 @@
+from typing import Callable, Optional, Set
+import asyncio
+import json
+import logging
+import signal
+import time
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DRAIN_REJECTED = registry.counter("gapi_drain_rejected_total", "排空期间被拒绝的新请求数")
+DRAIN_ABORTED = registry.counter("gapi_drain_aborted_total", "排空宽限期结束时仍未完成、被中止的请求数")
+
+# 排空时拒绝新请求的路径前缀（健康检查和指标仍然响应）
+_DRAINED_PREFIXES = ("/v1/", "/v1beta/")
+
+
+class DrainController:
+    """
+    优雅关闭：收到 SIGTERM 后进入排空状态——拒绝新的API请求（503 + Connection: close），
+    /health 返回503让负载均衡摘除本实例，已在处理的请求（包括流式响应）继续完成；
+    全部完成或超过 DRAIN_GRACE_SECONDS 后中止剩余请求，再交给 uvicorn 的信号处理正常退出
+    （之后 lifespan 关闭上游连接池）。排空期间再次收到 SIGTERM 立即退出。
+    """
+
+    def __init__(self, grace: float):
+        self.grace = grace
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._aborting: Set[asyncio.Task] = set()
+        self._idle: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._previous: Optional[Callable] = None
+        self._drain_task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> int:
+        return len(self._tasks)
+
+    def install(self):
+        """
+        在 lifespan 启动阶段调用：接管 SIGTERM（此时 uvicorn 已安装自己的处理函数，排空结束后再调用它）。
+        不在主线程中运行（例如嵌入其他程序）时不接管。
+        """
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._previous = signal.getsignal(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, self._on_signal)
+        except ValueError:
+            logger.warning("不在主线程中运行，SIGTERM 不会触发优雅排空")
+            self._previous = None
+
+    def _on_signal(self, signum, frame):
+        if self.draining or self.grace <= 0:
+            self._exit(signum, frame)
+            return
+        self._loop.call_soon_threadsafe(self.start)
+
+    def start(self):
+        """进入排空状态并在后台等待在途请求完成。"""
+        if self.draining:
+            return
+        self.draining = True
+        self.started_at = time.monotonic()
+        logger.info(f"开始排空：{self.active} 个在途请求，最多等待 {self.grace:.0f} 秒")
+        self._drain_task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        await self.wait_idle(self.grace)
+        if self._tasks:
+            logger.warning(f"排空宽限期已到，中止 {len(self._tasks)} 个未完成的请求")
+            DRAIN_ABORTED.inc(len(self._tasks))
+            for task in list(self._tasks):
+                self._aborting.add(task)
+                task.cancel()
+            await self.wait_idle(5.0)
+        logger.info(f"排空完成，耗时 {time.monotonic() - self.started_at:.1f} 秒")
+        self._exit(signal.SIGTERM, None)
+
+    def _exit(self, signum, frame):
+        if callable(self._previous):
+            self._previous(signum, frame)
+        else:
+            raise SystemExit(0)
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """等待在途请求全部完成，超时返回False。"""
+        if not self._tasks:
+            return True
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def enter(self, task: asyncio.Task):
+        self._tasks.add(task)
+
+    def leave(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not self._tasks and self._idle is not None:
+            self._idle.set()
+
+    def aborting(self, task: asyncio.Task) -> bool:
+        return task in self._aborting
+
+
+drain_controller = DrainController(grace=settings.DRAIN_GRACE_SECONDS)
+
+registry.callback("gapi_draining", "是否处于排空状态（1表示正在关闭）", lambda: {(): 1.0 if drain_controller.draining else 0.0})
+registry.callback("gapi_drain_active_requests", "排空需要等待的在途API请求数", lambda: {(): drain_controller.active})
+
+
+class DrainMiddleware:
+    """
+    纯ASGI中间件：记录在途的API请求（流式响应到最后一个字节），排空期间直接拒绝新请求。
+    应在最外层，使排队等待准入的请求也计入在途请求。
+    """
+
+    def __init__(self, app, controller: DrainController = drain_controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(_DRAINED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        if self.controller.draining:
+            DRAIN_REJECTED.inc()
+            body = json.dumps({"detail": "Server is shutting down"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"1"),
+                    (b"connection", b"close"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        task = asyncio.current_task()
+        self.controller.enter(task)
+        try:
+            await self.app(scope, receive, send)
+        except asyncio.CancelledError:
+            # 宽限期结束时由排空中止的请求：上游响应已在各自的 finally 中关闭，连接由服务器关闭
+            if not self.controller.aborting(task):
+                raise
+        finally:
+            self.controller.leave(task)
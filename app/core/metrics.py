@@ -0,0 +1,326 @@
+from bisect import bisect_left
+from typing import Callable, Dict, FrozenSet, Iterable, List, Sequence, Set, Tuple
+import time
+
+# 默认的延迟分桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values: str):
+        """返回指定标签值的子指标，创建后缓存，热路径上只有一次字典查找。"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._children[()].inc(amount)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._children[()].set(value)
+
+    def dec(self, amount: float = 1.0):
+        self._children[()].dec(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum", "count")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        # 最后一个桶对应 +Inf
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child: _HistogramChild):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = f'le="{le}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le_label)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+
+class CallbackMetric(_Metric):
+    """抓取时才计算取值的指标，用于缓存计数器、连接池状态等已有统计。"""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Dict[Tuple[str, ...], float]],
+                 labelnames: Sequence[str] = (), metric_type: str = "gauge"):
+        self.type = metric_type
+        self._callback = callback
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return None
+
+    def _samples(self):
+        try:
+            samples = self._callback()
+        except Exception:
+            return
+        for values, value in samples.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable[[], Dict[Tuple[str, ...], float]],
+                 labelnames: Sequence[str] = (), metric_type: str = "gauge") -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, labelnames, metric_type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class ModelLabels:
+    """
+    模型标签的取值。客户端可以发送任意模型名，直接用作标签会让序列数无限增长：
+    只有路由规则中出现的模型和上游模型列表中的模型作为标签值，其余归为 "other"。
+    """
+
+    OTHER = "other"
+
+    def __init__(self):
+        self._configured: FrozenSet[str] = frozenset()
+        self._listed: Set[str] = set()
+
+    def configure(self, models: Iterable[str]):
+        """设置配置中出现的模型（启动和热加载路由规则时调用）。"""
+        self._configured = frozenset(models)
+
+    def add(self, models: Iterable[str]):
+        """加入上游模型列表中的模型。"""
+        self._listed.update(models)
+
+    def known(self, model: str) -> bool:
+        return model in self._configured or model in self._listed
+
+    def __call__(self, model: str) -> str:
+        if not model or self.known(model):
+            return model
+        return self.OTHER
+
+
+model_labels = ModelLabels()
+
+# 请求级指标，由 MetricsMiddleware 记录
+REQUESTS = registry.counter("gapi_requests_total", "处理的请求数", ("route", "model", "status"))
+REQUEST_DURATION = registry.histogram("gapi_request_duration_seconds", "请求总耗时（流式请求到最后一个字节）", ("route", "model", "status"))
+BYTES_IN = registry.counter("gapi_request_bytes_total", "客户端请求体字节数", ("route",))
+BYTES_OUT = registry.counter("gapi_response_bytes_total", "返回给客户端的响应体字节数", ("route",))
+INFLIGHT_STREAMS = registry.gauge("gapi_inflight_streams", "正在向客户端输出的流式响应数")
+
+# 上游与转换阶段
+UPSTREAM_CONNECT = registry.histogram("gapi_upstream_connect_seconds", "建立上游连接（TCP+TLS）耗时")
+UPSTREAM_TTFB = registry.histogram("gapi_upstream_ttfb_seconds", "发送上游请求到收到响应头的耗时", ("status",))
+UPSTREAM_OPEN_RESPONSES = registry.gauge("gapi_upstream_open_responses", "已收到响应头、尚未关闭的上游响应数（各自占用一个连接或HTTP/2流）")
+UPSTREAM_LEAKED_RESPONSES = registry.counter("gapi_upstream_leaked_responses_total", "未关闭就被垃圾回收的上游响应数，非零说明存在泄漏")
+STREAMS_ABORTED = registry.counter("gapi_streams_aborted_total", "未输出完整就结束的流式响应数（客户端中途断开或上游出错）")
+STREAM_FRAMES = registry.counter("gapi_stream_frames_total", "流式响应产出的分块数")
+STREAM_WRITES = registry.counter("gapi_stream_writes_total", "流式响应写出的响应体消息数（合并写出时少于分块数）")
+CONVERT_DURATION = registry.histogram(
+    "gapi_convert_seconds", "格式转换耗时", ("stage",),
+    buckets=(0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+
+
+class MetricsMiddleware:
+    """
+    纯ASGI中间件：记录请求数、耗时、进出字节数和在途流数。
+    路由标签取自匹配的路由模板，模型标签取自 request.state.model（由处理器设置，未知模型归为 other）。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = "500"
+        bytes_in = 0
+        bytes_out = 0
+        streaming = False
+
+        async def receive_wrapper():
+            nonlocal bytes_in
+            message = await receive()
+            if message["type"] == "http.request":
+                bytes_in += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status, bytes_out, streaming
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            elif message["type"] == "http.response.body":
+                bytes_out += len(message.get("body", b""))
+                more_body = message.get("more_body", False)
+                if more_body and not streaming:
+                    streaming = True
+                    INFLIGHT_STREAMS.inc()
+                elif not more_body and streaming:
+                    streaming = False
+                    INFLIGHT_STREAMS.dec()
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            if streaming:
+                INFLIGHT_STREAMS.dec()
+            route = scope.get("route")
+            route_label = getattr(route, "path", None) or "unmatched"
+            state = scope.get("state") or {}
+            model = state.get("model", "") if isinstance(state, dict) else getattr(state, "model", "")
+            model = model_labels(model)
+            REQUESTS.labels(route_label, model, status).inc()
+            REQUEST_DURATION.labels(route_label, model, status).observe(time.perf_counter() - start)
+            BYTES_IN.labels(route_label).inc(bytes_in)
+            BYTES_OUT.labels(route_label).inc(bytes_out)
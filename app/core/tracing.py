@@ -0,0 +1,216 @@
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+import logging
+import random
+import time
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 只追踪API请求，健康检查和 /metrics 不参与
+_TRACED_PREFIXES = ("/v1/", "/v1beta/")
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("gapi_trace", default=None)
+
+
+class Trace:
+    """
+    一个请求的各阶段耗时。
+
+    同名阶段多次出现时（例如逐块编码、逐块写出、换密钥重试的上游调用）累加耗时并计数，
+    Server-Timing 中每个阶段只占一项。
+    """
+
+    __slots__ = ("started", "started_ns", "stages")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_ns = time.time_ns()
+        # 阶段名 -> [第一次开始时间, 累计耗时, 次数]
+        self.stages: Dict[str, List[float]] = {}
+
+    def add(self, name: str, start: float, duration: float):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [start, duration, 1]
+        else:
+            stage[1] += duration
+            stage[2] += 1
+
+    def wall_ns(self, perf: float) -> int:
+        """把 perf_counter 时间换算为墙钟纳秒（导出到 OpenTelemetry 时使用）。"""
+        return self.started_ns + int((perf - self.started) * 1e9)
+
+    def server_timing(self) -> str:
+        """
+        Server-Timing 格式的耗时（毫秒）。proxy 为总耗时减去上游调用耗时，
+        即代理自身（解析、转换、排队、写出等）的开销。
+        """
+        total = time.perf_counter() - self.started
+        parts = [f"{name};dur={stage[1] * 1000:.2f}" for name, stage in self.stages.items()]
+        upstream = self.stages.get("upstream")
+        if upstream is not None:
+            parts.append(f"proxy;dur={max(0.0, total - upstream[1]) * 1000:.2f}")
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+class _Span:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, self.start, time.perf_counter() - self.start)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def span(name: str):
+    """记录一个阶段的耗时；当前请求未被采样时返回无操作的上下文管理器，开销只有一次 ContextVar 读取。"""
+    trace = _current.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _Span(trace, name)
+
+
+class _OTelExporter:
+    """把采样的请求导出为 OpenTelemetry span：请求为根 span，各阶段为子 span。"""
+
+    def __init__(self, kind: str):
+        from opentelemetry import propagate, trace as otel_trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if kind == "otlp":
+            # 端点等参数由 OTEL_EXPORTER_OTLP_* 环境变量指定
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        else:
+            exporter = ConsoleSpanExporter()
+        provider = TracerProvider(resource=Resource.create({"service.name": settings.TRACING_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        self._tracer = provider.get_tracer("gemini-proxy")
+        self._propagate = propagate
+        self._otel_trace = otel_trace
+
+    def export(self, trace: Trace, scope, status: int):
+        # 沿用调用方传入的 traceparent，代理的 span 挂在调用方的追踪下
+        carrier = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        route = getattr(scope.get("route"), "path", None) or scope["path"]
+        root = self._tracer.start_span(
+            f"{scope['method']} {route}",
+            context=self._propagate.extract(carrier),
+            start_time=trace.started_ns,
+            attributes={"http.method": scope["method"], "http.route": route, "http.status_code": status},
+        )
+        context = self._otel_trace.set_span_in_context(root)
+        for name, (start, duration, count) in trace.stages.items():
+            child = self._tracer.start_span(
+                name, context=context, start_time=trace.wall_ns(start), attributes={"gapi.count": int(count)}
+            )
+            child.end(end_time=trace.wall_ns(start + duration))
+        root.end(end_time=trace.wall_ns(time.perf_counter()))
+
+
+def build_exporter(kind: str):
+    if kind == "none":
+        return None
+    if kind not in ("console", "otlp"):
+        logger.warning(f"未知的 TRACING_EXPORTER: {kind}，不导出追踪数据")
+        return None
+    try:
+        return _OTelExporter(kind)
+    except ImportError as exc:
+        logger.warning(f"未安装 OpenTelemetry（pip install opentelemetry-sdk opentelemetry-exporter-otlp），不导出追踪数据: {exc}")
+        return None
+
+
+class TracingMiddleware:
+    """
+    纯ASGI中间件：按 TRACING_SAMPLE_RATE 采样API请求（带 TRACING_HEADER 请求头的请求总是采样）并记录各阶段耗时。
+
+    普通响应在 Server-Timing 响应头中返回各阶段耗时。流式响应的响应头在调用上游之前就已发出，
+    头中只有此前的阶段，完整耗时作为SSE注释（": server-timing ..."，客户端会忽略）追加在流的末尾；
+    原样转发压缩字节（带 Content-Encoding）的流不追加，否则明文注释会跟在压缩数据之后。
+    """
+
+    def __init__(self, app, sample_rate: float = None, exporter=None):
+        self.app = app
+        self.sample_rate = settings.TRACING_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.force_header = settings.TRACING_HEADER.lower().encode("latin-1")
+        self.exporter = exporter
+
+    def _sampled(self, scope) -> bool:
+        if self.sample_rate >= 1.0 or (self.sample_rate > 0.0 and random.random() < self.sample_rate):
+            return True
+        return any(name == self.force_header for name, _ in scope["headers"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(_TRACED_PREFIXES) or not self._sampled(scope):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = _current.set(trace)
+        status = 500
+        event_stream = False
+
+        async def send_wrapper(message):
+            nonlocal status, event_stream
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                encoded = False
+                for name, value in headers:
+                    name = name.lower()
+                    if name == b"content-type" and value.startswith(b"text/event-stream"):
+                        event_stream = True
+                    elif name == b"content-encoding":
+                        encoded = True
+                event_stream = event_stream and not encoded
+                headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                await send({**message, "headers": headers})
+                return
+            if message["type"] == "http.response.body" and event_stream and not message.get("more_body", False):
+                comment = f": server-timing {trace.server_timing()}\n\n".encode("latin-1")
+                message = {**message, "body": message.get("body", b"") + comment}
+            start = time.perf_counter()
+            await send(message)
+            trace.add("write", start, time.perf_counter() - start)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if self.exporter is not None:
+                try:
+                    self.exporter.export(trace, scope, status)
+                except Exception as exc:
+                    logger.warning(f"导出追踪数据失败: {exc}")
+
+
+tracing_exporter = build_exporter(settings.TRACING_EXPORTER)
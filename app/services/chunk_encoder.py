@@ -0,0 +1,57 @@
+from typing import Any, Dict
+import json
+import time
+import uuid
+
+from app.services.converter import converter
+
+try:
+    import orjson
+except ImportError:  # 可选依赖，未安装时使用标准库
+    orjson = None
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """序列化为紧凑的UTF-8 JSON字节；安装了orjson时使用orjson。"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    """解析JSON字节；安装了orjson时使用orjson。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+DONE_FRAME = b"data: [DONE]\n\n"
+
+
+class ChunkEncoder:
+    """
+    单个流式响应的SSE分块编码器。
+
+    id、created、model 在整个流中保持不变（与OpenAI行为一致），信封部分只序列化一次，
+    每个分块只需序列化 choices 并拼接字节。
+    """
+
+    def __init__(self, model: str):
+        self.id = f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time())
+        self.model = model
+        envelope = dumps_bytes({
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+        })
+        # 去掉结尾的 "}"，接上 choices 字段
+        self._prefix = b"data: " + envelope[:-1] + b',"choices":'
+
+    def encode(self, gemini_chunk: Dict[str, Any]) -> bytes:
+        return b"".join((self._prefix, dumps_bytes(converter.gemini_chunk_choices(gemini_chunk)), b"}\n\n"))
+
+    @staticmethod
+    def error(message: str, code: int) -> bytes:
+        return b"data: " + dumps_bytes({"error": {"message": message, "code": code}}) + b"\n\n"
@@ -0,0 +1,167 @@
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+import asyncio
+import logging
+import time
+
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.services.response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+COALESCE_REQUESTS = registry.counter("gapi_coalesce_requests_total", "合并请求中的角色（leader发起上游调用，follower复用结果）", ("role",))
+_LEADER = COALESCE_REQUESTS.labels("leader")
+_FOLLOWER = COALESCE_REQUESTS.labels("follower")
+
+
+class _Flight:
+    """一次共享的上游调用：保存已收到的全部分块，订阅者从头重放后继续跟随新分块。"""
+
+    def __init__(self, source: AsyncIterator[Dict[str, Any]]):
+        self.chunks: List[Dict[str, Any]] = []
+        self.done = False
+        self.cancelled = False
+        self.error: Optional[HTTPException] = None
+        self.started_at = time.monotonic()
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source: AsyncIterator[Dict[str, Any]]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except HTTPException as exc:
+            self.error = exc
+        except asyncio.CancelledError:
+            # 被取消（所有订阅者都已离开或服务关闭）时，仍在等待的订阅者明确失败，而不是当作正常结束
+            self.error = HTTPException(status_code=502, detail="Coalesced upstream request was cancelled")
+            raise
+        except Exception as exc:
+            logger.warning(f"合并的上游请求失败: {exc}")
+            self.error = HTTPException(status_code=500, detail=str(exc))
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def subscribe(self) -> "_Subscription":
+        return _Subscription(self)
+
+    def leave(self):
+        self.subscribers -= 1
+        # 所有订阅者都已离开时取消上游调用，释放连接
+        if self.subscribers == 0 and not self.done:
+            self.cancelled = True
+            self.task.cancel()
+
+
+class _Subscription:
+    """
+    一个订阅者的分块迭代器：从头重放已收到的分块后继续跟随新分块。
+    创建时即计入订阅者数（加入后尚未开始读取的订阅者也会阻止取消上游调用），
+    读取结束、出错或 aclose() 时退出，即使从未开始读取。
+    """
+
+    def __init__(self, flight: _Flight):
+        self._flight = flight
+        self._position = 0
+        self._left = False
+        flight.subscribers += 1
+
+    def __aiter__(self) -> "_Subscription":
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        flight = self._flight
+        try:
+            while self._position >= len(flight.chunks):
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    raise StopAsyncIteration
+                await flight._changed.wait()
+        except BaseException:
+            self._leave()
+            raise
+        chunk = flight.chunks[self._position]
+        self._position += 1
+        return chunk
+
+    async def aclose(self):
+        self._leave()
+
+    def _leave(self):
+        if not self._left:
+            self._left = True
+            self._flight.leave()
+
+
+class Coalescer:
+    """
+    相同补全请求的单飞合并。
+
+    转换后负载哈希相同的并发请求共享一次上游调用：非流式请求得到同一结果，
+    流式请求得到同一分块序列，迟到的请求先从缓冲区重放已收到的分块。
+    上游调用开始超过 COALESCE_WINDOW_MS 后到达的请求不再加入，而是发起新的调用。
+    """
+
+    def __init__(self, enabled: bool, window: float, deterministic_only: bool):
+        self.enabled = enabled
+        self.window = window
+        self.deterministic_only = deterministic_only
+        self._flights: Dict[str, _Flight] = {}
+
+    def eligible(self, payload: Dict[str, Any]) -> bool:
+        """非确定性请求各自的结果本应不同，默认不参与合并。"""
+        if not self.enabled:
+            return False
+        return not self.deterministic_only or ResponseCache.eligible(payload)
+
+    @staticmethod
+    def make_key(method: str, model: str, payload: Dict[str, Any], api_key: Optional[str]) -> str:
+        return ResponseCache.make_key(f"{model}:{method}", payload, api_key)
+
+    def subscribe(self, key: str, start: Callable[[], AsyncIterator[Dict[str, Any]]]) -> _Subscription:
+        """
+        加入键相同的进行中调用；没有可加入的调用时用 start() 发起新调用。
+        返回时即已计入订阅者，调用方必须读取到结束或调用 aclose()。
+        """
+        flight = self._flights.get(key)
+        if flight is not None and not flight.cancelled and time.monotonic() - flight.started_at <= self.window:
+            _FOLLOWER.inc()
+            return flight.subscribe()
+
+        flight = _Flight(start())
+        self._flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._discard(key, flight))
+        _LEADER.inc()
+        return flight.subscribe()
+
+    def _discard(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "flights": len(self._flights),
+            "subscribers": sum(flight.subscribers for flight in self._flights.values()),
+        }
+
+
+coalescer = Coalescer(
+    enabled=settings.COALESCE_ENABLED,
+    window=settings.COALESCE_WINDOW_MS / 1000,
+    deterministic_only=settings.COALESCE_DETERMINISTIC_ONLY
+)
+
+registry.callback(
+    "gapi_coalesce_inflight", "进行中的合并上游调用数",
+    lambda: {(): coalescer.stats()["flights"]}
+)
@@ -0,0 +1,46 @@
+from typing import Optional, Tuple
+import gzip
+
+from app.core.config import settings
+from app.core.tracing import span
+
+
+def accepts_encoding(accept_encoding: Optional[str], content_encoding: str) -> bool:
+    """
+    按客户端的 Accept-Encoding 判断是否接受给定的 Content-Encoding。
+    Content-Encoding 可能是多个编码的列表（依次应用），每个编码都必须被接受；
+    q=0 表示拒绝，"*" 匹配未列出的编码。
+    """
+    if not accept_encoding:
+        return False
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality > 0
+    for coding in content_encoding.split(","):
+        coding = coding.strip().lower()
+        if not coding or coding == "identity":
+            continue
+        if not accepted.get(coding, accepted.get("*", False)):
+            return False
+    return True
+
+
+def compress_body(body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """
+    响应体不小于 RESPONSE_GZIP_MIN_BYTES 且客户端接受 gzip 时压缩，返回 (响应体, Content-Encoding)。
+    RESPONSE_GZIP_MIN_BYTES 为0时不压缩。
+    """
+    if settings.RESPONSE_GZIP_MIN_BYTES <= 0 or len(body) < settings.RESPONSE_GZIP_MIN_BYTES:
+        return body, None
+    if not accepts_encoding(accept_encoding, "gzip"):
+        return body, None
+    with span("compress"):
+        return gzip.compress(body, compresslevel=settings.RESPONSE_GZIP_LEVEL), "gzip"
@@ -0,0 +1,154 @@
+from typing import List, Optional
+import asyncio
+import logging
+import signal
+
+from app.core.admission import _parse_weights, admission_controller
+from app.core.config import Settings, settings
+from app.core.drain import drain_controller
+from app.core.metrics import registry
+from app.services.coalescer import coalescer
+from app.services.context_cache import context_cache
+from app.services.embedding_batcher import embedding_batcher
+from app.services.file_offload import file_offload
+from app.services.history_cache import history_cache
+from app.services.key_pool import key_pool
+from app.services.media_cache import media_cache
+from app.services.model_cache import model_cache
+from app.services.proxy_service import proxy_service
+from app.services.response_cache import response_cache
+from app.services.retry_policy import retry_policy
+from app.services.upstream_router import _parse_endpoints, _parse_routes, upstream_router
+
+logger = logging.getLogger(__name__)
+
+CONFIG_RELOADS = registry.counter("gapi_config_reloads_total", "配置热加载次数（ok/unchanged/error）", ("result",))
+
+# 变化时需要重建上游连接池的设置
+_POOL_SETTINGS = frozenset((
+    "UPSTREAM_BASE_URL", "UPSTREAM_MAX_CONNECTIONS", "UPSTREAM_MAX_KEEPALIVE", "UPSTREAM_KEEPALIVE_EXPIRY",
+    "UPSTREAM_TIMEOUT", "UPSTREAM_CONNECT_TIMEOUT", "UPSTREAM_HTTP2", "UPSTREAM_STREAM_MAX_CONNECTIONS",
+))
+# 在启动时决定（中间件、导出器、持久层等），修改后需要重启才能生效的设置
+_RESTART_SETTINGS = frozenset((
+    "PORT", "METRICS_ENABLED", "ADMISSION_ENABLED", "TRACING_ENABLED", "TRACING_EXPORTER", "TRACING_SERVICE_NAME",
+    "RESPONSE_CACHE_ENABLED", "RESPONSE_CACHE_SQLITE_PATH", "RESPONSE_CACHE_SQLITE_MAX_BYTES", "MEDIA_CACHE_DIR",
+))
+
+
+class ConfigReloader:
+    """
+    运行时重新读取配置（环境变量和 .env 文件，环境变量优先），不重启、不断开连接。
+
+    大部分设置在每次请求时读取，更新 settings 后立即生效；启动时创建的组件按变化的设置分别调整：
+    连接池参数变化时重建连接池（旧连接池上的请求和流照常完成后再关闭），端点和路由规则、密钥池、
+    各级缓存的容量、准入控制和重试参数原地更新并保留运行状态。新配置无效时整体不生效。
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    def install(self):
+        """在 lifespan 启动阶段调用：收到 SIGHUP 时热加载配置（不支持的平台上忽略）。"""
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        except (AttributeError, NotImplementedError, RuntimeError):
+            logger.info("当前平台不支持 SIGHUP，配置热加载不可用")
+
+    async def reload(self) -> Optional[List[str]]:
+        """重新读取配置并应用，返回变化的设置名；配置无效时返回 None 并保持原配置。"""
+        async with self._lock:
+            try:
+                fresh = Settings()
+                changed = sorted(
+                    name for name in type(settings).model_fields if getattr(fresh, name) != getattr(settings, name)
+                )
+                if not changed:
+                    CONFIG_RELOADS.labels("unchanged").inc()
+                    logger.info("配置没有变化")
+                    return []
+                # 先解析会失败的部分，失败时不修改任何设置
+                endpoints = _parse_endpoints(fresh.UPSTREAM_ENDPOINTS)
+                routes = _parse_routes(fresh.MODEL_ROUTES)
+                weights = _parse_weights(fresh.ADMISSION_TENANT_WEIGHTS)
+                for pattern, targets in routes:
+                    for endpoint, _ in targets:
+                        if endpoint != "default" and endpoint not in endpoints:
+                            raise ValueError(f"MODEL_ROUTES 中的规则 {pattern} 引用了未定义的上游端点 {endpoint}")
+            except ValueError as exc:
+                CONFIG_RELOADS.labels("error").inc()
+                logger.error(f"配置无效，未热加载: {exc}")
+                return None
+
+            restart = [name for name in changed if name in _RESTART_SETTINGS]
+            for name in changed:
+                if name not in _RESTART_SETTINGS:
+                    setattr(settings, name, getattr(fresh, name))
+            await self._apply(set(changed), endpoints, routes, weights)
+            CONFIG_RELOADS.labels("ok").inc()
+            logger.info(f"已热加载配置: {', '.join(name for name in changed if name not in _RESTART_SETTINGS)}")
+            if restart:
+                logger.warning(f"以下设置需要重启才能生效: {', '.join(restart)}")
+            return changed
+
+    @staticmethod
+    async def _apply(changed: set, endpoints, routes, weights):
+        rebuild_pools = bool(changed & _POOL_SETTINGS)
+        if rebuild_pools:
+            await proxy_service.reload_pools()
+        if rebuild_pools or changed & {"UPSTREAM_ENDPOINTS", "MODEL_ROUTES"}:
+            await upstream_router.reload(endpoints, routes, rebuild_pools=rebuild_pools)
+
+        if changed & {"GEMINI_API_KEYS", "KEY_COOLDOWN_SECONDS", "KEY_RPM_LIMIT", "KEY_POOL_ACCESS_TOKEN"}:
+            key_pool.reload(
+                keys=[key.strip() for key in settings.GEMINI_API_KEYS.split(",")],
+                cooldown=settings.KEY_COOLDOWN_SECONDS,
+                rpm_limit=settings.KEY_RPM_LIMIT,
+                access_token=settings.KEY_POOL_ACCESS_TOKEN
+            )
+
+        history_cache.resize(settings.HISTORY_CACHE_MAX_BYTES)
+        await media_cache.resize(settings.MEDIA_CACHE_MAX_BYTES)
+        media_cache.disk_max_bytes = settings.MEDIA_CACHE_DISK_MAX_BYTES
+        media_cache.url_ttl = settings.MEDIA_CACHE_URL_TTL
+        response_cache.resize(settings.RESPONSE_CACHE_MAX_BYTES, settings.RESPONSE_CACHE_TTL)
+        model_cache.ttl = settings.MODEL_CACHE_TTL
+        model_cache.stale_ttl = settings.MODEL_CACHE_STALE_TTL
+
+        context_cache.enabled = settings.CONTEXT_CACHE_ENABLED
+        context_cache.min_tokens = settings.CONTEXT_CACHE_MIN_TOKENS
+        context_cache.ttl = settings.CONTEXT_CACHE_TTL
+        context_cache.leading_contents = settings.CONTEXT_CACHE_LEADING_CONTENTS
+        context_cache.refresh_margin = settings.CONTEXT_CACHE_REFRESH_MARGIN
+        context_cache.resize(settings.CONTEXT_CACHE_MAX_ENTRIES)
+
+        file_offload.enabled = settings.FILE_OFFLOAD_ENABLED
+        file_offload.min_bytes = settings.FILE_OFFLOAD_MIN_BYTES
+        file_offload.processing_timeout = settings.FILE_OFFLOAD_PROCESSING_TIMEOUT
+        file_offload.resize(settings.FILE_OFFLOAD_MAX_ENTRIES)
+
+        coalescer.enabled = settings.COALESCE_ENABLED
+        coalescer.window = settings.COALESCE_WINDOW_MS / 1000
+        coalescer.deterministic_only = settings.COALESCE_DETERMINISTIC_ONLY
+
+        embedding_batcher.max_batch_size = max(1, settings.EMBEDDING_BATCH_MAX_SIZE)
+        embedding_batcher.linger = settings.EMBEDDING_BATCH_LINGER_MS / 1000
+
+        admission_controller.reconfigure(
+            max_concurrency=settings.ADMISSION_MAX_CONCURRENCY,
+            tenant_concurrency=settings.ADMISSION_TENANT_CONCURRENCY,
+            queue_size=settings.ADMISSION_QUEUE_SIZE,
+            queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+            weights=weights
+        )
+        retry_policy.reconfigure(
+            max_attempts=settings.RETRY_MAX_ATTEMPTS,
+            retry_ratio=settings.RETRY_BUDGET_RATIO,
+            hedge_enabled=settings.HEDGE_ENABLED,
+            hedge_ratio=settings.HEDGE_MAX_RATIO
+        )
+        drain_controller.grace = settings.DRAIN_GRACE_SECONDS
+
+
+config_reloader = ConfigReloader()
@@ -0,0 +1,208 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.services.proxy_service import proxy_service
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_CACHE_EVENTS = registry.counter("gapi_context_cache_events_total", "上游上下文缓存事件", ("event",))
+
+# 作为缓存前缀的负载字段（会从请求负载中移除，改为引用 cachedContent）
+_PREFIX_FIELDS = ("system_instruction", "tools", "tool_config")
+# 创建失败后在这段时间内不再重试同一前缀
+_FAILURE_BACKOFF = 60.0
+# 剩余有效期不足该值的条目视为已过期，避免请求到达上游时恰好失效
+_EXPIRY_SAFETY = 10.0
+
+
+class _Entry:
+    __slots__ = ("name", "expires_at", "api_key")
+
+    def __init__(self, name: str, expires_at: float, api_key: str):
+        self.name = name
+        self.expires_at = expires_at
+        self.api_key = api_key
+
+
+class ContextCache:
+    """
+    自动使用 Gemini 上下文缓存（cachedContents）。
+
+    当 system_instruction、tools、tool_config 及前 CONTEXT_CACHE_LEADING_CONTENTS 条 contents
+    组成的稳定前缀超过阈值时，在上游创建 cachedContents 资源并在后续请求中按名称引用。
+    本地登记表记录每个资源的有效期：临近过期时后台续期，超出数量上限时淘汰并删除上游资源。
+    创建失败时原样返回负载。
+    """
+
+    def __init__(self, enabled: bool, min_tokens: int, ttl: int, leading_contents: int,
+                 refresh_margin: float, max_entries: int):
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.leading_contents = leading_contents
+        self.refresh_margin = refresh_margin
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._creating: Dict[str, asyncio.Task] = {}
+        self._failures: Dict[str, float] = {}
+        self._refreshing: Set[str] = set()
+        self._background: Set[asyncio.Task] = set()
+
+    async def apply(self, payload: Dict[str, Any], model: str, api_key: str) -> Dict[str, Any]:
+        """返回发往上游的负载；可用缓存时用 cachedContent 引用替换稳定前缀。"""
+        if not self.enabled or not api_key:
+            return payload
+
+        contents = payload.get("contents") or []
+        # 至少保留一条 contents 随请求发送
+        leading = min(self.leading_contents, max(0, len(contents) - 1))
+        prefix = {field: payload[field] for field in _PREFIX_FIELDS if payload.get(field)}
+        if leading:
+            prefix["contents"] = contents[:leading]
+        if not prefix:
+            return payload
+
+        serialized = json.dumps(prefix, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        # 粗略估算：约4个字符一个token
+        if len(serialized) // 4 < self.min_tokens:
+            return payload
+
+        key = hashlib.sha256(f"{api_key}\0{model}\0{serialized}".encode("utf-8", "surrogatepass")).hexdigest()
+        entry = await self._lookup(key, prefix, model, api_key)
+        if entry is None:
+            return payload
+
+        rewritten = {k: v for k, v in payload.items() if k not in _PREFIX_FIELDS}
+        rewritten["contents"] = contents[leading:]
+        rewritten["cachedContent"] = entry.name
+        return rewritten
+
+    async def _lookup(self, key: str, prefix: Dict[str, Any], model: str, api_key: str) -> Optional[_Entry]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            remaining = entry.expires_at - now
+            if remaining > _EXPIRY_SAFETY:
+                self._entries.move_to_end(key)
+                CONTEXT_CACHE_EVENTS.labels("hit").inc()
+                if remaining < self.refresh_margin and key not in self._refreshing:
+                    self._spawn(self._refresh(key, entry))
+                return entry
+            # 已过期，上游会自行清理
+            del self._entries[key]
+            CONTEXT_CACHE_EVENTS.labels("expired").inc()
+
+        failed_at = self._failures.get(key)
+        if failed_at is not None:
+            if now - failed_at < _FAILURE_BACKOFF:
+                return None
+            del self._failures[key]
+
+        task = self._creating.get(key)
+        if task is None:
+            task = asyncio.create_task(self._create(key, prefix, model, api_key))
+            self._creating[key] = task
+        return await asyncio.shield(task)
+
+    async def _create(self, key: str, prefix: Dict[str, Any], model: str, api_key: str) -> Optional[_Entry]:
+        body = {"model": f"models/{model}", "ttl": f"{self.ttl}s", **prefix}
+        try:
+            response = await proxy_service.client.post(
+                "/v1beta/cachedContents", json=body, headers={"x-goog-api-key": api_key}, timeout=60.0
+            )
+            response.raise_for_status()
+            name = response.json()["name"]
+        except (httpx.HTTPError, KeyError, ValueError) as exc:
+            logger.warning(f"创建上下文缓存失败，改为内联发送: {exc}")
+            CONTEXT_CACHE_EVENTS.labels("create_failed").inc()
+            self._record_failure(key)
+            return None
+        finally:
+            self._creating.pop(key, None)
+
+        CONTEXT_CACHE_EVENTS.labels("created").inc()
+        self._failures.pop(key, None)
+        entry = _Entry(name, time.time() + self.ttl, api_key)
+        self._entries[key] = entry
+        self._evict()
+        return entry
+
+    def _record_failure(self, key: str):
+        """记录创建失败的时间。只保留退避期内的记录，且不超过登记数上限（超出时丢弃最早的）。"""
+        now = time.time()
+        self._failures.pop(key, None)
+        self._failures[key] = now
+        if len(self._failures) > self.max_entries:
+            self._failures = {k: t for k, t in self._failures.items() if now - t < _FAILURE_BACKOFF}
+            while len(self._failures) > self.max_entries:
+                del self._failures[next(iter(self._failures))]
+
+    def resize(self, max_entries: int):
+        """调整登记数上限（热加载配置），被淘汰的缓存在后台从上游删除。"""
+        self.max_entries = max_entries
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            CONTEXT_CACHE_EVENTS.labels("evicted").inc()
+            self._spawn(self._delete(evicted))
+
+    async def _refresh(self, key: str, entry: _Entry):
+        self._refreshing.add(key)
+        try:
+            response = await proxy_service.client.patch(
+                f"/v1beta/{entry.name}", json={"ttl": f"{self.ttl}s"},
+                params={"updateMask": "ttl"}, headers={"x-goog-api-key": entry.api_key}, timeout=30.0
+            )
+            response.raise_for_status()
+            entry.expires_at = time.time() + self.ttl
+            CONTEXT_CACHE_EVENTS.labels("refreshed").inc()
+        except httpx.HTTPError as exc:
+            # 续期失败则让条目自然过期，之后重新创建
+            logger.warning(f"上下文缓存续期失败: {entry.name}: {exc}")
+        finally:
+            self._refreshing.discard(key)
+
+    async def _delete(self, entry: _Entry):
+        try:
+            await proxy_service.client.delete(f"/v1beta/{entry.name}", headers={"x-goog-api-key": entry.api_key}, timeout=30.0)
+        except httpx.HTTPError as exc:
+            logger.warning(f"删除上下文缓存失败: {entry.name}: {exc}")
+
+    def invalidate(self, name: str, error: str):
+        """
+        上游因引用的缓存不存在或不可用而拒绝请求时，移除对应条目并删除上游资源（已不存在时删除失败无妨）。
+        error 为上游的错误信息，没有提到该缓存时（例如普通的参数错误）不处理。
+        """
+        if name not in error and "cachedcontent" not in error.lower().replace(" ", ""):
+            return
+        for key, entry in list(self._entries.items()):
+            if entry.name == name:
+                del self._entries[key]
+                CONTEXT_CACHE_EVENTS.labels("invalidated").inc()
+                self._spawn(self._delete(entry))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+
+context_cache = ContextCache(
+    enabled=settings.CONTEXT_CACHE_ENABLED,
+    min_tokens=settings.CONTEXT_CACHE_MIN_TOKENS,
+    ttl=settings.CONTEXT_CACHE_TTL,
+    leading_contents=settings.CONTEXT_CACHE_LEADING_CONTENTS,
+    refresh_margin=settings.CONTEXT_CACHE_REFRESH_MARGIN,
+    max_entries=settings.CONTEXT_CACHE_MAX_ENTRIES
+)
@@ -1,109 +1,157 @@
-from typing import List, Dict, Any, Optional
-from app.schemas.openai import ChatCompletionRequest, ChatMessage
+from typing import List, Dict, Any, Optional, Tuple
+from app.schemas.openai import ChatCompletionRequest, EmbeddingRequest
+from app.services.media_fetcher import media_fetcher
+from app.services.media_cache import media_cache
+from app.services.history_cache import history_cache, HistorySnapshot
+from app.core.config import settings
+from app.core.metrics import CONVERT_DURATION
+from app.core.tracing import span
 import time
 import uuid
 
-import httpx
+import asyncio
 import base64
 import json
+import struct
+
+_CONVERT_REQUEST = CONVERT_DURATION.labels("openai_to_gemini")
+
+
+_CHAT_NUMBER_FIELDS = ("temperature", "top_p", "presence_penalty", "frequency_penalty")
+
 
 class Converter:
     @staticmethod
-    async def openai_to_gemini(request: ChatCompletionRequest) -> Dict[str, Any]:
+    def check_chat_request(body: Any) -> Dict[str, Any]:
+        """
+        快速路径的最小结构检查，代替构建完整的 ChatCompletionRequest。
+        检查项与pydantic模型的必填字段和类型一致，不合法时抛出 ValueError。
+        """
+        if not isinstance(body, dict):
+            raise ValueError("request body must be a JSON object")
+        if not isinstance(body.get("model"), str):
+            raise ValueError("model: field required (str)")
+        messages = body.get("messages")
+        if not isinstance(messages, list):
+            raise ValueError("messages: field required (list)")
+        for i, msg in enumerate(messages):
+            if not isinstance(msg, dict):
+                raise ValueError(f"messages.{i}: must be an object")
+            if not isinstance(msg.get("role"), str):
+                raise ValueError(f"messages.{i}.role: field required (str)")
+            content = msg.get("content")
+            if not isinstance(content, (str, list)):
+                raise ValueError(f"messages.{i}.content: field required (str or list)")
+            if isinstance(content, list) and not all(isinstance(item, dict) for item in content):
+                raise ValueError(f"messages.{i}.content: list items must be objects")
+            tool_calls = msg.get("tool_calls")
+            if tool_calls is not None and not (isinstance(tool_calls, list) and all(isinstance(tc, dict) for tc in tool_calls)):
+                raise ValueError(f"messages.{i}.tool_calls: must be a list of objects")
+        for field in _CHAT_NUMBER_FIELDS:
+            value = body.get(field)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError(f"{field}: must be a number")
+        for field in ("n", "max_tokens"):
+            value = body.get(field)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+                raise ValueError(f"{field}: must be an integer")
+        stop = body.get("stop")
+        if stop is not None and not isinstance(stop, (str, list)):
+            raise ValueError("stop: must be a string or list")
+        tools = body.get("tools")
+        if tools is not None and not (isinstance(tools, list) and all(isinstance(tool, dict) for tool in tools)):
+            raise ValueError("tools: must be a list of objects")
+        tool_choice = body.get("tool_choice")
+        if tool_choice is not None and not isinstance(tool_choice, (str, dict)):
+            raise ValueError("tool_choice: must be a string or object")
+        return body
+
+    @staticmethod
+    def validate_chat_request(body: Any) -> Dict[str, Any]:
+        """pydantic路径：完整校验并返回规范化后的请求字典（例如数值字符串会被转换）。"""
+        if not isinstance(body, dict):
+            raise ValueError("request body must be a JSON object")
+        return ChatCompletionRequest(**body).model_dump()
+
+    @staticmethod
+    async def openai_to_gemini(request: Dict[str, Any]) -> Dict[str, Any]:
+        """把已通过检查的OpenAI聊天请求（原始JSON字典）一次遍历转换为Gemini负载。"""
+        with _CONVERT_REQUEST.time(), span("convert"):
+            return await Converter._openai_to_gemini(request)
+
+    @staticmethod
+    async def _openai_to_gemini(request: Dict[str, Any]) -> Dict[str, Any]:
         contents = []
         system_instruction = None
+        pending_images = []
+        messages = request["messages"]
+        # tool_call_id -> 函数名，随遍历到的assistant消息逐步建立
+        tool_call_names = {}
+
+        # 多轮对话：复用最长的已转换前缀，只转换新增的尾部消息
+        start = 0
+        prefix_keys = None
+        if history_cache.enabled and len(messages) > 1:
+            prefix_keys = history_cache.prefix_keys(messages)
+            snapshot = history_cache.lookup(messages, prefix_keys)
+            if snapshot is not None:
+                start = snapshot.count
+                contents = list(snapshot.contents)
+                system_instruction = snapshot.system_instruction
+                tool_call_names = dict(snapshot.tool_call_names)
+            history_cache.record(start, len(messages) - start)
         
-        for msg in request.messages:
-            if msg.role == "system":
-                system_instruction = {"parts": [{"text": msg.content}]}
-            elif msg.role == "user":
+        for msg in messages[start:]:
+            role = msg["role"]
+            content = msg.get("content")
+            if role == "system":
+                system_instruction = {"parts": [{"text": content}]}
+            elif role == "user":
                 parts = []
-                if isinstance(msg.content, str):
-                    parts.append({"text": msg.content})
-                elif isinstance(msg.content, list):
-                    for item in msg.content:
+                if isinstance(content, str):
+                    parts.append({"text": content})
+                elif isinstance(content, list):
+                    for item in content:
                         if item.get("type") == "text":
                             parts.append({"text": item["text"]})
                         elif item.get("type") == "image_url":
                             image_url = item["image_url"]["url"]
-                            mime_type = "image/jpeg" # 默认
-                            data = None
 
                             if image_url.startswith("data:"):
                                 # Base64编码
-                                header, encoded = image_url.split(",", 1)
-                                data = encoded
-                                if "image/png" in header:
-                                    mime_type = "image/png"
-                                elif "image/jpeg" in header:
-                                    mime_type = "image/jpeg"
-                                elif "image/webp" in header:
-                                    mime_type = "image/webp"
-                                elif "image/heic" in header:
-                                    mime_type = "image/heic"
-                            else:
-                                # URL - 下载它
-                                async with httpx.AsyncClient() as client:
-                                    resp = await client.get(image_url)
-                                    if resp.status_code == 200:
-                                        data = base64.b64encode(resp.content).decode("utf-8")
-                                        content_type = resp.headers.get("content-type")
-                                        if content_type:
-                                            mime_type = content_type
-                            
-                            if data:
+                                mime_type, data = Converter._split_data_uri(image_url)
                                 parts.append({
                                     "inline_data": {
                                         "mime_type": mime_type,
                                         "data": data
                                     }
                                 })
+                            else:
+                                # URL - 先占位，循环结束后统一并发下载
+                                part = {"inline_data": None}
+                                parts.append(part)
+                                pending_images.append((parts, part, image_url))
                 contents.append({"role": "user", "parts": parts})
-            elif msg.role == "assistant":
+            elif role == "assistant":
                 parts = []
-                if msg.tool_calls:
-                    for tool_call in msg.tool_calls:
+                if msg.get("tool_calls"):
+                    for tool_call in msg["tool_calls"]:
+                        if tool_call.get("id"):
+                            tool_call_names[tool_call["id"]] = tool_call["function"]["name"]
                         parts.append({
                             "functionCall": {
                                 "name": tool_call["function"]["name"],
                                 "args": json.loads(tool_call["function"]["arguments"])
                             }
                         })
-                if msg.content:
-                    parts.append({"text": msg.content})
+                if content:
+                    parts.append({"text": content})
                 contents.append({"role": "model", "parts": parts})
-            elif msg.role == "tool":
+            elif role == "tool":
                 # OpenAI tool响应 -> Gemini functionResponse
-                # 我们需要匹配tool call id吗？Gemini不使用相同ID方式，它依赖顺序或名称。
-                # 但对于代理，我们只需要构造一个有效的functionResponse。
-                # 我们假设名称可用，或者我们可能需要推断它。
-                # OpenAI 'tool'消息有时有'name'，但'tool_call_id'是关键。
-                # 如果未提供，我们可能需要回查以前的消息来找到名称，
-                # 但让我们假设'name'已填充，或者我们无法轻松支持它而不保留状态。
-                # 实际上，OpenAI 'tool'消息通常没有name，只有tool_call_id。
-                # Gemini需要'name'。
-                # 这对于无状态代理来说是一个问题。
-                # 然而，许多客户端在tool消息中发送'name'，或者我们可以尝试猜测。
-                # 或者我们可以只是传递内容，希望Gemini能解决（它不会）。
-                
-                # 解决方案：如果缺少name，我们可能会失败。
-                # 但让我们检查ChatMessage模型中是否有'name'字段。是的，有。
-                # 如果客户端发送它，很好。如果没有，我们就麻烦了。
-                # 标准的OpenAI客户端可能不会发送它。
-                
-                function_name = msg.name
-                if not function_name:
-                    # 尝试在匹配tool_call_id的前一个assistant消息中找到它
-                    # 这需要向后迭代。
-                    for prev_msg in reversed(request.messages):
-                        if prev_msg.role == "assistant" and prev_msg.tool_calls:
-                            for tc in prev_msg.tool_calls:
-                                if tc["id"] == msg.tool_call_id: # msg.tool_call_id可能还不在ChatMessage schema中？
-                                    # 等等，ChatMessage schema需要tool_call_id对应role='tool'
-                                    function_name = tc["function"]["name"]
-                                    break
-                        if function_name:
-                            break
+                # Gemini需要函数名，而标准OpenAI客户端的tool消息通常只有tool_call_id，
+                # 没有name时按tool_call_id在assistant消息的tool_calls中查找。
+                function_name = msg.get("name") or tool_call_names.get(msg.get("tool_call_id"))
                 
                 if function_name:
                     contents.append({
@@ -111,18 +159,30 @@ class Converter:
                         "parts": [{
                             "functionResponse": {
                                 "name": function_name,
-                                "response": {"content": msg.content} # Gemini通常期期一个dict
+                                "response": {"content": content} # Gemini通常期期一个dict
                             }
                         }]
                     })
                 else:
                     # 回退方案：只是作为用户文本发送？
-                    contents.append({"role": "user", "parts": [{"text": f"Tool output: {msg.content}"}]})
+                    contents.append({"role": "user", "parts": [{"text": f"Tool output: {content}"}]})
+
+        cacheable = True
+        if pending_images:
+            # 有图像下载失败时不缓存，下一轮重新尝试
+            with span("images"):
+                cacheable = await Converter._fetch_images(pending_images)
+
+        if prefix_keys is not None and cacheable and start < len(messages):
+            history_cache.store(prefix_keys[-1], HistorySnapshot(
+                list(messages), tuple(contents), system_instruction, dict(tool_call_names),
+                history_cache.estimate_size(messages, start)
+            ))
 
         tools = None
-        if request.tools:
+        if request.get("tools"):
             tools_list = []
-            for tool in request.tools:
+            for tool in request["tools"]:
                 if tool["type"] == "function":
                     tools_list.append({
                         "name": tool["function"]["name"],
@@ -132,37 +192,39 @@ class Converter:
             if tools_list:
                 tools = [{"function_declarations": tools_list}]
         
+        stop = request.get("stop")
         payload = {
             "contents": contents,
             "generationConfig": {
-                "temperature": request.temperature,
-                "topP": request.top_p,
-                "maxOutputTokens": request.max_tokens,
-                "stopSequences": request.stop if isinstance(request.stop, list) else [request.stop] if request.stop else None
+                "temperature": request.get("temperature", 1.0),
+                "topP": request.get("top_p", 1.0),
+                "maxOutputTokens": request.get("max_tokens"),
+                "stopSequences": stop if isinstance(stop, list) else [stop] if stop else None
             }
         }
         
         if tools:
             payload["tools"] = tools
             
-        if request.tool_choice:
+        tool_choice = request.get("tool_choice")
+        if tool_choice:
             # 映射tool_choice
             # OpenAI: "auto", "none", 或 {"type": "function", "function": {"name": "..."}}
             # Gemini: "AUTO", "ANY", "NONE"
             mode = "AUTO"
             allowed_function_names = None
             
-            if isinstance(request.tool_choice, str):
-                if request.tool_choice == "none":
+            if isinstance(tool_choice, str):
+                if tool_choice == "none":
                     mode = "NONE"
-                elif request.tool_choice == "auto":
+                elif tool_choice == "auto":
                     mode = "AUTO"
-                elif request.tool_choice == "required": # OpenAI没有'required'但有些有
+                elif tool_choice == "required": # OpenAI没有'required'但有些有
                     mode = "ANY"
-            elif isinstance(request.tool_choice, dict):
-                if request.tool_choice.get("type") == "function":
+            elif isinstance(tool_choice, dict):
+                if tool_choice.get("type") == "function":
                     mode = "ANY"
-                    allowed_function_names = [request.tool_choice["function"]["name"]]
+                    allowed_function_names = [tool_choice["function"]["name"]]
             
             tool_config = {
                 "function_calling_config": {
@@ -179,6 +241,67 @@ class Converter:
             
         return payload
 
+    @staticmethod
+    def _split_data_uri(image_url: str) -> Tuple[str, str]:
+        header, encoded = image_url.split(",", 1)
+        mime_type = "image/jpeg" # 默认
+        if "image/png" in header:
+            mime_type = "image/png"
+        elif "image/jpeg" in header:
+            mime_type = "image/jpeg"
+        elif "image/webp" in header:
+            mime_type = "image/webp"
+        elif "image/heic" in header:
+            mime_type = "image/heic"
+        return mime_type, encoded
+
+    @staticmethod
+    async def _fetch_images(pending_images: List[Tuple[List[Dict[str, Any]], Dict[str, Any], str]]) -> bool:
+        """
+        并发下载请求中的所有远程图像，并发数受 IMAGE_FETCH_CONCURRENCY 限制。
+        已缓存的URL直接复用，同一URL只下载一次；下载失败的图像从对应的parts中移除。
+        全部成功时返回True。
+        """
+        resolved = {}
+        missing = []
+        for url in dict.fromkeys(url for _, _, url in pending_images):
+            entry = await media_cache.get_url(url) if media_cache.enabled else None
+            if entry is not None:
+                resolved[url] = entry
+            else:
+                missing.append(url)
+
+        if missing:
+            semaphore = asyncio.Semaphore(max(1, settings.IMAGE_FETCH_CONCURRENCY))
+
+            async def fetch_one(url: str):
+                async with semaphore:
+                    return await media_fetcher.fetch(url)
+
+            fetched = await asyncio.gather(*(fetch_one(url) for url in missing))
+            for url, entry in zip(missing, fetched):
+                resolved[url] = entry
+                if entry is not None and media_cache.enabled:
+                    await media_cache.put_url(url, *entry)
+
+        complete = True
+        for parts, part, url in pending_images:
+            result = resolved[url]
+            if result:
+                mime_type, data = result
+                part["inline_data"] = {
+                    "mime_type": mime_type,
+                    "data": data
+                }
+            else:
+                complete = False
+                # 按身份移除，避免误删内容相同的其他占位
+                for index, existing in enumerate(parts):
+                    if existing is part:
+                        del parts[index]
+                        break
+        return complete
+
     @staticmethod
     def gemini_to_openai(response: Dict[str, Any], model: str) -> Dict[str, Any]:
         choices = []
@@ -236,6 +359,17 @@ class Converter:
 
     @staticmethod
     def gemini_to_openai_chunk(response: Dict[str, Any], model: str) -> Dict[str, Any]:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4()}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": Converter.gemini_chunk_choices(response)
+        }
+
+    @staticmethod
+    def gemini_chunk_choices(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """把一个Gemini流式分块转换为OpenAI分块的choices列表（不含外层信封）。"""
         choices = []
         if "candidates" in response:
             for i, candidate in enumerate(response["candidates"]):
@@ -279,12 +413,38 @@ class Converter:
                     "finish_reason": finish_reason
                 })
         
+        return choices
+
+    @staticmethod
+    def openai_to_gemini_embeddings(request: EmbeddingRequest, model: str) -> List[Dict[str, Any]]:
+        """把OpenAI嵌入请求的每条输入转换为一个Gemini EmbedContentRequest。"""
+        texts = [request.input] if isinstance(request.input, str) else request.input
+        requests = []
+        for text in texts:
+            item = {"model": f"models/{model}", "content": {"parts": [{"text": text}]}}
+            if request.dimensions:
+                item["outputDimensionality"] = request.dimensions
+            requests.append(item)
+        return requests
+
+    @staticmethod
+    def gemini_to_openai_embeddings(vectors: List[List[float]], model: str, encoding_format: Optional[str] = "float") -> Dict[str, Any]:
+        data = []
+        for i, values in enumerate(vectors):
+            if encoding_format == "base64":
+                # 与OpenAI一致：小端float32数组的base64编码
+                embedding = base64.b64encode(struct.pack(f"<{len(values)}f", *values)).decode("ascii")
+            else:
+                embedding = values
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
         return {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
+            "object": "list",
+            "data": data,
             "model": model,
-            "choices": choices
+            "usage": {
+                "prompt_tokens": 0,
+                "total_tokens": 0
+            }
         }
 
 converter = Converter()
@@ -0,0 +1,133 @@
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import logging
+
+import httpx
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.services.proxy_service import proxy_service
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BATCH_SIZE = registry.histogram(
+    "gapi_embedding_batch_size", "每次 batchEmbedContents 调用包含的文本数",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 250)
+)
+
+# 批次键：(使用密钥池, 客户端密钥, 租户（仅密钥池模式）, 模型)
+_BatchKey = Tuple[bool, Optional[str], Optional[str], str]
+
+
+class _Batch:
+    __slots__ = ("requests", "futures", "timer")
+
+    def __init__(self):
+        self.requests: List[Dict[str, Any]] = []
+        self.futures: List[asyncio.Future] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """
+    把并发的小型嵌入请求合并为 batchEmbedContents 调用。
+
+    同一密钥（密钥池模式下为同一租户）、同一模型的待处理文本累积到 max_batch_size 条，或第一条文本等待满
+    linger 秒后，作为一个批次发往上游；结果按顺序拆回各调用方。多条文本的批次收到4xx（429除外）时，
+    可能只是其中某个调用方的输入无效，把批次对半拆开重新发送，只有出错的文本的调用方收到错误；
+    其他失败（429、5xx、连接错误）对整个批次相同，所有调用方都收到同一错误。
+    """
+
+    def __init__(self, max_batch_size: int, linger: float):
+        self.max_batch_size = max(1, max_batch_size)
+        self.linger = linger
+        self._pending: Dict[_BatchKey, _Batch] = {}
+        self._inflight: set = set()
+
+    async def embed(self, requests: List[Dict[str, Any]], model: str,
+                    api_key: Optional[str], use_pool: bool, tenant: Optional[str] = None) -> List[List[float]]:
+        """返回每个 EmbedContentRequest 对应的向量，顺序与输入一致。tenant 为准入控制的租户标识。"""
+        key = (use_pool, None if use_pool else api_key, tenant if use_pool else None, model)
+        loop = asyncio.get_running_loop()
+        futures = []
+        for request in requests:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = _Batch()
+                self._pending[key] = batch
+                if self.linger > 0:
+                    batch.timer = loop.call_later(self.linger, self._flush, key, batch)
+            future = loop.create_future()
+            batch.requests.append(request)
+            batch.futures.append(future)
+            futures.append(future)
+            if len(batch.requests) >= self.max_batch_size or self.linger <= 0:
+                self._flush(key, batch)
+        return list(await asyncio.gather(*futures))
+
+    def _flush(self, key: _BatchKey, batch: _Batch):
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        if not batch.requests:
+            return
+        task = asyncio.create_task(self._send(key, batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, key: _BatchKey, batch: _Batch):
+        EMBEDDING_BATCH_SIZE.observe(len(batch.requests))
+        await self._send_items(key, batch.requests, batch.futures)
+
+    async def _send_items(self, key: _BatchKey, requests: List[Dict[str, Any]], futures: List[asyncio.Future]):
+        use_pool, api_key, _, model = key
+        headers = {} if use_pool else {"x-goog-api-key": api_key}
+        try:
+            req = proxy_service.client.build_request(
+                "POST", f"/v1beta/models/{model}:batchEmbedContents",
+                json={"requests": requests}, headers=headers
+            )
+            response = await proxy_service.send(req, use_pool=use_pool)
+            await response.aread()
+            response.raise_for_status()
+            embeddings = response.json()["embeddings"]
+            if len(embeddings) != len(futures):
+                raise ValueError(f"上游返回 {len(embeddings)} 个向量，期望 {len(futures)} 个")
+        except httpx.HTTPStatusError as exc:
+            status = exc.response.status_code
+            if len(requests) > 1 and 400 <= status < 500 and status != 429:
+                # 对半拆开重新发送，找出输入无效的文本
+                middle = len(requests) // 2
+                await asyncio.gather(
+                    self._send_items(key, requests[:middle], futures[:middle]),
+                    self._send_items(key, requests[middle:], futures[middle:])
+                )
+                return
+            self._fail(futures, HTTPException(status_code=status, detail=exc.response.text))
+            return
+        except HTTPException as exc:
+            self._fail(futures, exc)
+            return
+        except Exception as exc:
+            logger.warning(f"嵌入批次请求失败: {exc}")
+            self._fail(futures, HTTPException(status_code=500, detail=str(exc)))
+            return
+
+        for future, embedding in zip(futures, embeddings):
+            if not future.done():
+                future.set_result(embedding["values"])
+
+    @staticmethod
+    def _fail(futures: List[asyncio.Future], exc: Exception):
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+
+embedding_batcher = EmbeddingBatcher(
+    max_batch_size=settings.EMBEDDING_BATCH_MAX_SIZE,
+    linger=settings.EMBEDDING_BATCH_LINGER_MS / 1000
+)
@@ -0,0 +1,262 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import base64
+import binascii
+import hashlib
+import logging
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.core.tracing import span
+from app.services.proxy_service import proxy_service
+
+logger = logging.getLogger(__name__)
+
+FILE_OFFLOAD_EVENTS = registry.counter("gapi_file_offload_events_total", "大媒体上传到 Files API 的事件", ("event",))
+FILE_OFFLOAD_BYTES = registry.counter("gapi_file_offload_uploaded_bytes_total", "上传到 Files API 的媒体字节数")
+
+# 上传失败后在这段时间内不再重试同一媒体
+_FAILURE_BACKOFF = 60.0
+# 剩余有效期不足该值的文件视为已过期，避免请求到达上游时恰好失效
+_EXPIRY_SAFETY = 300.0
+# 上游未返回过期时间时按 Files API 的默认保留时长（48小时）估计
+_DEFAULT_TTL = 48 * 3600.0
+# 计算内容哈希时每次编码的字符数，避免为整段base64字符串创建一份字节副本
+_DIGEST_CHUNK = 1024 * 1024
+
+
+class _File:
+    __slots__ = ("name", "uri", "expires_at")
+
+    def __init__(self, name: str, uri: str, expires_at: float):
+        self.name = name
+        self.uri = uri
+        self.expires_at = expires_at
+
+
+def _digest(data: str) -> str:
+    digest = hashlib.sha256()
+    for offset in range(0, len(data), _DIGEST_CHUNK):
+        digest.update(data[offset:offset + _DIGEST_CHUNK].encode("ascii", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def _parse_expiry(value: Optional[str]) -> float:
+    """解析 RFC 3339 时间（例如 2024-05-01T12:00:00.123456789Z），失败时按默认保留时长估计。"""
+    if value:
+        try:
+            text = value.rstrip("Z")
+            if "." in text:
+                seconds, fraction = text.split(".", 1)
+                text = f"{seconds}.{fraction[:6]}"
+            expires = datetime.fromisoformat(text)
+            if expires.tzinfo is None:
+                expires = expires.replace(tzinfo=timezone.utc)
+            return expires.timestamp()
+        except ValueError:
+            pass
+    return time.time() + _DEFAULT_TTL
+
+
+class FileOffloader:
+    """
+    把较大的 inline_data 媒体上传到 Gemini Files API，请求中改为 file_data 引用。
+
+    按（API密钥, 内容哈希）记录已上传文件的 URI 和过期时间：多轮对话每轮重发的同一媒体只上传一次，
+    并发请求中的相同媒体共享一次上传。上传使用可恢复上传协议（start 后一次 upload, finalize）。
+    文件属于API密钥所在的项目，因此只用于客户端自带密钥的请求。上传失败时原样内联发送。
+    """
+
+    def __init__(self, enabled: bool, min_bytes: int, max_entries: int, processing_timeout: float):
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.max_entries = max_entries
+        self.processing_timeout = processing_timeout
+        self._files: "OrderedDict[str, _File]" = OrderedDict()
+        self._uploading: Dict[str, asyncio.Task] = {}
+        self._failures: Dict[str, float] = {}
+
+    async def apply(self, payload: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+        """
+        返回发往上游的负载：达到大小阈值的 inline_data 替换为 file_data。
+        contents 中的字典可能被历史前缀缓存共享，只复制被替换的部分，不原地修改。
+        """
+        if not self.enabled or not api_key:
+            return payload
+
+        # base64 长度约为原始字节数的 4/3
+        min_chars = self.min_bytes * 4 // 3
+        targets: List[Tuple[int, int, Dict[str, Any]]] = []
+        for content_index, content in enumerate(payload.get("contents") or ()):
+            for part_index, part in enumerate(content.get("parts") or ()):
+                inline = part.get("inline_data")
+                if inline and len(inline.get("data") or "") >= min_chars:
+                    targets.append((content_index, part_index, inline))
+        if not targets:
+            return payload
+
+        with span("file_offload"):
+            files = await asyncio.gather(*(self._reference(inline, api_key) for _, _, inline in targets))
+
+        contents = list(payload["contents"])
+        copied = set()
+        for (content_index, part_index, inline), uploaded in zip(targets, files):
+            if uploaded is None:
+                continue
+            if content_index not in copied:
+                copied.add(content_index)
+                original = contents[content_index]
+                contents[content_index] = {**original, "parts": list(original["parts"])}
+            contents[content_index]["parts"][part_index] = {
+                "file_data": {"mime_type": inline["mime_type"], "file_uri": uploaded.uri}
+            }
+        if not copied:
+            return payload
+        return {**payload, "contents": contents}
+
+    async def _reference(self, inline: Dict[str, Any], api_key: str) -> Optional[_File]:
+        key = hashlib.sha256(f"{api_key}\0{_digest(inline['data'])}".encode()).hexdigest()
+        now = time.time()
+        entry = self._files.get(key)
+        if entry is not None:
+            if entry.expires_at - now > _EXPIRY_SAFETY:
+                self._files.move_to_end(key)
+                FILE_OFFLOAD_EVENTS.labels("hit").inc()
+                return entry
+            del self._files[key]
+            FILE_OFFLOAD_EVENTS.labels("expired").inc()
+
+        failed_at = self._failures.get(key)
+        if failed_at is not None:
+            if now - failed_at < _FAILURE_BACKOFF:
+                return None
+            del self._failures[key]
+
+        task = self._uploading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._upload(key, inline["mime_type"], inline["data"], api_key))
+            self._uploading[key] = task
+        return await asyncio.shield(task)
+
+    async def _upload(self, key: str, mime_type: str, data: str, api_key: str) -> Optional[_File]:
+        size = 0
+        try:
+            raw = base64.b64decode(data)
+            size = len(raw)
+            start = await proxy_service.client.post(
+                "/upload/v1beta/files",
+                json={"file": {"display_name": key[:16]}},
+                headers={
+                    "x-goog-api-key": api_key,
+                    "X-Goog-Upload-Protocol": "resumable",
+                    "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Header-Content-Length": str(size),
+                    "X-Goog-Upload-Header-Content-Type": mime_type,
+                }
+            )
+            start.raise_for_status()
+            upload_url = start.headers["x-goog-upload-url"]
+            response = await proxy_service.client.post(
+                upload_url,
+                content=raw,
+                headers={
+                    "x-goog-api-key": api_key,
+                    "X-Goog-Upload-Offset": "0",
+                    "X-Goog-Upload-Command": "upload, finalize",
+                }
+            )
+            del raw
+            response.raise_for_status()
+            info = response.json()["file"]
+            if info.get("state") == "PROCESSING":
+                info = await self._wait_active(info["name"], api_key)
+            if info.get("state", "ACTIVE") != "ACTIVE":
+                raise ValueError(f"文件 {info.get('name')} 状态为 {info.get('state')}")
+            uploaded = _File(info["name"], info["uri"], _parse_expiry(info.get("expirationTime")))
+        except (httpx.HTTPError, KeyError, ValueError, binascii.Error, asyncio.TimeoutError) as exc:
+            logger.warning(f"上传媒体到 Files API 失败，改为内联发送: {exc!r}")
+            FILE_OFFLOAD_EVENTS.labels("upload_failed").inc()
+            self._record_failure(key)
+            return None
+        finally:
+            self._uploading.pop(key, None)
+
+        FILE_OFFLOAD_EVENTS.labels("uploaded").inc()
+        FILE_OFFLOAD_BYTES.inc(size)
+        self._failures.pop(key, None)
+        self._files[key] = uploaded
+        self._evict()
+        return uploaded
+
+    def _record_failure(self, key: str):
+        """记录上传失败的时间。只保留退避期内的记录，且不超过登记数上限（超出时丢弃最早的）。"""
+        now = time.time()
+        self._failures.pop(key, None)
+        self._failures[key] = now
+        if len(self._failures) > self.max_entries:
+            self._failures = {k: t for k, t in self._failures.items() if now - t < _FAILURE_BACKOFF}
+            while len(self._failures) > self.max_entries:
+                del self._failures[next(iter(self._failures))]
+
+    def resize(self, max_entries: int):
+        """调整登记数上限（热加载配置）。"""
+        self.max_entries = max_entries
+        self._evict()
+
+    def _evict(self):
+        # 被淘汰的文件不主动删除：可能仍被进行中的请求引用，上游会在过期后自行清理
+        while len(self._files) > self.max_entries:
+            self._files.popitem(last=False)
+            FILE_OFFLOAD_EVENTS.labels("evicted").inc()
+
+    async def _wait_active(self, name: str, api_key: str) -> Dict[str, Any]:
+        """视频等媒体上传后需要处理一段时间，轮询直到状态不再是 PROCESSING。"""
+        async def poll():
+            while True:
+                await asyncio.sleep(0.5)
+                response = await proxy_service.client.get(f"/v1beta/{name}", headers={"x-goog-api-key": api_key})
+                response.raise_for_status()
+                info = response.json()
+                if info.get("state") != "PROCESSING":
+                    return info
+
+        return await asyncio.wait_for(poll(), timeout=self.processing_timeout)
+
+    def invalidate(self, payload: Dict[str, Any], error: str):
+        """
+        上游因引用的文件不存在或不可用而拒绝请求时，移除该文件的登记，下次重新上传。
+        error 为上游的错误信息，只移除其中提到的文件（按 URI 或文件名），其余仍然有效的文件保留。
+        """
+        uris = {
+            part["file_data"].get("file_uri")
+            for content in payload.get("contents") or ()
+            for part in content.get("parts") or ()
+            if "file_data" in part
+        }
+        if not uris:
+            return
+        for key, entry in list(self._files.items()):
+            if entry.uri in uris and (entry.uri in error or entry.name.rpartition("/")[2] in error):
+                del self._files[key]
+                FILE_OFFLOAD_EVENTS.labels("invalidated").inc()
+
+    def stats(self) -> Dict[str, int]:
+        return {"files": len(self._files), "uploading": len(self._uploading)}
+
+
+file_offload = FileOffloader(
+    enabled=settings.FILE_OFFLOAD_ENABLED,
+    min_bytes=settings.FILE_OFFLOAD_MIN_BYTES,
+    max_entries=settings.FILE_OFFLOAD_MAX_ENTRIES,
+    processing_timeout=settings.FILE_OFFLOAD_PROCESSING_TIMEOUT
+)
+
+registry.callback(
+    "gapi_file_offload_files", "已上传且仍在有效期内登记的 Files API 文件数",
+    lambda: {(): file_offload.stats()["files"]}
+)
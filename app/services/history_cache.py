@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+HISTORY_CACHE_MESSAGES = registry.counter(
+    "gapi_history_cache_messages_total", "聊天历史转换中复用与重新转换的消息数", ("result",)
+)
+_REUSED = HISTORY_CACHE_MESSAGES.labels("reused")
+_CONVERTED = HISTORY_CACHE_MESSAGES.labels("converted")
+
+
+class HistorySnapshot:
+    """转换完前 len(messages) 条消息后的状态。contents 中的字典在多个请求间共享，不能原地修改。"""
+
+    __slots__ = ("messages", "contents", "system_instruction", "tool_call_names", "size")
+
+    def __init__(self, messages: List[Dict[str, Any]], contents: Tuple[Dict[str, Any], ...],
+                 system_instruction: Optional[Dict[str, Any]], tool_call_names: Dict[str, str], size: int):
+        self.messages = messages
+        self.contents = contents
+        self.system_instruction = system_instruction
+        self.tool_call_names = tool_call_names
+        self.size = size
+
+    @property
+    def count(self) -> int:
+        return len(self.messages)
+
+
+def _fingerprint(msg: Dict[str, Any]) -> int:
+    content = msg.get("content")
+    if not isinstance(content, str):
+        content = len(content) if content else 0
+    return hash((msg.get("role"), content, msg.get("tool_call_id"), len(msg.get("tool_calls") or ())))
+
+
+def _size(msg: Dict[str, Any]) -> int:
+    """按消息中字符串的长度粗略估算原始消息的占用。"""
+    content = msg.get("content")
+    if isinstance(content, str):
+        size = len(content)
+    else:
+        size = 0
+        for item in content or ():
+            size += len(item.get("text") or "") + len((item.get("image_url") or {}).get("url") or "")
+    for tool_call in msg.get("tool_calls") or ():
+        size += len(tool_call.get("function", {}).get("arguments") or "")
+    # 字典本身的固定开销
+    return size + 256
+
+
+class HistoryCache:
+    """
+    多轮对话历史的前缀转换缓存。
+
+    键为消息序列的滚动指纹（第 i 个键覆盖前 i 条消息），值为转换到该位置的 contents 等状态。
+    每轮对话会重发完整历史，查找最长的已缓存前缀后只需转换新增的尾部消息。
+    指纹只用于定位候选，命中后逐条比较原始消息，相等才复用，因此指纹冲突不会导致错误结果。
+    每个快照保留完整的原始消息用于比较，按其全部原始消息加上新转换部分的估算占用计费，
+    总量超过 max_bytes 时按LRU淘汰。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, HistorySnapshot]" = OrderedDict()
+        self._bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def prefix_keys(messages: List[Dict[str, Any]]) -> List[int]:
+        """返回每个前缀的键。"""
+        keys = []
+        key = 0
+        for msg in messages:
+            key = hash((key, _fingerprint(msg)))
+            keys.append(key)
+        return keys
+
+    @staticmethod
+    def estimate_size(messages: List[Dict[str, Any]], reused: int) -> int:
+        """
+        新快照的计费大小：快照保留的全部原始消息，加上新转换的消息的转换结果
+        （复用前缀的转换结果与父快照共享，只计引用本身的开销）。
+        """
+        sizes = [_size(msg) for msg in messages]
+        return sum(sizes) + sum(sizes[reused:]) + 16 * len(messages)
+
+    def lookup(self, messages: List[Dict[str, Any]], keys: List[int]) -> Optional[HistorySnapshot]:
+        """查找与 messages 开头完全一致的最长已缓存前缀。"""
+        for count in range(len(keys), 0, -1):
+            key = keys[count - 1]
+            snapshot = self._entries.get(key)
+            if snapshot is not None and snapshot.count == count and snapshot.messages == messages[:count]:
+                self._entries.move_to_end(key)
+                return snapshot
+        return None
+
+    def store(self, key: int, snapshot: HistorySnapshot):
+        if snapshot.size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[key] = snapshot
+        self._bytes += snapshot.size
+        self._evict()
+
+    def resize(self, max_bytes: int):
+        """调整字节上限（热加载配置），超出部分按LRU淘汰。"""
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    @staticmethod
+    def record(reused: int, converted: int):
+        if reused:
+            _REUSED.inc(reused)
+        if converted:
+            _CONVERTED.inc(converted)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+history_cache = HistoryCache(max_bytes=settings.HISTORY_CACHE_MAX_BYTES)
+
+registry.callback(
+    "gapi_history_cache_bytes", "聊天历史前缀缓存的估算占用字节数",
+    lambda: {(): history_cache.stats()["bytes"]}
+)
@@ -0,0 +1,150 @@
+from typing import Dict, Iterable, List, Optional
+import hmac
+import logging
+import time
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class _KeyState:
+    __slots__ = ("key", "inflight", "cooldown_until", "tokens", "refilled_at")
+
+    def __init__(self, key: str, capacity: float):
+        self.key = key
+        self.inflight = 0
+        self.cooldown_until = 0.0
+        self.tokens = capacity
+        self.refilled_at = time.monotonic()
+
+
+class KeyPool:
+    """
+    服务端上游API密钥池。
+
+    选择当前在途请求最少的可用密钥（同负载时轮询）；配置了 KEY_RPM_LIMIT 时，
+    每个密钥还受令牌桶限速。收到429/RESOURCE_EXHAUSTED的密钥进入冷却期，
+    期间不会被选中。
+    """
+
+    def __init__(self, keys: Iterable[str], cooldown: float, rpm_limit: int = 0, access_token: Optional[str] = None):
+        self.cooldown = cooldown
+        self.rpm_limit = rpm_limit
+        self.access_token = access_token
+        self._states: List[_KeyState] = [_KeyState(key, rpm_limit) for key in dict.fromkeys(keys) if key]
+        self._by_key: Dict[str, _KeyState] = {state.key: state for state in self._states}
+        self._cursor = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._states)
+
+    def accepts(self, client_key: Optional[str]) -> bool:
+        """请求是否应使用密钥池：未配置访问令牌时所有请求都使用，否则需令牌匹配。"""
+        if not self.enabled:
+            return False
+        if self.access_token is None:
+            return True
+        return client_key is not None and hmac.compare_digest(client_key, self.access_token)
+
+    def acquire(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        """选择一个可用密钥并计入在途请求；没有可用密钥时返回None。"""
+        now = time.monotonic()
+        excluded = set(exclude)
+        best = None
+        count = len(self._states)
+        for offset in range(count):
+            state = self._states[(self._cursor + offset) % count]
+            if state.key in excluded or state.cooldown_until > now:
+                continue
+            if self.rpm_limit > 0:
+                self._refill(state, now)
+                if state.tokens < 1:
+                    continue
+            if best is None or state.inflight < best.inflight:
+                best = state
+
+        if best is None:
+            return None
+
+        self._cursor = (self._states.index(best) + 1) % count
+        best.inflight += 1
+        if self.rpm_limit > 0:
+            best.tokens -= 1
+        return best.key
+
+    def reload(self, keys: Iterable[str], cooldown: float, rpm_limit: int = 0, access_token: Optional[str] = None):
+        """
+        替换密钥列表和参数（热加载配置）。保留下来的密钥沿用在途数和冷却状态；
+        被移除的密钥上仍在进行的请求照常完成，释放时忽略。
+        """
+        self.cooldown = cooldown
+        self.access_token = access_token
+        if rpm_limit != self.rpm_limit:
+            for state in self._states:
+                state.tokens = min(state.tokens, float(rpm_limit))
+            self.rpm_limit = rpm_limit
+        self._states = [self._by_key.get(key) or _KeyState(key, rpm_limit) for key in dict.fromkeys(keys) if key]
+        self._by_key = {state.key: state for state in self._states}
+        self._cursor = 0
+
+    def release(self, key: str):
+        state = self._by_key.get(key)
+        if state is not None and state.inflight > 0:
+            state.inflight -= 1
+
+    def quarantine(self, key: str, retry_after: Optional[float] = None):
+        state = self._by_key.get(key)
+        if state is None:
+            return
+        cooldown = retry_after if retry_after and retry_after > 0 else self.cooldown
+        state.cooldown_until = time.monotonic() + cooldown
+        logger.warning(f"上游密钥 ...{key[-4:]} 配额耗尽，冷却 {cooldown:.0f} 秒")
+
+    def retry_after(self) -> float:
+        """距离最早一个密钥恢复可用的秒数。"""
+        now = time.monotonic()
+        waits = [max(0.0, state.cooldown_until - now) for state in self._states]
+        if self.rpm_limit > 0:
+            rate = self.rpm_limit / 60.0
+            waits = [
+                max(wait, (1 - state.tokens) / rate if state.tokens < 1 else 0.0)
+                for wait, state in zip(waits, self._states)
+            ]
+        return min(waits) if waits else 0.0
+
+    def _refill(self, state: _KeyState, now: float):
+        elapsed = now - state.refilled_at
+        state.refilled_at = now
+        state.tokens = min(float(self.rpm_limit), state.tokens + elapsed * self.rpm_limit / 60.0)
+
+    def stats(self) -> List[Dict[str, float]]:
+        now = time.monotonic()
+        return [
+            {
+                "key": f"...{state.key[-4:]}",
+                "inflight": state.inflight,
+                "cooldown": max(0.0, state.cooldown_until - now),
+            }
+            for state in self._states
+        ]
+
+
+key_pool = KeyPool(
+    keys=[key.strip() for key in settings.GEMINI_API_KEYS.split(",")],
+    cooldown=settings.KEY_COOLDOWN_SECONDS,
+    rpm_limit=settings.KEY_RPM_LIMIT,
+    access_token=settings.KEY_POOL_ACCESS_TOKEN
+)
+
+
+registry.callback(
+    "gapi_key_pool_inflight", "各上游密钥的在途请求数",
+    lambda: {(stat["key"],): stat["inflight"] for stat in key_pool.stats()}, ("key",)
+)
+registry.callback(
+    "gapi_key_pool_cooldown_seconds", "各上游密钥剩余冷却时间",
+    lambda: {(stat["key"],): stat["cooldown"] for stat in key_pool.stats()}, ("key",)
+)
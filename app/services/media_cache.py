@@ -0,0 +1,294 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# (mime_type, base64数据)
+MediaEntry = Tuple[str, str]
+
+# 磁盘层中URL别名文件的后缀，文件内容为 "内容哈希\n过期时间（Unix时间戳）"
+_ALIAS_SUFFIX = ".url"
+
+
+def content_key(data: str) -> str:
+    """内容哈希键，相同的数据无论来源都只保存一份。"""
+    return hashlib.sha256(data.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class MediaCache:
+    """
+    多模态输入的内容寻址缓存。
+
+    条目按内容哈希保存已下载的远程图像，URL 通过别名映射到内容哈希，别名超过 url_ttl 秒后失效、重新下载
+    （远程图像可能已经更新）。data URI 不经过缓存：直接拆分比计算内容哈希快得多。
+    内存层按总字节数做LRU淘汰；配置了 MEDIA_CACHE_DIR 时被淘汰的条目写入磁盘层，
+    磁盘层同样按总字节数做LRU淘汰。启用磁盘层时URL别名也写入同一目录，重启后仍能从URL命中磁盘层；
+    过期的别名文件在读取时或启动扫描目录时删除。
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0,
+                 url_ttl: float = 3600.0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.url_ttl = url_ttl
+
+        self._entries: "OrderedDict[str, MediaEntry]" = OrderedDict()
+        # URL -> (内容哈希, 过期时间)
+        self._urls: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+
+        self._disk_index: Optional["OrderedDict[str, int]"] = None
+        self._disk_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def disk_enabled(self) -> bool:
+        return bool(self.disk_dir) and self.disk_max_bytes > 0
+
+    async def get_url(self, url: str) -> Optional[MediaEntry]:
+        alias = self._urls.get(url)
+        if alias is not None and time.monotonic() >= alias[1]:
+            del self._urls[url]
+            alias = None
+        if alias is None and self.disk_enabled:
+            alias = await self._disk_get_alias(url)
+            if alias is not None:
+                self._urls[url] = alias
+        # 每次查找只计一次未命中
+        entry = await self._lookup(alias[0]) if alias is not None else None
+        if entry is None:
+            self._urls.pop(url, None)
+            self.misses += 1
+            return None
+        self._urls.move_to_end(url)
+        return entry
+
+    async def put_url(self, url: str, mime_type: str, data: str) -> str:
+        key = await self.put(mime_type, data)
+        self._urls[url] = (key, time.monotonic() + self.url_ttl)
+        self._urls.move_to_end(url)
+        # 别名本身很小，按条目数的倍数限制即可
+        while len(self._urls) > max(1024, len(self._entries) * 4):
+            self._urls.popitem(last=False)
+        if self.disk_enabled:
+            self._ensure_disk_index()
+            try:
+                await asyncio.to_thread(_write_file, self._alias_path(url), f"{key}\n{time.time() + self.url_ttl}")
+            except OSError as exc:
+                logger.warning(f"写入媒体缓存URL别名失败: {exc}")
+        return key
+
+    async def get(self, key: str) -> Optional[MediaEntry]:
+        entry = await self._lookup(key)
+        if entry is None:
+            self.misses += 1
+        return entry
+
+    async def _lookup(self, key: str) -> Optional[MediaEntry]:
+        """依次查内存层和磁盘层，只统计命中，未命中由调用方统计。"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        if self.disk_enabled:
+            entry = await self._disk_get(key)
+            if entry is not None:
+                self.disk_hits += 1
+                for spilled_key, spilled_entry in self._insert(key, entry):
+                    await self._disk_put(spilled_key, spilled_entry)
+                return entry
+        return None
+
+    async def put(self, mime_type: str, data: str) -> str:
+        key = content_key(data)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return key
+        spilled = self._insert(key, (mime_type, data))
+        for spilled_key, spilled_entry in spilled:
+            await self._disk_put(spilled_key, spilled_entry)
+        return key
+
+    def _insert(self, key: str, entry: MediaEntry):
+        """写入内存层，返回被淘汰、需要写入磁盘层的条目。"""
+        size = _entry_size(entry)
+        if size > self.max_bytes:
+            return [(key, entry)] if self.disk_enabled else []
+
+        self._entries[key] = entry
+        self._bytes += size
+        return self._evict()
+
+    async def resize(self, max_bytes: int):
+        """调整内存层字节上限（热加载配置），被淘汰的条目与正常淘汰一样写入磁盘层。"""
+        self.max_bytes = max_bytes
+        for spilled_key, spilled_entry in self._evict():
+            await self._disk_put(spilled_key, spilled_entry)
+
+    def _evict(self):
+        spilled = []
+        while self._bytes > self.max_bytes and self._entries:
+            old_key, old_entry = self._entries.popitem(last=False)
+            self._bytes -= _entry_size(old_entry)
+            self.evictions += 1
+            if self.disk_enabled:
+                spilled.append((old_key, old_entry))
+        return spilled
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key)
+
+    def _alias_path(self, url: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(url.encode("utf-8", "surrogatepass")).hexdigest() + _ALIAS_SUFFIX)
+
+    async def _disk_get_alias(self, url: str) -> Optional[Tuple[str, float]]:
+        """读取磁盘上的URL别名，返回与内存别名相同的 (内容哈希, 单调时钟过期时间)。"""
+        path = self._alias_path(url)
+        try:
+            raw = await asyncio.to_thread(_read_file, path)
+            key, _, expires_at = raw.partition("\n")
+            remaining = float(expires_at) - time.time()
+        except (OSError, ValueError):
+            return None
+        if remaining <= 0:
+            try:
+                await asyncio.to_thread(os.remove, path)
+            except OSError:
+                pass
+            return None
+        return key, time.monotonic() + remaining
+
+    def _ensure_disk_index(self):
+        if self._disk_index is not None:
+            return
+        self._disk_index = OrderedDict()
+        os.makedirs(self.disk_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(_ALIAS_SUFFIX):
+                # 别名文件不计入磁盘层容量，过期的直接删除
+                if time.time() - stat.st_mtime >= self.url_ttl:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._disk_index[name] = size
+            self._disk_bytes += size
+
+    async def _disk_get(self, key: str) -> Optional[MediaEntry]:
+        self._ensure_disk_index()
+        if key not in self._disk_index:
+            return None
+        try:
+            raw = await asyncio.to_thread(_read_file, self._disk_path(key))
+        except OSError:
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+            return None
+        if key in self._disk_index:
+            self._disk_index.move_to_end(key)
+        mime_type, _, data = raw.partition("\n")
+        return mime_type, data
+
+    async def _disk_put(self, key: str, entry: MediaEntry):
+        self._ensure_disk_index()
+        if key in self._disk_index:
+            self._disk_index.move_to_end(key)
+            return
+        raw = f"{entry[0]}\n{entry[1]}"
+        try:
+            await asyncio.to_thread(_write_file, self._disk_path(key), raw)
+        except OSError as exc:
+            logger.warning(f"写入媒体磁盘缓存失败: {exc}")
+            return
+        self._disk_index[key] = len(raw)
+        self._disk_bytes += len(raw)
+
+        while self._disk_bytes > self.disk_max_bytes and self._disk_index:
+            old_key, old_size = self._disk_index.popitem(last=False)
+            self._disk_bytes -= old_size
+            self.disk_evictions += 1
+            try:
+                await asyncio.to_thread(os.remove, self._disk_path(old_key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "disk_bytes": self._disk_bytes,
+        }
+
+
+def _entry_size(entry: MediaEntry) -> int:
+    return len(entry[0]) + len(entry[1])
+
+
+def _read_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        raw = f.read()
+    # 更新修改时间，重启后按其恢复LRU顺序
+    os.utime(path)
+    return raw
+
+
+def _write_file(path: str, raw: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(raw)
+    os.replace(tmp_path, path)
+
+
+media_cache = MediaCache(
+    max_bytes=settings.MEDIA_CACHE_MAX_BYTES,
+    disk_dir=settings.MEDIA_CACHE_DIR,
+    disk_max_bytes=settings.MEDIA_CACHE_DISK_MAX_BYTES,
+    url_ttl=settings.MEDIA_CACHE_URL_TTL
+)
+
+
+registry.callback(
+    "gapi_media_cache_events_total", "多模态输入缓存事件数",
+    lambda: {(event,): media_cache.stats()[event] for event in ("hits", "disk_hits", "misses", "evictions", "disk_evictions")},
+    ("event",), metric_type="counter"
+)
+registry.callback(
+    "gapi_media_cache_bytes", "多模态输入缓存占用字节数",
+    lambda: {("memory",): media_cache.stats()["bytes"], ("disk",): media_cache.stats()["disk_bytes"]},
+    ("tier",)
+)
@@ -0,0 +1,82 @@
+from typing import Optional, Tuple
+import asyncio
+import base64
+import logging
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MediaFetcher:
+    """
+    远程图像下载服务。
+
+    使用共享连接池复用TCP/TLS连接，对单张图像限制大小和耗时，
+    并在下载过程中分块进行base64编码，避免整块缓存原始字节。
+    """
+
+    def __init__(self):
+        limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        timeout = httpx.Timeout(settings.IMAGE_FETCH_TIMEOUT, connect=5.0)
+
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=limits,
+            follow_redirects=True
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def fetch(self, url: str) -> Optional[Tuple[str, str]]:
+        """
+        下载图像并返回 (mime_type, base64数据)。
+        超时、超出大小限制或状态码非200时返回None。
+        """
+        try:
+            return await asyncio.wait_for(self._fetch(url), timeout=settings.IMAGE_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"下载图像超时: {url!r}")
+        except httpx.HTTPError as exc:
+            logger.warning(f"下载图像失败: {url!r}: {exc}")
+        return None
+
+    async def _fetch(self, url: str) -> Optional[Tuple[str, str]]:
+        max_bytes = settings.IMAGE_MAX_BYTES
+        async with self.client.stream("GET", url) as resp:
+            if resp.status_code != 200:
+                logger.warning(f"下载图像失败: {url!r} 返回状态码 {resp.status_code}")
+                return None
+
+            content_length = resp.headers.get("content-length")
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                logger.warning(f"图像过大: {url!r} ({content_length} 字节)")
+                return None
+
+            content_type = resp.headers.get("content-type")
+            mime_type = content_type.split(";")[0].strip() if content_type else "image/jpeg"
+
+            encoded = []
+            pending = b""
+            received = 0
+            async for chunk in resp.aiter_bytes():
+                received += len(chunk)
+                if received > max_bytes:
+                    logger.warning(f"图像过大: {url!r} 超过 {max_bytes} 字节")
+                    return None
+                # 只编码3字节对齐的部分，余下的字节留到下一块
+                pending += chunk
+                usable = len(pending) - len(pending) % 3
+                if usable:
+                    encoded.append(base64.b64encode(pending[:usable]))
+                    pending = pending[usable:]
+            if pending:
+                encoded.append(base64.b64encode(pending))
+
+        return mime_type, b"".join(encoded).decode("ascii")
+
+
+media_fetcher = MediaFetcher()
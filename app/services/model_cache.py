@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+import hashlib
+import logging
+import time
+
+from app.core.config import settings
+from app.core.metrics import model_labels
+
+logger = logging.getLogger(__name__)
+
+
+class ModelList:
+    """一次上游模型列表查询的结果，同时保存预先转换好的OpenAI格式。"""
+
+    def __init__(self, gemini_data: Dict[str, Any]):
+        self.fetched_at = time.monotonic()
+        self.gemini_data = gemini_data
+
+        created = int(time.time())
+        openai_models = []
+        for model in gemini_data.get("models", []):
+            # model["name"]的格式类似"models/gemini-pro"
+            model_id = model["name"].replace("models/", "")
+            openai_models.append({
+                "id": model_id,
+                "object": "model",
+                "created": created,
+                "owned_by": "google"
+            })
+        self.openai_data = {
+            "object": "list",
+            "data": openai_models
+        }
+        # 上游列出的模型可以作为指标的模型标签
+        model_labels.add(model["id"] for model in openai_models)
+
+
+class ModelListCache:
+    """
+    按API密钥（哈希后）缓存模型列表。
+
+    - 在 ttl 内直接返回缓存；
+    - 过期但仍在 stale_ttl 内时返回旧数据，并在后台刷新；
+    - 同一密钥的并发未命中只触发一次上游请求。
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, ModelList]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    async def get(self, api_key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> ModelList:
+        """返回模型列表；fetch 用于在未命中时请求上游，其异常原样抛出。"""
+        if not self.enabled:
+            return ModelList(await fetch())
+
+        key = hashlib.sha256(api_key.encode()).hexdigest()
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                return entry
+            if age < self.ttl + self.stale_ttl:
+                # 先返回旧数据，后台刷新
+                self._entries.move_to_end(key)
+                self._refresh(key, fetch)
+                return entry
+
+        # shield: 单个等待者被取消时不影响其他等待者共享的请求
+        return await asyncio.shield(self._refresh(key, fetch))
+
+    def _refresh(self, key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, fetch))
+            task.add_done_callback(_log_refresh_error)
+            self._inflight[key] = task
+        return task
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> ModelList:
+        try:
+            entry = ModelList(await fetch())
+        finally:
+            self._inflight.pop(key, None)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, api_key: Optional[str] = None):
+        if api_key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(hashlib.sha256(api_key.encode()).hexdigest(), None)
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"刷新模型列表失败: {task.exception()!r}")
+
+
+model_cache = ModelListCache(
+    ttl=settings.MODEL_CACHE_TTL,
+    stale_ttl=settings.MODEL_CACHE_STALE_TTL
+)
@@ -1,25 +1,401 @@
 import httpx
 from fastapi import Request, HTTPException
 from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
 import logging
+import time
+
+from app.core.config import settings
+from app.core.tracing import Trace, current_trace
+from app.core.metrics import (
+    registry, STREAM_FRAMES, STREAM_WRITES, STREAMS_ABORTED, UPSTREAM_CONNECT, UPSTREAM_LEAKED_RESPONSES,
+    UPSTREAM_OPEN_RESPONSES, UPSTREAM_TTFB
+)
+from app.services.compression import accepts_encoding
+from app.services.key_pool import key_pool
+from app.services.upstream_pool import UpstreamPools
 
 logger = logging.getLogger(__name__)
 
+# 不转发给客户端的上游响应头（Content-Encoding 视是否原样转发压缩字节而定）
+_EXCLUDED_RESPONSE_HEADERS = {"content-length", "transfer-encoding", "connection"}
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """
+    包装上游响应体流：计入打开的上游响应数，关闭时执行一次已注册的回调（例如归还密钥）。
+    读取出错时立即关闭；未关闭就被垃圾回收时计为泄漏。
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream):
+        self._stream = stream
+        self._callbacks: List[Callable[[], None]] = []
+        self._closed = False
+        UPSTREAM_OPEN_RESPONSES.inc()
+
+    def on_close(self, callback: Callable[[], None]):
+        self._callbacks.append(callback)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._stream.aclose()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        UPSTREAM_OPEN_RESPONSES.dec()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def __del__(self):
+        if not self._closed:
+            # 此时已无法异步关闭连接，只能记录并归还其他资源
+            self._closed = True
+            UPSTREAM_LEAKED_RESPONSES.inc()
+            logger.warning("上游响应未关闭就被回收，对应的上游连接已泄漏")
+            self._finish()
+
+
+class _WriteCoalescer:
+    """
+    合并写出的缓冲区：读取任务把分块追加到缓冲区，写出任务在时间窗口到期、累计到 flush_bytes
+    或流结束时取走整批数据。每批只设一个定时器，不为每个分块创建任务或超时。
+    缓冲区满 flush_bytes 后读取任务等待写出任务取走数据（客户端读得慢时形成背压）；
+    写出结束（包括客户端断开）后 close() 解除该等待，读取任务随即停止。
+    """
+
+    def __init__(self, delay: float, max_bytes: int):
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self.error: Optional[Exception] = None
+        self._loop = asyncio.get_running_loop()
+        self._parts: List[bytes] = []
+        self._size = 0
+        self._first = True
+        self._flush = False
+        self._ended = False
+        self._closed = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._ready: Optional[asyncio.Future] = None
+        self._drained: Optional[asyncio.Future] = None
+
+    async def pump(self, iterator: AsyncIterator, charset: str):
+        try:
+            async for chunk in iterator:
+                if self._closed:
+                    break
+                if not isinstance(chunk, (bytes, memoryview)):
+                    chunk = chunk.encode(charset)
+                self._parts.append(chunk)
+                self._size += len(chunk)
+                if self._first or self._size >= self.max_bytes:
+                    # 第一个分块立即写出，不影响首字延迟
+                    self._first = False
+                    self._wake()
+                    if self._size >= self.max_bytes:
+                        self._drained = self._loop.create_future()
+                        await self._drained
+                        if self._closed:
+                            break
+                elif self._timer is None:
+                    self._timer = self._loop.call_later(self.delay, self._wake)
+        except Exception as exc:
+            self.error = exc
+        self._ended = True
+        self._wake()
+
+    async def take(self) -> Tuple[List[bytes], bool]:
+        """等待下一批数据，返回 (分块列表, 流是否已结束)。"""
+        if not self._flush:
+            self._ready = self._loop.create_future()
+            await self._ready
+        parts, self._parts, self._size, self._flush = self._parts, [], 0, False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_result(None)
+        return parts, self._ended
+
+    def close(self):
+        """写出结束：停止定时器，并让等待背压的读取任务退出（不依赖取消读取任务）。"""
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_result(None)
+
+    def _wake(self):
+        self._flush = True
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_result(None)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    结束时（正常完成、出错或客户端中途断开）一定会关闭内容迭代器并调用 on_close 的流式响应。
+
+    Starlette 在客户端断开时只取消输出任务，不会关闭内容迭代器，
+    其中持有的上游响应要等到超时或垃圾回收才释放连接。
+
+    flush_ms 大于0时合并写出：第一个分块立即写出（不影响首字延迟），之后的分块最多等待 flush_ms 毫秒
+    或累计到 flush_bytes 字节再一起写出，减少高频小分块流的 send 调用和 TCP 报文数。
+    """
+
+    def __init__(self, content: AsyncIterator, *args, on_close: Optional[Callable[[], Awaitable[None]]] = None,
+                 flush_ms: float = 0.0, flush_bytes: int = 16384, **kwargs):
+        super().__init__(content, *args, **kwargs)
+        self._on_close = on_close
+        self._completed = False
+        self._flush_delay = flush_ms / 1000
+        self._flush_bytes = flush_bytes
+        self._pump: Optional[asyncio.Future] = None
+
+    async def stream_response(self, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self._flush_delay > 0:
+            frames, writes = await self._stream_coalesced(send)
+        else:
+            frames = 0
+            async for chunk in self.body_iterator:
+                if not isinstance(chunk, (bytes, memoryview)):
+                    chunk = chunk.encode(self.charset)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                frames += 1
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            writes = frames + 1
+        STREAM_FRAMES.inc(frames)
+        STREAM_WRITES.inc(writes)
+        self._completed = True
+
+    async def _stream_coalesced(self, send) -> Tuple[int, int]:
+        coalescer = _WriteCoalescer(self._flush_delay, self._flush_bytes)
+        self._pump = pump = asyncio.ensure_future(coalescer.pump(self.body_iterator, self.charset))
+        frames = writes = 0
+        try:
+            while True:
+                parts, ended = await coalescer.take()
+                if ended:
+                    break
+                frames += len(parts)
+                writes += 1
+                await send({"type": "http.response.body", "body": b"".join(parts), "more_body": True})
+        finally:
+            # 客户端断开时这里处于 Starlette 的取消范围内，无法等待读取任务结束，在 __call__ 中等待。
+            # 取消可能被内容迭代器内部吞掉，由 close() 设置的标志保证读取任务不会停在背压等待上
+            coalescer.close()
+            if not pump.done():
+                pump.cancel()
+        if coalescer.error is not None:
+            if parts:
+                await send({"type": "http.response.body", "body": b"".join(parts), "more_body": True})
+            raise coalescer.error
+        # 最后一批数据与结束标志一起写出，且必须是最后一个 await：
+        # 响应结束后 Starlette 会立即取消输出任务，之后的 await 都会被打断
+        frames += len(parts)
+        writes += 1
+        await send({"type": "http.response.body", "body": b"".join(parts), "more_body": False})
+        return frames, writes
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if not self._completed:
+                STREAMS_ABORTED.inc()
+            if self._pump is not None:
+                # 读取任务结束后才能关闭内容迭代器
+                await asyncio.gather(self._pump, return_exceptions=True)
+            try:
+                aclose = getattr(self.body_iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                if self._on_close is not None:
+                    await self._on_close()
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def _connect_tracer(request_trace: Optional[Trace]):
+    """创建httpx trace回调：请求新建上游连接时记录TCP+TLS耗时（指标，及当前请求的追踪）。"""
+    started = None
+
+    async def trace(event_name: str, info: dict):
+        nonlocal started
+        if event_name == "connection.connect_tcp.started":
+            started = time.perf_counter()
+        elif started is not None and event_name.endswith(".send_request_headers.started"):
+            elapsed = time.perf_counter() - started
+            if settings.METRICS_ENABLED:
+                UPSTREAM_CONNECT.observe(elapsed)
+            if request_trace is not None:
+                request_trace.add("upstream_connect", started, elapsed)
+            started = None
+
+    return trace
+
+
 class ProxyService:
     def __init__(self):
-        # 高并发设置
-        limits = httpx.Limits(max_keepalive_connections=100, max_connections=1000)
-        timeout = httpx.Timeout(60.0, connect=10.0)
-        
-        self.client = httpx.AsyncClient(
-            base_url="https://generativelanguage.googleapis.com",
-            timeout=timeout,
-            limits=limits,
-            follow_redirects=True
-        )
+        # 连接池参数见 UPSTREAM_* 设置
+        self.pools = UpstreamPools()
+        # 用于构建请求及不区分流式的辅助调用；发送时按是否流式选择连接池
+        self.client = self.pools.unary
+        # 被替换、等待在途请求结束后关闭的连接池
+        self._retiring: Dict[asyncio.Future, UpstreamPools] = {}
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        return self.pools.stats()
+
+    async def warmup(self):
+        await self.pools.warmup(settings.UPSTREAM_WARMUP_CONNECTIONS)
+
+    async def reload_pools(self):
+        """
+        按当前设置重建连接池（热加载配置）：之后的请求使用新连接池，
+        旧连接池上进行中的请求和流照常完成后再关闭。
+        """
+        old = self.pools
+        pools = UpstreamPools()
+        await pools.warmup(settings.UPSTREAM_WARMUP_CONNECTIONS)
+        self.pools = pools
+        self.client = pools.unary
+        self.retire(old)
+
+    def retire(self, pools: UpstreamPools):
+        """在后台等连接池空闲后关闭。"""
+        task = asyncio.ensure_future(pools.close_when_idle())
+        self._retiring[task] = pools
+        task.add_done_callback(lambda done: self._retiring.pop(done, None))
 
     async def close(self):
-        await self.client.aclose()
+        # 关闭时不再等待被替换的连接池空闲（此前已经过优雅排空）
+        for task, pools in list(self._retiring.items()):
+            task.cancel()
+            await pools.close()
+        await self.pools.close()
+
+    @staticmethod
+    def passthrough_response(response: httpx.Response, accept_encoding: Optional[str],
+                             flush_ms: float = 0.0) -> ClosingStreamingResponse:
+        """
+        把上游响应流式返回给客户端。上游响应已压缩且客户端接受该编码时原样转发压缩字节，
+        省去解压的CPU和数倍的出口流量；否则由httpx解压，去掉 Content-Encoding 后返回。
+        flush_ms 为合并写出的窗口（见 ClosingStreamingResponse）。
+        """
+        content_encoding = response.headers.get("content-encoding")
+        raw = (
+            settings.PASSTHROUGH_COMPRESSED
+            and content_encoding is not None
+            and accepts_encoding(accept_encoding, content_encoding)
+        )
+        headers = {
+            k: v for k, v in response.headers.items()
+            if k.lower() not in _EXCLUDED_RESPONSE_HEADERS and (raw or k.lower() != "content-encoding")
+        }
+        return ClosingStreamingResponse(
+            response.aiter_raw() if raw else response.aiter_bytes(),
+            status_code=response.status_code,
+            headers=headers,
+            on_close=response.aclose,
+            flush_ms=flush_ms,
+            flush_bytes=settings.SSE_COALESCE_MAX_BYTES
+        )
+
+    async def request_body(self, request: Request, headers: Dict[str, str], buffered: bool = False) -> Union[bytes, AsyncIterator[bytes]]:
+        """
+        返回转发给上游的请求体。
+
+        需要重试（buffered）或关闭了 PASSTHROUGH_STREAM_BODY 时读取完整请求体；
+        否则直接把客户端请求体流式转发给上游，内存占用与请求体大小无关，
+        并保留客户端的 content-length，避免改用分块传输编码。
+        """
+        if buffered or not settings.PASSTHROUGH_STREAM_BODY:
+            return await request.body()
+
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) == 0:
+                return b""
+            headers["content-length"] = content_length
+            return request.stream()
+        if "chunked" in request.headers.get("transfer-encoding", "").lower():
+            return request.stream()
+        return b""
+
+    async def send(self, req: httpx.Request, use_pool: bool = False, streaming: bool = False,
+                   pools: Optional[UpstreamPools] = None) -> httpx.Response:
+        """
+        以流式方式发送上游请求；streaming 表示长时间输出的流式响应，配置了独立连接池时走流式连接池。
+        pools 为目标端点的连接池（多上游路由时），默认使用 UPSTREAM_BASE_URL 的连接池。
+
+        use_pool 为真时从密钥池选择 x-goog-api-key；遇到429时冷却该密钥并换一个密钥重试，
+        重试发生在向客户端输出任何字节之前。所有密钥都不可用时返回429。
+        """
+        request_trace = current_trace()
+        if settings.METRICS_ENABLED or request_trace is not None:
+            req.extensions["trace"] = _connect_tracer(request_trace)
+
+        client = (pools or self.pools).client_for(streaming)
+        if not use_pool:
+            return await self._send(client, req)
+
+        tried = set()
+        key = key_pool.acquire()
+        attempts = 0
+        while key is not None:
+            attempts += 1
+            tried.add(key)
+            req.headers["x-goog-api-key"] = key
+            try:
+                response = await self._send(client, req)
+            except BaseException:
+                key_pool.release(key)
+                raise
+
+            next_key = None
+            if response.status_code == 429:
+                key_pool.quarantine(key, _retry_after(response))
+                if attempts < settings.KEY_POOL_MAX_ATTEMPTS:
+                    next_key = key_pool.acquire(exclude=tried)
+
+            if next_key is None:
+                # 在响应关闭（读完或被丢弃）时归还密钥
+                response.stream.on_close(lambda key=key: key_pool.release(key))
+                return response
+
+            logger.info(f"上游密钥 ...{key[-4:]} 返回429，换用密钥 ...{next_key[-4:]} 重试")
+            await response.aclose()
+            key_pool.release(key)
+            key = next_key
+
+        retry_after = max(1, int(key_pool.retry_after() + 0.999))
+        raise HTTPException(
+            status_code=429,
+            detail="All upstream API keys are rate limited",
+            headers={"Retry-After": str(retry_after)}
+        )
 
     async def proxy_request(self, method: str, path: str, request: Request, target_url: str = None):
         """
@@ -32,12 +408,15 @@ class ProxyService:
         headers = dict(request.headers)
         headers.pop("host", None)
         headers.pop("content-length", None)
+        # 不原样转发压缩字节时，由httpx按自身支持的编码协商，保证能够解压
+        if not settings.PASSTHROUGH_COMPRESSED:
+            headers.pop("accept-encoding", None)
         
         # 提取查询参数
         params = dict(request.query_params)
         
-        # 读取请求体
-        body = await request.body()
+        # 请求体（默认流式转发）
+        body = await self.request_body(request, headers)
 
         try:
             req = self.client.build_request(
@@ -48,17 +427,38 @@ class ProxyService:
                 content=body
             )
             
-            response = await self.client.send(req, stream=True)
+            response = await self._send(self.client, req)
             
-            return StreamingResponse(
-                response.aiter_bytes(),
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                background=None # 如果需要，可能需要后台任务来关闭响应，但aiter_bytes基本已处理
-            )
+            return self.passthrough_response(response, request.headers.get("accept-encoding"))
 
         except httpx.RequestError as exc:
             logger.error(f"请求 {exc.request.url!r} 时发生错误。")
             raise HTTPException(status_code=502, detail=f"Proxy error: {exc}")
 
+    @staticmethod
+    async def _send(client: httpx.AsyncClient, req: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        response = await client.send(req, stream=True)
+        ttfb = time.perf_counter() - started
+        response.stream = _TrackedStream(response.stream)
+        UPSTREAM_TTFB.labels(str(response.status_code)).observe(ttfb)
+        request_trace = current_trace()
+        if request_trace is not None:
+            # upstream 覆盖从发送请求到上游响应关闭（流式响应读完）的整个区间
+            request_trace.add("upstream_ttfb", started, ttfb)
+            response.stream.on_close(lambda: request_trace.add("upstream", started, time.perf_counter() - started))
+        return response
+
+
 proxy_service = ProxyService()
+
+
+def _pool_samples() -> Dict[Tuple[str, ...], float]:
+    return {
+        (pool, state): value
+        for pool, stats in proxy_service.pool_stats().items()
+        for state, value in stats.items()
+    }
+
+
+registry.callback("gapi_upstream_pool_connections", "上游连接池连接数（in_use/idle/max）", _pool_samples, ("pool", "state"))
@@ -0,0 +1,217 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_REQUESTS = registry.counter("gapi_response_cache_requests_total", "响应缓存查询结果", ("result",))
+_HIT = RESPONSE_CACHE_REQUESTS.labels("hit")
+_MISS = RESPONSE_CACHE_REQUESTS.labels("miss")
+_BYPASS = RESPONSE_CACHE_REQUESTS.labels("bypass")
+
+
+def merge_chunks(chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """把流式分块合并为一个完整的 generateContent 响应。"""
+    if len(chunks) == 1:
+        return chunks[0]
+    candidates: Dict[int, Dict[str, Any]] = {}
+    merged: Dict[str, Any] = {}
+    for chunk in chunks:
+        for key, value in chunk.items():
+            if key != "candidates":
+                merged[key] = value
+        for position, candidate in enumerate(chunk.get("candidates", [])):
+            index = candidate.get("index", position)
+            target = candidates.setdefault(index, {"content": {"role": "model", "parts": []}, "index": index})
+            target["content"]["parts"].extend(candidate.get("content", {}).get("parts", []))
+            for key, value in candidate.items():
+                if key not in ("content", "index"):
+                    target[key] = value
+    merged["candidates"] = [candidates[index] for index in sorted(candidates)]
+    return merged
+
+
+class _SQLiteTier:
+    """SQLite 持久层，所有操作在线程池中执行。"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0], row[1]
+
+    def put(self, key: str, value: bytes, expires_at: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires_at, now)
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # 按最近访问时间从旧到新删除，直到回到上限以内
+                for old_key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= size
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """
+    确定性补全请求（temperature=0）的精确匹配缓存。
+
+    键为转换后的Gemini负载、模型和调用方密钥的规范化哈希；值为上游返回的分块列表，
+    非流式响应保存为单个分块，因此同一条目可以同时服务流式与非流式请求。
+    内存层按总字节数做LRU淘汰，可选的SQLite层按TTL和总字节数淘汰。
+    """
+
+    def __init__(self, enabled: bool, max_bytes: int, ttl: float,
+                 sqlite_path: Optional[str] = None, sqlite_max_bytes: int = 0):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._bytes = 0
+        self._sqlite = _SQLiteTier(sqlite_path, sqlite_max_bytes) if enabled and sqlite_path else None
+
+    @staticmethod
+    def eligible(payload: Dict[str, Any]) -> bool:
+        """只有确定性的生成设置才会被缓存。"""
+        config = payload.get("generationConfig") or {}
+        return config.get("temperature") == 0 and (config.get("candidateCount") or 1) == 1
+
+    @staticmethod
+    def make_key(model: str, payload: Dict[str, Any], api_key: Optional[str]) -> str:
+        canonical = json.dumps(
+            {"model": model, "payload": payload},
+            sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        digest = hashlib.sha256()
+        # 区分调用方密钥，避免无效密钥通过缓存拿到结果
+        digest.update((api_key or "").encode())
+        digest.update(b"\0")
+        digest.update(canonical.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def record_bypass():
+        _BYPASS.inc()
+
+    async def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._entries.move_to_end(key)
+                _HIT.inc()
+                return json.loads(entry[0])
+            self._remove(key)
+
+        if self._sqlite is not None:
+            try:
+                row = await asyncio.to_thread(self._sqlite.get, key)
+            except sqlite3.Error as exc:
+                logger.warning(f"读取响应缓存失败: {exc}")
+                row = None
+            if row is not None:
+                self._insert(key, row[0], row[1])
+                _HIT.inc()
+                return json.loads(row[0])
+
+        _MISS.inc()
+        return None
+
+    async def put(self, key: str, chunks: List[Dict[str, Any]]):
+        value = json.dumps(chunks, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        expires_at = time.time() + self.ttl
+        self._insert(key, value, expires_at)
+        if self._sqlite is not None:
+            try:
+                await asyncio.to_thread(self._sqlite.put, key, value, expires_at)
+            except sqlite3.Error as exc:
+                logger.warning(f"写入响应缓存失败: {exc}")
+
+    def _insert(self, key: str, value: bytes, expires_at: float):
+        if len(value) > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (value, expires_at)
+        self._bytes += len(value)
+        self._evict()
+
+    def resize(self, max_bytes: int, ttl: float):
+        """调整内存层字节上限和有效期（热加载配置，只影响之后写入的条目），超出部分按LRU淘汰。"""
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (old_value, _) = self._entries.popitem(last=False)
+            self._bytes -= len(old_value)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def close(self):
+        if self._sqlite is not None:
+            self._sqlite.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+response_cache = ResponseCache(
+    enabled=settings.RESPONSE_CACHE_ENABLED,
+    max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    sqlite_path=settings.RESPONSE_CACHE_SQLITE_PATH,
+    sqlite_max_bytes=settings.RESPONSE_CACHE_SQLITE_MAX_BYTES
+)
+
+registry.callback(
+    "gapi_response_cache_bytes", "响应缓存内存层占用字节数",
+    lambda: {(): response_cache.stats()["bytes"]}
+)
+registry.callback(
+    "gapi_response_cache_hit_ratio", "响应缓存命中率（命中 / (命中 + 未命中)）",
+    lambda: {(): _HIT.value / max(1.0, _HIT.value + _MISS.value)}
+)
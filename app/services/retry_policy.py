@@ -0,0 +1,246 @@
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.core.metrics import model_labels, registry
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+UPSTREAM_RETRIES = registry.counter("gapi_upstream_retries_total", "非流式补全的重试次数（按触发原因）", ("reason",))
+RETRY_OUTCOMES = registry.counter(
+    "gapi_upstream_retry_outcomes_total", "发生过失败的非流式补全的最终结果", ("outcome",)
+)
+UPSTREAM_HEDGES = registry.counter(
+    "gapi_upstream_hedges_total", "对冲请求：fired 已发出，won/lost 对冲先于/晚于原请求返回，budget 预算不足未发出", ("result",)
+)
+DEADLINE_EXCEEDED = registry.counter("gapi_deadline_exceeded_total", "超过截止时间预算的非流式补全数")
+
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))
+# 预算最多积累的令牌数（允许短时间内的突发重试/对冲）
+_BUDGET_BURST = 10.0
+# 每个模型保留的近期延迟样本数、开始对冲所需的最少样本数及重新计算阈值的间隔
+_LATENCY_WINDOW = 512
+_MIN_SAMPLES = 20
+_RECOMPUTE_EVERY = 32
+
+
+class _Budget:
+    """额外尝试的预算：每个请求存入 ratio 个令牌，每次重试或对冲消耗一个，限制额外尝试占请求数的比例。"""
+
+    def __init__(self, ratio: float):
+        self.ratio = ratio
+        self.tokens = _BUDGET_BURST if ratio > 0 else 0.0
+
+    def deposit(self):
+        self.tokens = min(_BUDGET_BURST, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class _LatencyWindow:
+    """一个模型近期成功请求的耗时，定期重新计算对冲阈值（百分位数）。"""
+
+    def __init__(self):
+        self.samples: Deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self.threshold: Optional[float] = None
+        self._count = 0
+
+    def observe(self, latency: float):
+        self.samples.append(latency)
+        self._count += 1
+        if self._count % _RECOMPUTE_EVERY == 0 or (self.threshold is None and len(self.samples) >= _MIN_SAMPLES):
+            ordered = sorted(self.samples)
+            index = min(len(ordered) - 1, int(len(ordered) * settings.HEDGE_PERCENTILE / 100))
+            self.threshold = ordered[index]
+
+
+def _retry_after(exc: Exception) -> float:
+    value = (getattr(exc, "headers", None) or {}).get("Retry-After")
+    try:
+        return float(value) if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+def _retryable(exc: BaseException) -> bool:
+    if isinstance(exc, HTTPException):
+        return exc.status_code in RETRYABLE_STATUSES
+    return isinstance(exc, httpx.RequestError)
+
+
+def _reason(exc: BaseException) -> str:
+    return str(exc.status_code) if isinstance(exc, HTTPException) else type(exc).__name__
+
+
+class RetryPolicy:
+    """
+    非流式补全的截止时间预算、重试和对冲。
+
+    每个请求有一个截止时间（请求头 DEADLINE_HEADER 指定的毫秒数，默认 DEADLINE_DEFAULT_SECONDS），
+    所有尝试共用这一预算：每次尝试最多使用剩余的时间，退避后剩余的时间不够一次典型的尝试时不再重试。
+    遇到429/5xx、连接错误时按指数退避加全抖动重试（429 的 Retry-After 作为最短退避）。
+    开启对冲时，第一次尝试超过该模型（未知模型合并统计）近期耗时的 HEDGE_PERCENTILE 百分位仍未返回，就再发起一次，
+    取先成功返回的结果并取消另一个。重试和对冲各有预算，额外尝试数不超过请求数的一定比例。
+    """
+
+    def __init__(self, max_attempts: int, retry_ratio: float, hedge_enabled: bool, hedge_ratio: float):
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_enabled = hedge_enabled
+        self.retry_budget = _Budget(retry_ratio)
+        self.hedge_budget = _Budget(hedge_ratio)
+        self._windows: Dict[str, _LatencyWindow] = {}
+
+    def reconfigure(self, max_attempts: int, retry_ratio: float, hedge_enabled: bool, hedge_ratio: float):
+        """调整重试次数、预算比例和对冲开关（热加载配置），已积累的令牌和延迟统计保留。"""
+        self.max_attempts = max(1, max_attempts)
+        self.hedge_enabled = hedge_enabled
+        self.retry_budget.ratio = retry_ratio
+        self.hedge_budget.ratio = hedge_ratio
+
+    @staticmethod
+    def deadline(header_value: Optional[str]) -> float:
+        """根据请求头（毫秒）计算截止时间（time.monotonic），无效值使用默认预算。"""
+        budget = settings.DEADLINE_DEFAULT_SECONDS
+        if header_value:
+            try:
+                requested = float(header_value) / 1000
+            except ValueError:
+                requested = 0.0
+            if requested > 0:
+                budget = min(requested, settings.DEADLINE_MAX_SECONDS)
+        return time.monotonic() + budget
+
+    async def call(self, attempt: Callable[[], Awaitable[T]], model: str, deadline: float) -> T:
+        """
+        在截止时间内执行 attempt（一次完整的上游请求，失败时抛出 HTTPException 或 httpx.RequestError），
+        必要时重试或对冲。超过截止时间时返回504，其余失败抛出最后一次的错误。
+        """
+        self.retry_budget.deposit()
+        self.hedge_budget.deposit()
+        # 路由规则和上游模型列表之外的模型共用一个延迟窗口，客户端发送任意模型名不会增加窗口（及其指标）
+        key = model_labels(model)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = _LatencyWindow()
+
+        failures = 0
+        for attempt_number in range(1, self.max_attempts + 1):
+            started = time.monotonic()
+            try:
+                result = await self._run(attempt, window, deadline)
+            except asyncio.TimeoutError:
+                DEADLINE_EXCEEDED.inc()
+                if failures:
+                    RETRY_OUTCOMES.labels("deadline").inc()
+                raise HTTPException(status_code=504, detail="Upstream deadline exceeded")
+            except (HTTPException, httpx.RequestError) as exc:
+                if not _retryable(exc):
+                    raise
+                failures += 1
+                delay = max(
+                    random.uniform(0, min(settings.RETRY_BACKOFF_MAX_MS, settings.RETRY_BACKOFF_MS * 2 ** (attempt_number - 1))) / 1000,
+                    _retry_after(exc)
+                )
+                outcome = self._retry_outcome(attempt_number, delay, window, deadline)
+                if outcome is not None:
+                    RETRY_OUTCOMES.labels(outcome).inc()
+                    raise
+                UPSTREAM_RETRIES.labels(_reason(exc)).inc()
+                logger.info(f"上游请求失败（{_reason(exc)}），{delay * 1000:.0f}ms 后重试（第{attempt_number}次失败）")
+                await asyncio.sleep(delay)
+                continue
+
+            window.observe(time.monotonic() - started)
+            if failures:
+                RETRY_OUTCOMES.labels("success").inc()
+            return result
+        raise RuntimeError("unreachable")
+
+    def stats(self) -> Dict[str, float]:
+        """各模型当前的对冲阈值（秒）。"""
+        return {model: window.threshold for model, window in self._windows.items() if window.threshold is not None}
+
+    def _retry_outcome(self, attempt_number: int, delay: float, window: _LatencyWindow, deadline: float) -> Optional[str]:
+        """不再重试的原因；返回 None 表示可以重试（并已从预算中扣除）。"""
+        if attempt_number >= self.max_attempts:
+            return "exhausted"
+        # 退避后剩余的时间要够一次典型的尝试（近期耗时的百分位数，尚无统计时不要求）
+        if time.monotonic() + delay + (window.threshold or 0.0) >= deadline:
+            return "deadline"
+        if not self.retry_budget.withdraw():
+            return "budget"
+        return None
+
+    async def _run(self, attempt: Callable[[], Awaitable[T]], window: _LatencyWindow, deadline: float) -> T:
+        """执行一次尝试，超过对冲阈值时发起对冲；超过截止时间时抛出 asyncio.TimeoutError。"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        threshold = window.threshold if self.hedge_enabled else None
+        if threshold is None or threshold >= remaining:
+            return await asyncio.wait_for(attempt(), remaining)
+
+        first = asyncio.ensure_future(attempt())
+        hedge: Optional[asyncio.Future] = None
+        pending: List[asyncio.Future] = [first]
+        try:
+            done, _ = await asyncio.wait(pending, timeout=threshold)
+            if not done:
+                if self.hedge_budget.withdraw():
+                    UPSTREAM_HEDGES.labels("fired").inc()
+                    hedge = asyncio.ensure_future(attempt())
+                    pending.append(hedge)
+                else:
+                    UPSTREAM_HEDGES.labels("budget").inc()
+
+            error: Optional[BaseException] = None
+            while pending:
+                remaining = deadline - time.monotonic()
+                done, _ = await asyncio.wait(pending, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    pending.remove(task)
+                    exc = task.exception()
+                    if exc is None:
+                        if hedge is not None:
+                            UPSTREAM_HEDGES.labels("won" if task is hedge else "lost").inc()
+                        return task.result()
+                    # 不可重试的错误（例如400）另一个尝试也会得到，直接返回
+                    if not _retryable(exc):
+                        raise exc
+                    error = exc
+            raise error
+        finally:
+            # 取消未完成的尝试，并等待其关闭上游响应
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+
+retry_policy = RetryPolicy(
+    max_attempts=settings.RETRY_MAX_ATTEMPTS,
+    retry_ratio=settings.RETRY_BUDGET_RATIO,
+    hedge_enabled=settings.HEDGE_ENABLED,
+    hedge_ratio=settings.HEDGE_MAX_RATIO
+)
+
+registry.callback(
+    "gapi_hedge_threshold_seconds", "各模型当前的对冲阈值（近期耗时的百分位数）",
+    lambda: {(model,): threshold for model, threshold in retry_policy.stats().items()},
+    ("model",)
+)
@@ -0,0 +1,135 @@
+from typing import Any, List
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# 字符串外只关心会改变扫描状态的字符，其余字符由正则引擎跳过
+_STRUCT_RE = re.compile(r'[{}"]')
+# 匹配字符串剩余部分（含转义），停在结束引号或分块末尾的单个反斜杠处
+_STRING_BODY_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+
+
+class JSONArrayStreamParser:
+    """
+    streamGenerateContent 默认输出格式（JSON数组 `[{...},{...}]`）的增量解析器。
+
+    在分块之间保存扫描状态（嵌套深度、是否处于字符串内、是否有待处理的转义），
+    每个字符只扫描一次，总开销为 O(总字节数)；字符串中的 `{`、`}` 不会影响计数。
+    """
+
+    def __init__(self):
+        self._pieces: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        """输入一个文本分块，返回其中已完整的顶层对象。"""
+        if not chunk:
+            return []
+
+        objects = []
+        start = 0
+        pos = 0
+        size = len(chunk)
+
+        if self._escape:
+            # 上一个分块以反斜杠结尾，本分块第一个字符属于该转义序列
+            self._escape = False
+            pos = 1
+
+        while pos < size:
+            if self._in_string:
+                end = _STRING_BODY_RE.match(chunk, pos).end()
+                if end >= size:
+                    break
+                if chunk[end] == '"':
+                    self._in_string = False
+                    pos = end + 1
+                    continue
+                # 分块末尾的单个反斜杠，转义字符在下一个分块中
+                self._escape = True
+                break
+
+            match = _STRUCT_RE.search(chunk, pos)
+            if match is None:
+                break
+            i = match.start()
+            pos = i + 1
+            char = chunk[i]
+
+            if char == "{":
+                if self._depth == 0:
+                    start = i
+                self._depth += 1
+            elif char == "}":
+                if self._depth == 0:
+                    # 对象外的孤立右括号，忽略
+                    continue
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pieces.append(chunk[start:i + 1])
+                    json_str = "".join(self._pieces)
+                    self._pieces = []
+                    obj = _loads(json_str)
+                    if obj is not None:
+                        objects.append(obj)
+            elif self._depth > 0:
+                self._in_string = True
+
+        if self._depth > 0:
+            self._pieces.append(chunk[start:])
+
+        return objects
+
+
+class SSEStreamParser:
+    """
+    `alt=sse` 响应格式的增量解析器。
+
+    只缓存尚未遇到换行符的行尾部分，每个 `data:` 行解析为一个对象。
+    """
+
+    def __init__(self):
+        self._tail: List[str] = []
+
+    def feed(self, chunk: str) -> List[Any]:
+        """输入一个文本分块，返回其中已完整的事件对象。"""
+        if "\n" not in chunk:
+            # 长行被拆成多个分块时先暂存，避免反复拼接
+            self._tail.append(chunk)
+            return []
+        if self._tail:
+            self._tail.append(chunk)
+            chunk = "".join(self._tail)
+        lines = chunk.split("\n")
+        tail = lines.pop()
+        self._tail = [tail] if tail else []
+
+        objects = []
+        for line in lines:
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if not data or data == "[DONE]":
+                continue
+            obj = _loads(data)
+            if obj is not None:
+                objects.append(obj)
+        return objects
+
+
+def _loads(json_str: str) -> Any:
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        # 括号已匹配但内容无效，跳过该对象
+        logger.warning("无法解析上游流中的JSON对象，已跳过")
+        return None
+
+
+def create_stream_parser(sse: bool = False):
+    """根据上游帧格式创建对应的增量解析器。"""
+    return SSEStreamParser() if sse else JSONArrayStreamParser()
@@ -0,0 +1,148 @@
+from typing import Dict, Optional
+import asyncio
+import logging
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2（pip install httpx[http2]）
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def build_client(base_url: str, max_connections: int, max_keepalive: int, keepalive_expiry: float,
+                 timeout: float, connect_timeout: float, http2: bool = False,
+                 http2_prior_knowledge: bool = False) -> httpx.AsyncClient:
+    """
+    按给定参数创建上游客户端。http2_prior_knowledge 用于明文 h2c（例如本地基准测试）；
+    HTTPS 上游通过 ALPN 协商，不需要该选项。
+    """
+    if http2 and not HTTP2_AVAILABLE:
+        logger.warning("未安装 h2（pip install httpx[http2]），上游连接回退为 HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=keepalive_expiry
+    )
+    return httpx.AsyncClient(
+        base_url=base_url,
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        limits=limits,
+        http1=not (http2 and http2_prior_knowledge),
+        http2=http2,
+        follow_redirects=True
+    )
+
+
+class UpstreamPools:
+    """
+    上游连接池。
+
+    非流式请求与流式请求默认共用一个连接池；设置 UPSTREAM_STREAM_MAX_CONNECTIONS 后
+    流式请求使用独立的连接池，长时间占用连接的流不会挤占短请求的连接。
+    多上游路由时每个端点各有一组连接池，base_url 默认为 UPSTREAM_BASE_URL。
+    """
+
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = base_url or settings.UPSTREAM_BASE_URL
+        self.http2 = settings.UPSTREAM_HTTP2 and HTTP2_AVAILABLE
+        self.max_connections = {"unary": settings.UPSTREAM_MAX_CONNECTIONS}
+        self.unary = self._build(settings.UPSTREAM_MAX_CONNECTIONS, settings.UPSTREAM_MAX_KEEPALIVE)
+        self.stream: Optional[httpx.AsyncClient] = None
+        if settings.UPSTREAM_STREAM_MAX_CONNECTIONS > 0:
+            self.max_connections["stream"] = settings.UPSTREAM_STREAM_MAX_CONNECTIONS
+            self.stream = self._build(
+                settings.UPSTREAM_STREAM_MAX_CONNECTIONS,
+                min(settings.UPSTREAM_MAX_KEEPALIVE, settings.UPSTREAM_STREAM_MAX_CONNECTIONS)
+            )
+
+    def _build(self, max_connections: int, max_keepalive: int) -> httpx.AsyncClient:
+        return build_client(
+            self.base_url,
+            max_connections=max_connections,
+            max_keepalive=max_keepalive,
+            keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+            timeout=settings.UPSTREAM_TIMEOUT,
+            connect_timeout=settings.UPSTREAM_CONNECT_TIMEOUT,
+            http2=settings.UPSTREAM_HTTP2
+        )
+
+    def client_for(self, streaming: bool) -> httpx.AsyncClient:
+        if streaming and self.stream is not None:
+            return self.stream
+        return self.unary
+
+    def clients(self) -> Dict[str, httpx.AsyncClient]:
+        clients = {"unary": self.unary}
+        if self.stream is not None:
+            clients["stream"] = self.stream
+        return clients
+
+    async def warmup(self, connections: int):
+        """
+        启动时预先建立连接（DNS+TCP+TLS），避免部署后的首批请求承担建连开销。
+        HTTP/2 下一个连接即可多路复用，只建立一个。失败只记录日志。
+        """
+        if connections <= 0:
+            return
+        count = 1 if self.http2 else connections
+        for name, client in self.clients().items():
+            results = await asyncio.gather(
+                *(self._open(client) for _ in range(min(count, self.max_connections[name]))),
+                return_exceptions=True
+            )
+            failures = [result for result in results if isinstance(result, Exception)]
+            if failures:
+                logger.warning(f"上游连接预热失败（{name}）: {len(failures)}/{len(results)}: {failures[0]}")
+            else:
+                logger.info(f"已预热 {len(results)} 个上游连接（{name}）")
+
+    @staticmethod
+    async def _open(client: httpx.AsyncClient):
+        # 并发请求迫使连接池各自建立连接；响应读完后连接回到空闲队列
+        response = await client.request("HEAD", "/", timeout=settings.UPSTREAM_CONNECT_TIMEOUT + 5.0)
+        await response.aclose()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """各连接池中在用与空闲的连接数（读取httpcore连接池状态）。"""
+        stats = {}
+        for name, client in self.clients().items():
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+            in_use = sum(1 for connection in connections if not connection.is_idle())
+            stats[name] = {
+                "in_use": in_use,
+                "idle": len(connections) - in_use,
+                "max": self.max_connections[name],
+            }
+        return stats
+
+    def busy(self) -> bool:
+        """是否还有在用的连接或等待连接的请求。"""
+        for client in self.clients().values():
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            if getattr(pool, "_requests", None) or any(not c.is_idle() for c in getattr(pool, "connections", [])):
+                return True
+        return False
+
+    async def close_when_idle(self, poll: float = 0.5):
+        """
+        被新连接池替换后（热加载配置）调用：等已经发出的请求和流式响应结束、连接都空闲后再关闭，
+        不中断进行中的请求。
+        """
+        while True:
+            # 先等一个周期：刚选中旧连接池的请求可能还没开始获取连接
+            await asyncio.sleep(poll)
+            if not self.busy():
+                break
+        await self.close()
+
+    async def close(self):
+        for client in self.clients().values():
+            await client.aclose()
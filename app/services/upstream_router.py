@@ -0,0 +1,403 @@
+from fnmatch import fnmatchcase
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.core.metrics import model_labels, registry
+from app.services.proxy_service import proxy_service
+from app.services.upstream_pool import UpstreamPools
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_FALLBACKS = registry.counter(
+    "gapi_upstream_fallbacks_total", "上游目标在首字节前失败、改用下一个目标的次数", ("endpoint", "reason")
+)
+UPSTREAM_EJECTIONS = registry.counter(
+    "gapi_upstream_ejections_total", "上游目标（被动检查）或端点（主动检查）被摘除的次数", ("endpoint", "source")
+)
+
+# 首字节前返回这些状态码（或连接失败）时改用下一个目标，并计入目标的错误率
+FALLBACK_STATUSES = frozenset((429, 500, 502, 503, 504))
+# 计入被动健康检查的状态码：429是配额问题，不说明端点不健康
+_UNHEALTHY_STATUSES = frozenset((500, 502, 503, 504))
+_EWMA_ALPHA = 0.3
+# 评分中错误率的权重：错误率10%时评分翻倍
+_ERROR_PENALTY = 10.0
+# 尚未观测到延迟的目标按该值（秒）评分，会被优先尝试
+_UNMEASURED_LATENCY = 0.001
+# 连续摘除时摘除时长翻倍的上限倍数
+_MAX_EJECTION_MULTIPLIER = 8
+
+
+class Endpoint:
+    """
+    一个上游地址（区域）及其连接池，probe_healthy 为最近一次主动健康检查的结果。
+    owns_pools 为 False 时连接池属于 ProxyService（default 端点），不由路由器预热或关闭。
+    """
+
+    def __init__(self, name: str, url: str, pools: UpstreamPools, owns_pools: bool = True):
+        self.name = name
+        self.url = url
+        self.pools = pools
+        self.owns_pools = owns_pools
+        self.probe_healthy = True
+
+
+class Target:
+    """
+    路由目标：某个端点上的某个模型，记录首字节延迟和错误率的指数加权移动平均（EWMA）。
+    model 为 None 时表示透传请求的模型：路由规则没有写明的模型在每个端点上共用一个目标，
+    客户端发送任意模型名都不会增加目标（及其指标）。
+
+    被动健康检查按目标进行（单个模型过载不影响同一端点上的其他模型）：连续失败
+    UPSTREAM_EJECT_FAILURES 次后摘除；端点整体故障由主动健康检查发现。
+    """
+
+    __slots__ = ("endpoint", "model", "latency", "error_rate", "inflight", "failures", "ejections", "ejected_until")
+
+    def __init__(self, endpoint: Endpoint, model: Optional[str]):
+        self.endpoint = endpoint
+        self.model = model
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    @property
+    def label(self) -> str:
+        return self.model or "*"
+
+    def available(self, now: float) -> bool:
+        return self.endpoint.probe_healthy and now >= self.ejected_until
+
+    def score(self) -> float:
+        """越小越好：延迟按错误率加罚，并乘以在途请求数，避免所有请求同时涌向同一个目标。"""
+        latency = self.latency or _UNMEASURED_LATENCY
+        return latency * (1.0 + _ERROR_PENALTY * self.error_rate) * (self.inflight + 1)
+
+    def observe(self, ok: bool, latency: Optional[float] = None):
+        self.error_rate += _EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if latency is not None:
+            self.latency = latency if not self.latency else self.latency + _EWMA_ALPHA * (latency - self.latency)
+
+    def record(self, healthy: bool):
+        if healthy:
+            self.failures = 0
+            self.ejections = 0
+            return
+        self.failures += 1
+        now = time.monotonic()
+        if self.failures < settings.UPSTREAM_EJECT_FAILURES or now < self.ejected_until:
+            return
+        self.ejections += 1
+        duration = settings.UPSTREAM_EJECT_SECONDS * min(2 ** (self.ejections - 1), _MAX_EJECTION_MULTIPLIER)
+        self.ejected_until = now + duration
+        # 摘除结束后处于半开状态：再失败一次就重新摘除，成功一次恢复正常
+        self.failures = settings.UPSTREAM_EJECT_FAILURES - 1
+        UPSTREAM_EJECTIONS.labels(self.endpoint.name, "passive").inc()
+        logger.warning(f"上游目标 {self.endpoint.name}:{self.label} 连续失败，摘除 {duration:.0f} 秒")
+
+    def _release(self):
+        self.inflight -= 1
+
+
+def _parse_endpoints(value: str) -> Dict[str, str]:
+    endpoints = {}
+    for item in value.split(","):
+        name, _, url = item.partition("=")
+        if name.strip() and url.strip():
+            endpoints[name.strip()] = url.strip()
+    return endpoints
+
+
+def _parse_routes(value: str) -> List[Tuple[str, List[Tuple[str, Optional[str]]]]]:
+    """解析 "模型通配符=端点[:模型]|端点[:模型];..."，返回 [(通配符, [(端点, 模型或None)])]。"""
+    routes = []
+    for rule in value.split(";"):
+        pattern, _, targets = rule.partition("=")
+        if not pattern.strip() or not targets.strip():
+            continue
+        parsed = []
+        for target in targets.split("|"):
+            endpoint, _, model = target.strip().partition(":")
+            parsed.append((endpoint.strip(), model.strip() or None))
+        routes.append((pattern.strip(), parsed))
+    return routes
+
+
+def _configured_models(routes: List[Tuple[str, List[Tuple[str, Optional[str]]]]]) -> List[str]:
+    """路由规则中写明的模型：不含通配符的规则和目标模型。"""
+    models = [pattern for pattern, _ in routes if not any(char in pattern for char in "*?[")]
+    models.extend(model for _, targets in routes for _, model in targets if model)
+    return models
+
+
+class UpstreamRouter:
+    """
+    把请求的模型映射到按顺序排列的上游目标（端点 + 模型）。
+
+    路由规则中同一模型的多个端点视为等价，按 EWMA 延迟和错误率以“二选一”（随机取两个，选评分低的）
+    选择首选，其余按评分排序；不同模型按规则中的顺序作为回退。目标被被动健康检查（连续失败）
+    或其端点被主动健康检查（定期 HEAD /）摘除后不参与选择；全部被摘除时仍按顺序尝试，而不是直接失败。
+    """
+
+    def __init__(self, endpoints: Dict[str, str], routes: List[Tuple[str, List[Tuple[str, Optional[str]]]]]):
+        self.endpoints: Dict[str, Endpoint] = {}
+        self.default_route: List[Tuple[str, Optional[str]]] = []
+        self.routes: List[Tuple[str, List[Tuple[str, Optional[str]]]]] = []
+        self._targets: Dict[Tuple[str, Optional[str]], Target] = {}
+        self._configured: FrozenSet[str] = frozenset()
+        self._health_task: Optional[asyncio.Task] = None
+        self._configure(endpoints, routes)
+
+    def _configure(self, endpoints: Dict[str, str], routes: List[Tuple[str, List[Tuple[str, Optional[str]]]]],
+                   rebuild_pools: bool = False) -> Tuple[List[UpstreamPools], List[UpstreamPools]]:
+        """
+        应用端点和路由规则，返回 (新建的连接池, 被替换的连接池)。地址不变的端点沿用原有的连接池和
+        目标统计（rebuild_pools 时按当前设置重建连接池）；规则引用未定义的端点时抛出 ValueError，不做任何修改。
+        """
+        # default 端点复用 ProxyService 的连接池（透传、模型列表等请求也使用它）
+        wanted = {"default": settings.UPSTREAM_BASE_URL}
+        wanted.update(endpoints)
+        for pattern, targets in routes:
+            for endpoint, _ in targets:
+                if endpoint not in wanted:
+                    raise ValueError(f"MODEL_ROUTES 中的规则 {pattern} 引用了未定义的上游端点 {endpoint}")
+
+        created: List[UpstreamPools] = []
+        retired: List[UpstreamPools] = []
+        current = dict(self.endpoints)
+        changed = set()
+        self.endpoints = {}
+        for name, url in wanted.items():
+            endpoint = current.pop(name, None)
+            shared = name == "default" and url == settings.UPSTREAM_BASE_URL
+            if shared:
+                pools = proxy_service.pools
+            elif endpoint is not None and endpoint.owns_pools and endpoint.url == url and not rebuild_pools:
+                pools = endpoint.pools
+            else:
+                pools = UpstreamPools(url)
+                created.append(pools)
+            if endpoint is None:
+                endpoint = Endpoint(name, url, pools, owns_pools=not shared)
+            elif endpoint.pools is not pools:
+                if endpoint.owns_pools:
+                    retired.append(endpoint.pools)
+                if endpoint.url != url:
+                    changed.add(name)
+                    endpoint.probe_healthy = True
+                endpoint.url = url
+                endpoint.pools = pools
+                endpoint.owns_pools = not shared
+            self.endpoints[name] = endpoint
+        for endpoint in current.values():
+            if endpoint.owns_pools:
+                retired.append(endpoint.pools)
+
+        # 未匹配任何规则的模型依次使用 UPSTREAM_ENDPOINTS 中的所有端点（未设置时只有 default）
+        self.default_route = [(name, None) for name in endpoints or ("default",)]
+        self.routes = routes
+        self._configured = frozenset(_configured_models(routes))
+        model_labels.configure(self._configured)
+        # 移除的端点、地址变化的端点和不再由规则写明的模型重新积累延迟与错误率
+        self._targets = {
+            key: target for key, target in self._targets.items()
+            if key[0] in self.endpoints and key[0] not in changed and (key[1] is None or key[1] in self._configured)
+        }
+        return created, retired
+
+    async def reload(self, endpoints: Dict[str, str], routes: List[Tuple[str, List[Tuple[str, Optional[str]]]]],
+                     rebuild_pools: bool = False):
+        """
+        热加载端点和路由规则。之后的请求按新规则路由；被替换的连接池上进行中的请求照常完成后再关闭。
+        """
+        created, retired = self._configure(endpoints, routes, rebuild_pools)
+        for pools in retired:
+            proxy_service.retire(pools)
+        for pools in created:
+            await pools.warmup(settings.UPSTREAM_WARMUP_CONNECTIONS)
+        if len(self.endpoints) > 1:
+            self.start()
+        elif self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+    def _route(self, model: str) -> List[Tuple[str, Optional[str]]]:
+        for pattern, targets in self.routes:
+            if fnmatchcase(model, pattern):
+                return targets
+        return self.default_route
+
+    def _target(self, endpoint: str, model: Optional[str]) -> Target:
+        target = self._targets.get((endpoint, model))
+        if target is None:
+            target = self._targets[(endpoint, model)] = Target(self.endpoints[endpoint], model)
+        return target
+
+    def primary_model(self, model: str) -> str:
+        """路由规则为请求的模型指定的首选上游模型（响应中的模型名、缓存键等使用它）。"""
+        _, target_model = self._route(model)[0]
+        return target_model or model
+
+    def plan(self, model: str) -> List[Target]:
+        """返回本次请求依次尝试的目标。"""
+        now = time.monotonic()
+        groups: Dict[str, List[Target]] = {}
+        # 规则没有写明的模型共用端点的透传目标（model 为 None）
+        passthrough = model if model in self._configured else None
+        for endpoint, target_model in self._route(model):
+            target = self._target(endpoint, target_model or passthrough)
+            groups.setdefault(target.model, []).append(target)
+
+        plan: List[Target] = []
+        for targets in groups.values():
+            ranked = sorted((target for target in targets if target.available(now)), key=Target.score)
+            if len(ranked) > 2:
+                first = min(random.sample(ranked, 2), key=Target.score)
+                ranked.remove(first)
+                ranked.insert(0, first)
+            plan.extend(ranked)
+        if not plan:
+            plan = [target for targets in groups.values() for target in targets]
+        return plan
+
+    async def send(self, model: str, build_request: Callable[[Target, httpx.AsyncClient], Awaitable[httpx.Request]],
+                   use_pool: bool = False, streaming: bool = False) -> Tuple[Target, httpx.Response]:
+        """
+        依次尝试模型的路由目标，返回 (目标, 响应)。build_request 为每个目标构建请求（模型和端点因目标而异，
+        目标的 model 为 None 时使用请求的模型）。
+
+        连接失败或返回 FALLBACK_STATUSES 时改用下一个目标；回退只发生在读取响应体之前，
+        最后一个目标的失败原样返回或抛出。
+        """
+        targets = self.plan(model)
+        for index, target in enumerate(targets):
+            last = index == len(targets) - 1
+            req = await build_request(target, target.endpoint.pools.client_for(streaming))
+            target.inflight += 1
+            started = time.perf_counter()
+            try:
+                response = await proxy_service.send(req, use_pool=use_pool, streaming=streaming, pools=target.endpoint.pools)
+            except httpx.RequestError as exc:
+                target.inflight -= 1
+                target.observe(False)
+                target.record(False)
+                if last:
+                    raise
+                self._fallback(target, type(exc).__name__)
+                continue
+            except HTTPException as exc:
+                # 密钥池中的密钥都在冷却
+                target.inflight -= 1
+                if last or exc.status_code not in FALLBACK_STATUSES:
+                    raise
+                self._fallback(target, str(exc.status_code))
+                continue
+            except BaseException:
+                target.inflight -= 1
+                raise
+
+            response.stream.on_close(target._release)
+            status = response.status_code
+            ok = status not in FALLBACK_STATUSES
+            target.observe(ok, time.perf_counter() - started if ok else None)
+            target.record(status not in _UNHEALTHY_STATUSES)
+            if ok or last:
+                return target, response
+            await response.aclose()
+            self._fallback(target, str(status))
+        raise RuntimeError(f"模型 {model} 没有可用的上游目标")
+
+    @staticmethod
+    def _fallback(target: Target, reason: str):
+        UPSTREAM_FALLBACKS.labels(target.endpoint.name, reason).inc()
+        logger.info(f"上游目标 {target.endpoint.name}:{target.label} 失败（{reason}），改用下一个目标")
+
+    def start(self):
+        """配置了多个端点时启动主动健康检查。"""
+        if settings.UPSTREAM_HEALTH_CHECK_INTERVAL > 0 and len(self.endpoints) > 1 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(endpoint) for endpoint in self.endpoints.values()))
+            await asyncio.sleep(settings.UPSTREAM_HEALTH_CHECK_INTERVAL)
+
+    @staticmethod
+    async def _probe(endpoint: Endpoint):
+        # 只检查端点能否正常响应（真实上游对 / 返回404），5xx 或连接失败视为不健康
+        try:
+            response = await endpoint.pools.unary.request("HEAD", "/", timeout=settings.UPSTREAM_CONNECT_TIMEOUT)
+            healthy = response.status_code not in _UNHEALTHY_STATUSES
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != endpoint.probe_healthy:
+            endpoint.probe_healthy = healthy
+            if healthy:
+                logger.info(f"上游端点 {endpoint.name} 主动健康检查恢复")
+            else:
+                UPSTREAM_EJECTIONS.labels(endpoint.name, "active").inc()
+                logger.warning(f"上游端点 {endpoint.name} 主动健康检查失败，暂停使用")
+
+    async def warmup(self):
+        for endpoint in self.endpoints.values():
+            if endpoint.owns_pools:
+                await endpoint.pools.warmup(settings.UPSTREAM_WARMUP_CONNECTIONS)
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for endpoint in self.endpoints.values():
+            if endpoint.owns_pools:
+                await endpoint.pools.close()
+
+    def stats(self) -> List[Dict[str, object]]:
+        now = time.monotonic()
+        return [
+            {
+                "endpoint": target.endpoint.name,
+                "model": target.label,
+                "available": target.available(now),
+                "latency": target.latency,
+                "error_rate": target.error_rate,
+                "inflight": target.inflight,
+            }
+            for target in self._targets.values()
+        ]
+
+
+upstream_router = UpstreamRouter(
+    endpoints=_parse_endpoints(settings.UPSTREAM_ENDPOINTS),
+    routes=_parse_routes(settings.MODEL_ROUTES)
+)
+
+registry.callback(
+    "gapi_upstream_target_latency_seconds", "各上游目标首字节延迟的EWMA",
+    lambda: {(stat["endpoint"], stat["model"]): stat["latency"] for stat in upstream_router.stats()},
+    ("endpoint", "model")
+)
+registry.callback(
+    "gapi_upstream_target_error_rate", "各上游目标错误率的EWMA",
+    lambda: {(stat["endpoint"], stat["model"]): stat["error_rate"] for stat in upstream_router.stats()},
+    ("endpoint", "model")
+)
+registry.callback(
+    "gapi_upstream_target_inflight", "各上游目标的在途请求数",
+    lambda: {(stat["endpoint"], stat["model"]): stat["inflight"] for stat in upstream_router.stats()},
+    ("endpoint", "model")
+)
+registry.callback(
+    "gapi_upstream_target_available", "各上游目标是否参与路由（未被健康检查摘除为1）",
+    lambda: {(stat["endpoint"], stat["model"]): float(stat["available"]) for stat in upstream_router.stats()},
+    ("endpoint", "model")
+)
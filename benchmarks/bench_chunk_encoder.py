@@ -0,0 +1,61 @@
+"""
+对比逐分块构建字典 + json.dumps + f-string 与 ChunkEncoder 的吞吐（chunks/sec）。
+
+用法：python -m benchmarks.bench_chunk_encoder [--chunks 200000]
+"""
+import argparse
+import json
+import time
+
+from app.services import chunk_encoder
+from app.services.chunk_encoder import ChunkEncoder
+from app.services.converter import converter
+
+
+def legacy(chunks, model):
+    for gemini_chunk in chunks:
+        openai_chunk = converter.gemini_to_openai_chunk(gemini_chunk, model)
+        f"data: {json.dumps(openai_chunk)}\n\n".encode("utf-8")
+
+
+def encoded(chunks, model):
+    encoder = ChunkEncoder(model)
+    for gemini_chunk in chunks:
+        encoder.encode(gemini_chunk)
+
+
+def bench(name, fn, chunks):
+    begin = time.perf_counter()
+    fn(chunks, "gemini-1.5-flash")
+    elapsed = time.perf_counter() - begin
+    rate = len(chunks) / elapsed
+    print(f"{name:<22} {rate:12,.0f} chunks/sec  {elapsed / len(chunks) * 1e6:6.2f} us/chunk")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=200000)
+    args = parser.parse_args()
+
+    # 逐token流：每个分块只有几个字符
+    chunks = [
+        {"candidates": [{"content": {"parts": [{"text": f"tok{i % 97} "}], "role": "model"}, "index": 0}]}
+        for i in range(args.chunks)
+    ]
+
+    before = bench("legacy", legacy, chunks)
+    orjson_module = chunk_encoder.orjson
+    chunk_encoder.orjson = None
+    stdlib = bench("ChunkEncoder (stdlib)", encoded, chunks)
+    chunk_encoder.orjson = orjson_module
+    print(f"{'':<22} x{stdlib / before:.2f}")
+    if orjson_module is not None:
+        fast = bench("ChunkEncoder (orjson)", encoded, chunks)
+        print(f"{'':<22} x{fast / before:.2f}")
+    else:
+        print("orjson 未安装，跳过")
+
+
+if __name__ == "__main__":
+    main()
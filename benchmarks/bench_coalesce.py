@@ -0,0 +1,116 @@
+"""
+对比高频小分块流式响应逐块写出与合并写出时代理的 CPU 开销、写出次数和首字延迟。
+
+模拟上游以 --chunk-interval-ms 的间隔输出 --chunks 个小分块（接近逐 token 输出），
+大量客户端同时发起流式聊天补全。依次以两种配置启动代理：
+  off   SSE_COALESCE_MS=0（每个分块一次 send）
+  on    SSE_COALESCE_MS=--flush-ms（第一个分块立即写出，之后按时间窗口合并）
+统计每核每秒可支撑的流数（完成的流数 / 代理CPU秒）、每秒 send 调用数、每次写出的平均分块数、
+首字节时间（TTFT）和完整流耗时，并校验每个流的 SSE 帧数一致。
+
+用法：python -m benchmarks.bench_coalesce [--streams 50] [--rounds 3] [--flush-ms 10]
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.bench_disconnect import parse_metrics
+from benchmarks.loadgen import ProcessSampler, percentile, spawn, wait_ready
+
+CONFIGS = {
+    "off": lambda args: {"SSE_COALESCE_MS": "0"},
+    "on": lambda args: {"SSE_COALESCE_MS": str(args.flush_ms)},
+}
+
+
+async def one_stream(client: httpx.AsyncClient, args, ttfts: List[float], durations: List[float]) -> int:
+    body = {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}], "stream": True}
+    headers = {"authorization": f"Bearer {args.api_key}"}
+    begin = time.perf_counter()
+    received = b""
+    first = None
+    async with client.stream("POST", "/v1/chat/completions", json=body, headers=headers) as response:
+        assert response.status_code == 200, response.status_code
+        async for chunk in response.aiter_raw():
+            if first is None:
+                first = time.perf_counter() - begin
+            received += chunk
+    ttfts.append(first)
+    durations.append(time.perf_counter() - begin)
+    assert received.endswith(b"data: [DONE]\n\n"), received[-40:]
+    return received.count(b"data: ")
+
+
+async def run(config: str, args, proxy_url: str, sampler: ProcessSampler) -> Dict:
+    ttfts: List[float] = []
+    durations: List[float] = []
+    frame_counts = set()
+    # 一轮中先结束的流的连接要空闲到整轮结束，短于代理（uvicorn）5秒的空闲超时才不会复用到已关闭的连接
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None, keepalive_expiry=2.0)
+    async with httpx.AsyncClient(base_url=proxy_url, limits=limits, timeout=120.0) as client:
+        before = parse_metrics((await client.get("/metrics")).text)
+        cpu_before = sampler.cpu_seconds()
+        begin = time.perf_counter()
+        for _ in range(args.rounds):
+            counts = await asyncio.gather(*(one_stream(client, args, ttfts, durations) for _ in range(args.streams)))
+            frame_counts.update(counts)
+        elapsed = time.perf_counter() - begin
+        cpu = sampler.cpu_seconds() - cpu_before
+        # 计数在写出最后一条消息之后才更新
+        await asyncio.sleep(0.2)
+        after = parse_metrics((await client.get("/metrics")).text)
+
+    writes = after["gapi_stream_writes_total"] - before.get("gapi_stream_writes_total", 0)
+    frames = after["gapi_stream_frames_total"] - before.get("gapi_stream_frames_total", 0)
+    streams = args.streams * args.rounds
+    print(
+        f"{config:<4} streams/core-s={streams / cpu:6.1f} cpu/stream={cpu * 1000 / streams:6.2f}ms "
+        f"sends/s={writes / elapsed:8.0f} frames/write={frames / writes:5.2f} "
+        f"ttft p50={percentile(ttfts, 50) * 1000:5.1f}ms p99={percentile(ttfts, 99) * 1000:6.1f}ms "
+        f"stream p50={percentile(durations, 50) * 1000:6.0f}ms sse_frames={sorted(frame_counts)}"
+    )
+
+
+async def main_async(args):
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    upstream = spawn([
+        "-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port), "--latency-ms", "0",
+        "--chunks", str(args.chunks), "--chunk-chars", "4", "--chunk-interval-ms", str(args.chunk_interval_ms),
+    ])
+    try:
+        await wait_ready(f"{upstream_url}/stats")
+        for config, env in CONFIGS.items():
+            proxy = spawn(
+                ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+                {"UPSTREAM_BASE_URL": upstream_url, "TRACING_SAMPLE_RATE": "0", **env(args)}
+            )
+            try:
+                await wait_ready(f"{proxy_url}/health")
+                await run(config, args, proxy_url, ProcessSampler(proxy.pid))
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=50, help="每轮同时进行的流数")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--chunks", type=int, default=200)
+    parser.add_argument("--chunk-interval-ms", type=float, default=10.0)
+    parser.add_argument("--flush-ms", type=float, default=10.0)
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9170)
+    parser.add_argument("--proxy-port", type=int, default=9171)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
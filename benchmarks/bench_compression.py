@@ -0,0 +1,121 @@
+"""
+对比代理返回大JSON响应时，解压后明文返回与原样转发/压缩返回的线上字节数和代理CPU时间。
+
+模拟上游在客户端接受时返回 gzip 压缩的响应（随机单词文本，压缩率接近真实输出）。依次以两种配置启动代理：
+  decode      PASSTHROUGH_COMPRESSED=false, RESPONSE_GZIP_MIN_BYTES=0（解压上游响应并以明文返回）
+  compressed  PASSTHROUGH_COMPRESSED=true,  RESPONSE_GZIP_MIN_BYTES=1024（透传原样转发压缩字节，聊天响应压缩）
+客户端总是发送 Accept-Encoding: gzip，统计收到的原始字节数（未解压）和代理进程每个响应的CPU时间。
+
+用法：python -m benchmarks.bench_compression [--requests 300] [--concurrency 10] [--response-kb 64]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import time
+from typing import Dict
+
+import httpx
+
+from benchmarks.loadgen import ProcessSampler, spawn, wait_ready
+
+SCENARIOS = {
+    "passthrough": ("/v1beta/models/gemini-fake:generateContent",
+                    {"contents": [{"role": "user", "parts": [{"text": "hello"}]}]}),
+    "passthrough-stream": ("/v1beta/models/gemini-fake:streamGenerateContent",
+                           {"contents": [{"role": "user", "parts": [{"text": "hello"}]}]}),
+    "chat": ("/v1/chat/completions", {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}]}),
+}
+
+CONFIGS = {
+    "decode": {"PASSTHROUGH_COMPRESSED": "false", "RESPONSE_GZIP_MIN_BYTES": "0"},
+    "compressed": {"PASSTHROUGH_COMPRESSED": "true", "RESPONSE_GZIP_MIN_BYTES": "1024"},
+}
+
+
+async def run(client: httpx.AsyncClient, name: str, args, sampler: ProcessSampler) -> Dict:
+    path, body = SCENARIOS[name]
+    headers = {"authorization": f"Bearer {args.api_key}", "accept-encoding": "gzip"}
+    wire_bytes = 0
+    remaining = args.requests
+    encodings = set()
+
+    async def worker():
+        nonlocal remaining, wire_bytes
+        while remaining > 0:
+            remaining -= 1
+            async with client.stream("POST", path, json=body, headers=headers) as response:
+                raw = b""
+                async for chunk in response.aiter_raw():
+                    raw += chunk
+                assert response.status_code == 200, response.status_code
+                encoding = response.headers.get("content-encoding")
+                encodings.add(encoding or "identity")
+                # 校验响应能正确解码
+                json.loads(gzip.decompress(raw) if encoding == "gzip" else raw)
+                wire_bytes += len(raw)
+
+    cpu_before = sampler.cpu_seconds()
+    begin = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - begin
+    cpu = sampler.cpu_seconds() - cpu_before
+    return {
+        "scenario": name,
+        "encoding": ",".join(sorted(encodings)),
+        "kb_per_response": wire_bytes / args.requests / 1024,
+        "cpu_ms_per_response": cpu * 1000 / args.requests,
+        "rps": args.requests / elapsed,
+    }
+
+
+async def main_async(args):
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    chunks = 20
+    chunk_chars = max(1, args.response_kb * 1024 // chunks)
+    upstream = spawn([
+        "-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port), "--latency-ms", "0",
+        "--chunks", str(chunks), "--chunk-chars", str(chunk_chars), "--chunk-interval-ms", "0",
+        "--text", "words", "--gzip",
+    ])
+    try:
+        await wait_ready(f"{upstream_url}/stats")
+        print(f"{'config':<11} {'scenario':<19} {'encoding':<9} {'KB/resp':>8} {'cpu/resp':>9} {'rps':>7}")
+        for config, env in CONFIGS.items():
+            proxy = spawn(
+                ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+                {"UPSTREAM_BASE_URL": upstream_url, **env}
+            )
+            try:
+                await wait_ready(f"{proxy_url}/health")
+                sampler = ProcessSampler(proxy.pid)
+                async with httpx.AsyncClient(base_url=proxy_url, timeout=60.0) as client:
+                    for name in args.scenarios.split(","):
+                        result = await run(client, name, args, sampler)
+                        print(
+                            f"{config:<11} {name:<19} {result['encoding']:<9} {result['kb_per_response']:>8.1f} "
+                            f"{result['cpu_ms_per_response']:>7.2f}ms {result['rps']:>7.1f}"
+                        )
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--response-kb", type=int, default=64, help="响应文本的大致大小（KB）")
+    parser.add_argument("--scenarios", default="passthrough,passthrough-stream,chat")
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9110)
+    parser.add_argument("--proxy-port", type=int, default=9111)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+对比聊天请求的两种解析路径：pydantic 完整校验 + 转换，与最小结构检查 + 一次遍历转换。
+计时包括JSON解析，历史长度从1到1000条消息，每10条消息包含一次不带name的工具调用往返。
+
+用法：python -m benchmarks.bench_converter [--lengths 1,10,100,1000] [--seconds 1.0]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.services.chunk_encoder import loads
+from app.services.converter import converter
+
+
+def build_body(length: int) -> bytes:
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(length - 1):
+        if i % 10 == 8:
+            messages.append({
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [{
+                    "id": f"call_{i}",
+                    "type": "function",
+                    "function": {"name": "get_weather", "arguments": json.dumps({"city": f"city-{i}"})}
+                }]
+            })
+        elif i % 10 == 9:
+            messages.append({"role": "tool", "tool_call_id": f"call_{i - 1}", "content": "sunny, 22C"})
+        elif i % 2 == 0:
+            messages.append({"role": "user", "content": f"question {i}: " + "lorem ipsum " * 20})
+        else:
+            messages.append({"role": "assistant", "content": f"answer {i}: " + "dolor sit amet " * 30})
+    return json.dumps({
+        "model": "gemini-1.5-flash",
+        "messages": messages,
+        "temperature": 0.7,
+        "tools": [{"type": "function", "function": {"name": "get_weather", "parameters": {"type": "object"}}}],
+    }).encode()
+
+
+async def run(validate, raw: bytes, seconds: float) -> float:
+    iterations = 0
+    begin = time.perf_counter()
+    deadline = begin + seconds
+    while time.perf_counter() < deadline:
+        await converter.openai_to_gemini(validate(loads(raw)))
+        iterations += 1
+    return (time.perf_counter() - begin) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lengths", default="1,10,100,200,1000")
+    parser.add_argument("--seconds", type=float, default=1.0, help="每个组合的运行时长")
+    args = parser.parse_args()
+
+    print(f"{'messages':>8} {'pydantic':>12} {'fast':>12} {'speedup':>8}")
+    for length in (int(value) for value in args.lengths.split(",")):
+        raw = build_body(length)
+        fast_validate = converter.check_chat_request
+        pydantic_validate = converter.validate_chat_request
+        # 两条路径的转换结果必须一致
+        fast_payload = asyncio.run(converter.openai_to_gemini(fast_validate(loads(raw))))
+        pydantic_payload = asyncio.run(converter.openai_to_gemini(pydantic_validate(loads(raw))))
+        assert fast_payload == pydantic_payload
+
+        slow = asyncio.run(run(pydantic_validate, raw, args.seconds))
+        fast = asyncio.run(run(fast_validate, raw, args.seconds))
+        print(f"{length:>8} {slow * 1e3:>10.3f}ms {fast * 1e3:>10.3f}ms {slow / fast:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+客户端中途断开流式请求后，检查代理是否及时释放上游连接。
+
+启动模拟上游（长时间输出的流）和代理，让大量客户端同时发起流式请求，收到第一段数据后立即断开，
+然后轮询代理的 /metrics 和上游的 /stats，直到每个被断开的响应都已在代理侧结束，
+并且打开的上游响应数、连接池在用连接数和上游正在输出的流数都回到0。
+超过 --timeout 仍未回到0时退出码为1（上游流本身要持续 chunks*chunk_interval 才结束，
+超时应远小于这个时长，否则无法区分“主动释放”和“等流自然结束”）。
+
+用法：python -m benchmarks.bench_disconnect [--clients 1000] [--scenarios passthrough-stream,chat-stream]
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import Dict
+
+import httpx
+
+from benchmarks.loadgen import spawn, wait_ready
+
+SCENARIOS = {
+    "passthrough-stream": {
+        "path": "/v1beta/models/gemini-fake:streamGenerateContent?alt=sse",
+        "json": {"contents": [{"role": "user", "parts": [{"text": "hello"}]}]},
+    },
+    "chat-stream": {
+        "path": "/v1/chat/completions",
+        "json": {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}], "stream": True},
+    },
+}
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """把 Prometheus 文本格式解析为 {带标签的指标名: 值}。"""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    return samples
+
+
+async def snapshot(client: httpx.AsyncClient, proxy_url: str, upstream_url: str) -> Dict[str, float]:
+    metrics = parse_metrics((await client.get(f"{proxy_url}/metrics")).text)
+    upstream = (await client.get(f"{upstream_url}/stats")).json()
+    return {
+        "open_responses": metrics.get("gapi_upstream_open_responses", 0),
+        "pool_in_use": sum(value for name, value in metrics.items()
+                           if name.startswith("gapi_upstream_pool_connections") and 'state="in_use"' in name),
+        "upstream_streaming": upstream["streaming"],
+        "aborted": metrics.get("gapi_streams_aborted_total", 0),
+        "leaked": metrics.get("gapi_upstream_leaked_responses_total", 0),
+    }
+
+
+async def disconnect_after_first_chunk(client: httpx.AsyncClient, scenario: Dict, api_key: str) -> bool:
+    headers = {"authorization": f"Bearer {api_key}"}
+    async with client.stream("POST", scenario["path"], json=scenario["json"], headers=headers) as response:
+        async for _ in response.aiter_raw():
+            # 退出上下文时连接没有读完，httpx 直接关闭连接，代理会收到断开
+            return response.status_code == 200
+    return False
+
+
+async def run(name: str, args, proxy_url: str, upstream_url: str) -> bool:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=proxy_url, limits=limits, timeout=60.0) as client, \
+            httpx.AsyncClient(timeout=10.0) as monitor:
+        before = await snapshot(monitor, proxy_url, upstream_url)
+        begin = time.perf_counter()
+        results = await asyncio.gather(
+            *(disconnect_after_first_chunk(client, SCENARIOS[name], args.api_key) for _ in range(args.clients)),
+            return_exceptions=True
+        )
+        disconnected = time.perf_counter()
+        ok = sum(1 for result in results if result is True)
+
+        while True:
+            state = await snapshot(monitor, proxy_url, upstream_url)
+            drained = (
+                state["open_responses"] == 0 and state["pool_in_use"] == 0 and state["upstream_streaming"] == 0
+                # 代理侧的响应也都已结束
+                and state["aborted"] - before["aborted"] >= ok
+            )
+            waited = time.perf_counter() - disconnected
+            if drained or waited > args.timeout:
+                break
+            await asyncio.sleep(0.05)
+
+    print(
+        f"{name:<20} clients={ok}/{args.clients} connect+first_chunk={disconnected - begin:.2f}s "
+        f"drain={waited:.2f}s open={state['open_responses']:.0f} in_use={state['pool_in_use']:.0f} "
+        f"upstream_streaming={state['upstream_streaming']} aborted=+{state['aborted'] - before['aborted']:.0f} "
+        f"leaked=+{state['leaked'] - before['leaked']:.0f} {'OK' if drained else 'NOT DRAINED'}"
+    )
+    return drained
+
+
+async def main_async(args) -> int:
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    processes = [spawn([
+        "-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port),
+        "--latency-ms", "0", "--chunks", str(args.chunks), "--chunk-interval-ms", str(args.chunk_interval_ms),
+    ])]
+    try:
+        await wait_ready(f"{upstream_url}/stats")
+        processes.append(spawn(
+            ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+            {"UPSTREAM_BASE_URL": upstream_url}
+        ))
+        await wait_ready(f"{proxy_url}/health")
+        failed = 0
+        for name in args.scenarios.split(","):
+            if not await run(name, args, proxy_url, upstream_url):
+                failed += 1
+        return 1 if failed else 0
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--scenarios", default="passthrough-stream,chat-stream")
+    parser.add_argument("--timeout", type=float, default=5.0, help="断开后等待连接释放的最长时间（秒）")
+    parser.add_argument("--chunks", type=int, default=300)
+    parser.add_argument("--chunk-interval-ms", type=float, default=200.0)
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--proxy-port", type=int, default=9101)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
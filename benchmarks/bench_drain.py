@@ -0,0 +1,174 @@
+"""
+优雅关闭与配置热加载：检查部署（SIGTERM）和改配置（SIGHUP）时进行中的流式请求是否被中断。
+
+模拟上游的每个流持续约 --chunks * --chunk-interval-ms 毫秒。依次运行：
+  drain    --streams 个流进行到一半时向代理发送 SIGTERM：统计完整结束的流数、排空期间 /health 和新请求的状态码、
+           代理退出耗时（应接近剩余的流时长，且所有流完整结束）
+  grace    同上，但 DRAIN_GRACE_SECONDS=--short-grace（短于流时长）：超过宽限期的流被中止，代理按时退出
+  reload   代理从临时目录的 .env 读取配置；持续发起流式请求的同时修改 .env（连接池上限、密钥、路由规则、
+           缓存容量）并发送 SIGHUP：所有流应完整结束，/metrics 中的连接池上限和热加载计数应随之变化
+
+用法：python -m benchmarks.bench_drain [--streams 50] [--short-grace 1]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.bench_disconnect import parse_metrics
+from benchmarks.loadgen import spawn, wait_ready
+
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_POOL_MAX = 'gapi_upstream_pool_connections{pool="unary",state="max"}'
+
+
+async def one_stream(client: httpx.AsyncClient, args, results: List[str]):
+    body = {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}], "stream": True}
+    headers = {"authorization": f"Bearer {args.api_key}"}
+    received = b""
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=body, headers=headers) as response:
+            if response.status_code != 200:
+                results.append(str(response.status_code))
+                return
+            async for chunk in response.aiter_raw():
+                received += chunk
+    except httpx.HTTPError as exc:
+        results.append(type(exc).__name__)
+        return
+    results.append("complete" if received.endswith(b"data: [DONE]\n\n") else "truncated")
+
+
+def summarize(results: List[str]) -> str:
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result] = counts.get(result, 0) + 1
+    return " ".join(f"{name}={count}" for name, count in sorted(counts.items()))
+
+
+async def run_shutdown(name: str, grace: float, args, proxy_url: str, upstream_url: str):
+    proxy = spawn(
+        ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+        {"UPSTREAM_BASE_URL": upstream_url, "TRACING_SAMPLE_RATE": "0", "DRAIN_GRACE_SECONDS": str(grace)}
+    )
+    try:
+        await wait_ready(f"{proxy_url}/health")
+        results: List[str] = []
+        stream_seconds = args.chunks * args.chunk_interval_ms / 1000
+        async with httpx.AsyncClient(base_url=proxy_url, timeout=60.0) as client, \
+                httpx.AsyncClient(base_url=proxy_url, timeout=5.0) as probe:
+            streams = [asyncio.ensure_future(one_stream(client, args, results)) for _ in range(args.streams)]
+            await asyncio.sleep(stream_seconds / 2)
+            proxy.send_signal(signal.SIGTERM)
+            signalled = time.perf_counter()
+            await asyncio.sleep(0.2)
+            health = (await probe.get("/health")).status_code
+            rejected = (await probe.post(
+                "/v1/chat/completions", json={}, headers={"authorization": f"Bearer {args.api_key}"}
+            )).status_code
+            await asyncio.gather(*streams)
+            exit_code = await asyncio.get_running_loop().run_in_executor(None, proxy.wait)
+            elapsed = time.perf_counter() - signalled
+        print(
+            f"{name:<6} grace={grace:.0f}s streams[{summarize(results)}] health={health} new_request={rejected} "
+            f"exit={elapsed:.1f}s after SIGTERM (remaining stream ~{stream_seconds / 2:.1f}s, code {exit_code})"
+        )
+    finally:
+        if proxy.poll() is None:
+            proxy.kill()
+            proxy.wait()
+
+
+def write_env(path: str, upstream_url: str, values: Dict[str, str]):
+    with open(path, "w") as f:
+        f.write(f"UPSTREAM_BASE_URL={upstream_url}\nTRACING_SAMPLE_RATE=0\n")
+        for key, value in values.items():
+            f.write(f"{key}={value}\n")
+
+
+async def run_reload(args, proxy_url: str, upstream_url: str):
+    workdir = tempfile.mkdtemp(prefix="gapi-reload-")
+    env_path = os.path.join(workdir, ".env")
+    write_env(env_path, upstream_url, {"UPSTREAM_MAX_CONNECTIONS": "100"})
+    # 在临时目录中启动，使代理读取（并热加载）该目录的 .env
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [_REPO, os.environ.get("PYTHONPATH")]))}
+    proxy = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+        cwd=workdir, env=env
+    )
+    try:
+        await wait_ready(f"{proxy_url}/health")
+        results: List[str] = []
+        stream_seconds = args.chunks * args.chunk_interval_ms / 1000
+        async with httpx.AsyncClient(base_url=proxy_url, timeout=60.0) as client:
+            before = parse_metrics((await client.get("/metrics")).text)
+            stop = time.perf_counter() + stream_seconds * 2
+
+            async def worker():
+                while time.perf_counter() < stop:
+                    await one_stream(client, args, results)
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(args.streams)]
+            await asyncio.sleep(stream_seconds / 2)
+            write_env(env_path, upstream_url, {
+                "UPSTREAM_MAX_CONNECTIONS": "200",
+                "GEMINI_API_KEYS": "reloaded-key-1,reloaded-key-2",
+                "MODEL_ROUTES": "gpt-*=default:gemini-fake",
+                "RESPONSE_CACHE_MAX_BYTES": str(1024 * 1024),
+                "HISTORY_CACHE_MAX_BYTES": str(1024 * 1024),
+            })
+            proxy.send_signal(signal.SIGHUP)
+            await asyncio.gather(*workers)
+            await asyncio.sleep(1.0)
+            after = parse_metrics((await client.get("/metrics")).text)
+        reloads = after.get('gapi_config_reloads_total{result="ok"}', 0.0)
+        print(
+            f"reload streams[{summarize(results)}] pool_max {before.get(_POOL_MAX, 0):.0f}->{after.get(_POOL_MAX, 0):.0f} "
+            f"reloads_ok={reloads:.0f} alive={proxy.poll() is None}"
+        )
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+
+async def main_async(args):
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    upstream = spawn([
+        "-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port), "--latency-ms", "0",
+        "--chunks", str(args.chunks), "--chunk-interval-ms", str(args.chunk_interval_ms),
+    ])
+    try:
+        await wait_ready(f"{upstream_url}/stats")
+        await run_shutdown("drain", 30.0, args, proxy_url, upstream_url)
+        await run_shutdown("grace", args.short_grace, args, proxy_url, upstream_url)
+        await run_reload(args, proxy_url, upstream_url)
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--chunks", type=int, default=100)
+    parser.add_argument("--chunk-interval-ms", type=float, default=40.0)
+    parser.add_argument("--short-grace", type=float, default=1.0)
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9180)
+    parser.add_argument("--proxy-port", type=int, default=9181)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+对比多轮图片对话中，媒体内联发送与上传到 Files API 后引用时发往上游的请求大小和代理内存。
+
+模拟上游实现了 Files API 的可恢复上传接口。每轮对话在历史末尾追加一条带图片（data URI）的用户消息，
+并带上完整历史重新发送，这与客户端的实际行为一致。依次以两种配置启动代理：
+  inline   FILE_OFFLOAD_ENABLED=false（每轮都把所有图片以 base64 内联发送）
+  offload  FILE_OFFLOAD_ENABLED=true（每张图片只上传一次，请求中改为 file_data 引用）
+统计每轮上游收到的生成请求大小、上传的字节数、请求耗时和代理进程的RSS。
+
+用法：python -m benchmarks.bench_files [--turns 8] [--image-kb 1024]
+"""
+import argparse
+import asyncio
+import base64
+import os
+import time
+
+import httpx
+
+from benchmarks.loadgen import ProcessSampler, spawn, wait_ready
+
+CONFIGS = {
+    "inline": {"FILE_OFFLOAD_ENABLED": "false"},
+    "offload": {"FILE_OFFLOAD_ENABLED": "true"},
+}
+
+
+def image_message(turn: int, image_kb: int) -> dict:
+    # 随机字节不可压缩，大小与真实图片相当
+    data = base64.b64encode(os.urandom(image_kb * 1024)).decode("ascii")
+    return {"role": "user", "content": [
+        {"type": "text", "text": f"第{turn}张图片里有什么？"},
+        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{data}"}},
+    ]}
+
+
+async def run(config: str, args, proxy_url: str, upstream_url: str, sampler: ProcessSampler):
+    headers = {"authorization": f"Bearer {args.api_key}"}
+    messages = []
+    totals = {"request_bytes": 0, "uploaded_bytes": 0}
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=120.0) as client, \
+            httpx.AsyncClient(timeout=10.0) as monitor:
+        for turn in range(1, args.turns + 1):
+            messages.append(image_message(turn, args.image_kb))
+            before = (await monitor.get(f"{upstream_url}/stats")).json()
+            begin = time.perf_counter()
+            response = await client.post(
+                "/v1/chat/completions", headers=headers,
+                json={"model": "gemini-fake", "messages": messages}
+            )
+            elapsed = time.perf_counter() - begin
+            assert response.status_code == 200, (response.status_code, response.text[:200])
+            messages.append(response.json()["choices"][0]["message"])
+            after = (await monitor.get(f"{upstream_url}/stats")).json()
+            request_bytes = after["request_bytes"] - before["request_bytes"]
+            uploaded = after["uploaded_bytes"] - before["uploaded_bytes"]
+            totals["request_bytes"] += request_bytes
+            totals["uploaded_bytes"] += uploaded
+            rss = sampler.rss_mb()
+            print(
+                f"{config:<8} {turn:>4} {request_bytes / 1024:>12.1f} {uploaded / 1024:>11.1f} "
+                f"{elapsed * 1000:>9.1f}ms {rss:>8.1f}"
+            )
+    print(
+        f"{config:<8} total request={totals['request_bytes'] / 1024 / 1024:.2f}MB "
+        f"uploaded={totals['uploaded_bytes'] / 1024 / 1024:.2f}MB"
+    )
+
+
+async def main_async(args):
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    upstream = spawn(["-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port), "--latency-ms", "0"])
+    try:
+        await wait_ready(f"{upstream_url}/stats")
+        print(f"{'config':<8} {'turn':>4} {'request KB':>12} {'upload KB':>11} {'latency':>11} {'RSS MB':>8}")
+        for config, env in CONFIGS.items():
+            proxy = spawn(
+                ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+                {"UPSTREAM_BASE_URL": upstream_url, **env}
+            )
+            try:
+                await wait_ready(f"{proxy_url}/health")
+                await run(config, args, proxy_url, upstream_url, ProcessSampler(proxy.pid))
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--image-kb", type=int, default=1024, help="每张图片的大小（KB）")
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9120)
+    parser.add_argument("--proxy-port", type=int, default=9121)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+模拟一段逐轮增长的对话（每轮追加一条assistant回复和一条user消息并重发完整历史），
+对比关闭与开启历史前缀缓存时每轮的转换耗时。历史中包含工具调用往返和内联图像（data URI）。
+
+用法：python -m benchmarks.bench_history [--turns 500] [--report 10,50,100,250,500]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+
+from app.services.converter import converter
+from app.services.history_cache import history_cache
+
+
+IMAGE = "data:image/png;base64," + base64.b64encode(os.urandom(150 * 1024)).decode()
+
+
+def turn_messages(turn: int):
+    if turn % 25 == 0:
+        return [
+            {"role": "assistant", "content": f"answer {turn}: " + "dolor sit amet " * 30},
+            {"role": "user", "content": [
+                {"type": "text", "text": f"what is in this image? ({turn})"},
+                {"type": "image_url", "image_url": {"url": IMAGE[:-8] + f"{turn:08d}"}},
+            ]},
+        ]
+    if turn % 10 == 9:
+        return [
+            {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [{
+                    "id": f"call_{turn}",
+                    "type": "function",
+                    "function": {"name": "search", "arguments": json.dumps({"query": f"topic {turn}", "limit": 10})}
+                }]
+            },
+            {"role": "tool", "tool_call_id": f"call_{turn}", "content": "result " * 50},
+        ]
+    return [
+        {"role": "assistant", "content": f"answer {turn}: " + "dolor sit amet " * 30},
+        {"role": "user", "content": f"question {turn}: " + "lorem ipsum " * 20},
+    ]
+
+
+async def simulate(turns: int, report):
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "hello"},
+    ]
+    timings = {}
+    for turn in range(1, turns + 1):
+        messages.extend(turn_messages(turn))
+        request = {"model": "gemini-1.5-flash", "messages": list(messages)}
+        begin = time.perf_counter()
+        await converter.openai_to_gemini(request)
+        if turn in report:
+            timings[turn] = (len(messages), time.perf_counter() - begin)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--report", default="10,50,100,250,500")
+    args = parser.parse_args()
+    report = {int(value) for value in args.report.split(",")}
+
+    max_bytes = history_cache.max_bytes or 64 * 1024 * 1024
+    history_cache.max_bytes = 0
+    off = asyncio.run(simulate(args.turns, report))
+    history_cache.max_bytes = max_bytes
+    on = asyncio.run(simulate(args.turns, report))
+
+    print(f"{'turn':>6} {'messages':>9} {'no cache':>12} {'prefix cache':>14} {'speedup':>8}")
+    for turn in sorted(off):
+        length, slow = off[turn]
+        _, fast = on[turn]
+        print(f"{turn:>6} {length:>9} {slow * 1e3:>10.3f}ms {fast * 1e3:>12.3f}ms {slow / fast:>7.2f}x")
+    print(f"cache: {history_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
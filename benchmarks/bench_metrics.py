@@ -0,0 +1,73 @@
+"""
+测量指标记录的开销：单次操作耗时，以及 MetricsMiddleware 包装一个请求的额外耗时。
+
+用法：python -m benchmarks.bench_metrics [--iterations 200000]
+"""
+import argparse
+import asyncio
+import time
+
+from app.core.metrics import (
+    CONVERT_DURATION, INFLIGHT_STREAMS, REQUEST_DURATION, REQUESTS, UPSTREAM_TTFB, MetricsMiddleware
+)
+
+
+def per_call(fn, iterations):
+    begin = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - begin) / iterations * 1e6
+
+
+async def asgi_app(scope, receive, send):
+    await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"x" * 64, "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def per_request(app, iterations):
+    scope = {"type": "http", "path": "/v1/chat/completions", "state": {"model": "gemini-fake"}}
+    request_message = {"type": "http.request", "body": b"{}", "more_body": False}
+
+    async def receive():
+        return request_message
+
+    async def send(message):
+        pass
+
+    begin = time.perf_counter()
+    for _ in range(iterations):
+        await app(scope, receive, send)
+    return (time.perf_counter() - begin) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+    n = args.iterations
+
+    counter = REQUESTS.labels("/v1/chat/completions", "gemini-fake", "200")
+    histogram = REQUEST_DURATION.labels("/v1/chat/completions", "gemini-fake", "200")
+    chunk_timer = CONVERT_DURATION.labels("chunk")
+
+    def timed():
+        with chunk_timer.time():
+            pass
+
+    print(f"counter.inc                {per_call(counter.inc, n):7.3f} us")
+    print(f"histogram.observe          {per_call(lambda: histogram.observe(0.0123), n):7.3f} us")
+    print(f"labels().inc               {per_call(lambda: REQUESTS.labels('/v1/models', '', '200').inc(), n):7.3f} us")
+    print(f"labels().observe           {per_call(lambda: UPSTREAM_TTFB.labels('200').observe(0.05), n):7.3f} us")
+    print(f"gauge inc+dec              {per_call(lambda: (INFLIGHT_STREAMS.inc(), INFLIGHT_STREAMS.dec()), n):7.3f} us")
+    print(f"histogram timer            {per_call(timed, n):7.3f} us")
+
+    bare = asyncio.run(per_request(asgi_app, n // 4))
+    wrapped = asyncio.run(per_request(MetricsMiddleware(asgi_app), n // 4))
+    print(f"ASGI request (bare)        {bare:7.3f} us")
+    print(f"ASGI request (middleware)  {wrapped:7.3f} us  (+{wrapped - bare:.3f} us/request)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+对比上游连接池使用 HTTP/1.1 与 HTTP/2 时，在不同并发下的吞吐、延迟和建立的连接数。
+
+默认在子进程中用 hypercorn 启动模拟上游（明文 h2c，需要 pip install hypercorn httpx[http2]）；
+也可以用 --upstream-url 指定已运行的上游（HTTPS 上游通过 ALPN 协商 HTTP/2）。
+
+用法：python -m benchmarks.bench_pool [--concurrency 10,100,500] [--requests 2000]
+"""
+import argparse
+import asyncio
+import collections
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from app.services.upstream_pool import HTTP2_AVAILABLE, build_client
+from benchmarks.fake_upstream import UpstreamConfig, create_app
+from benchmarks.loadgen import percentile, wait_ready
+
+
+def connection_count(client) -> int:
+    pool = client._transport._pool
+    return len(pool.connections)
+
+
+async def run(base_url: str, http2: bool, concurrency: int, total: int, args) -> Dict:
+    client = build_client(
+        base_url, max_connections=args.max_connections, max_keepalive=args.max_connections,
+        keepalive_expiry=30.0, timeout=60.0, connect_timeout=10.0,
+        http2=http2, http2_prior_knowledge=http2 and base_url.startswith("http://")
+    )
+    path = f"/v1beta/models/gemini-fake:{'streamGenerateContent' if args.stream else 'generateContent'}"
+    body = {"contents": [{"role": "user", "parts": [{"text": "hello"}]}]}
+    headers = {"x-goog-api-key": args.api_key}
+    latencies: List[float] = []
+    errors = collections.Counter()
+    remaining = total
+    peak_connections = 0
+
+    async def worker():
+        nonlocal remaining, peak_connections
+        while remaining > 0:
+            remaining -= 1
+            begin = time.perf_counter()
+            try:
+                async with client.stream("POST", path, json=body, headers=headers) as response:
+                    await response.aread()
+                    error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+            except Exception as exc:
+                error = type(exc).__name__
+            peak_connections = max(peak_connections, connection_count(client))
+            if error is None:
+                latencies.append(time.perf_counter() - begin)
+            else:
+                errors[error] += 1
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - begin
+    await client.aclose()
+    return {
+        "protocol": "h2" if http2 else "h1",
+        "concurrency": concurrency,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+        "connections": peak_connections,
+        "errors": dict(errors),
+    }
+
+
+async def serve(args):
+    """子进程：用 hypercorn 运行模拟上游（同时支持 HTTP/1.1 和明文 HTTP/2）。"""
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{args.port}"]
+    config.loglevel = "warning"
+    # 允许单个HTTP/2连接承载的并发流数不低于压测并发
+    config.h2_max_concurrent_streams = max(int(value) for value in args.concurrency.split(","))
+    # hypercorn 默认每个连接处理1000个请求后发送GOAWAY，会让HTTP/2下的在途请求失败
+    config.keep_alive_max_requests = 10 ** 9
+    app = create_app(UpstreamConfig(latency_ms=args.latency_ms, chunks=args.chunks, chunk_interval_ms=0))
+    await hypercorn_serve(app, config)
+
+
+async def main_async(args):
+    server = None
+    base_url = args.upstream_url
+    if base_url is None:
+        server = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_pool", "--serve", *sys.argv[1:]])
+        base_url = f"http://127.0.0.1:{args.port}"
+        await wait_ready(f"{base_url}/stats")
+
+    try:
+        print(f"{'proto':<6} {'c':>5} {'rps':>9} {'p50':>9} {'p99':>9} {'conns':>6}  errors")
+        for concurrency in (int(value) for value in args.concurrency.split(",")):
+            for http2 in (False, True):
+                result = await run(base_url, http2, concurrency, args.requests, args)
+                print(
+                    f"{result['protocol']:<6} {concurrency:>5} {result['rps']:>9.1f} "
+                    f"{result['p50_ms']:>7.1f}ms {result['p99_ms']:>7.1f}ms "
+                    f"{result['connections']:>6}  {result['errors'] or '-'}"
+                )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="10,100,500")
+    parser.add_argument("--requests", type=int, default=2000, help="每个组合发送的请求数")
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--stream", action="store_true", help="使用 streamGenerateContent")
+    parser.add_argument("--upstream-url", help="使用已运行的上游，而不是启动模拟上游")
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--chunks", type=int, default=5)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        asyncio.run(serve(args))
+        return
+    if not HTTP2_AVAILABLE:
+        parser.error("需要安装 h2：pip install httpx[http2]")
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+对比非流式聊天补全在上游偶发5xx和长尾延迟下，不重试、重试、重试+对冲时的成功率、尾延迟和上游请求放大倍数。
+
+模拟上游首字节延迟 50ms，其中 --tail-rate 的请求延迟 --tail-ms，--error-rate 的请求返回503。
+依次以三种配置启动代理：
+  none    RETRY_MAX_ATTEMPTS=1
+  retry   RETRY_MAX_ATTEMPTS=3（指数退避+抖动）
+  hedge   RETRY_MAX_ATTEMPTS=3, HEDGE_ENABLED=true（超过近期 p95 仍未返回时发起对冲）
+所有请求带 x-gapi-deadline-ms 截止时间预算（默认1500ms，短于长尾延迟），超时的请求返回504。
+
+用法：python -m benchmarks.bench_retry [--requests 1000] [--concurrency 20] [--deadline-ms 1500]
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from typing import List
+
+import httpx
+
+from benchmarks.bench_disconnect import parse_metrics
+from benchmarks.loadgen import percentile, spawn, wait_ready
+
+CONFIGS = {
+    "none": {"RETRY_MAX_ATTEMPTS": "1"},
+    "retry": {"RETRY_MAX_ATTEMPTS": "3"},
+    "hedge": {"RETRY_MAX_ATTEMPTS": "3", "HEDGE_ENABLED": "true", "HEDGE_MAX_RATIO": "0.1"},
+}
+
+
+def metric_sum(metrics, prefix: str, label: str = "") -> float:
+    return sum(value for name, value in metrics.items() if name.startswith(prefix) and label in name)
+
+
+async def run(config: str, args, proxy_url: str, upstream_url: str):
+    headers = {"authorization": f"Bearer {args.api_key}", "x-gapi-deadline-ms": str(args.deadline_ms)}
+    body = {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}]}
+    latencies: List[float] = []
+    statuses = Counter()
+    remaining = args.requests
+
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=60.0) as client, \
+            httpx.AsyncClient(timeout=10.0) as monitor:
+        # 预热：积累对冲阈值所需的延迟样本
+        for _ in range(args.warmup):
+            await client.post("/v1/chat/completions", json=body, headers=headers)
+        upstream_before = (await monitor.get(f"{upstream_url}/stats")).json()["requests"]
+        metrics_before = parse_metrics((await monitor.get(f"{proxy_url}/metrics")).text)
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                begin = time.perf_counter()
+                response = await client.post("/v1/chat/completions", json=body, headers=headers)
+                statuses[response.status_code] += 1
+                latencies.append(time.perf_counter() - begin)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        upstream_after = (await monitor.get(f"{upstream_url}/stats")).json()["requests"]
+        metrics = parse_metrics((await monitor.get(f"{proxy_url}/metrics")).text)
+
+    def delta(prefix: str, label: str = "") -> float:
+        return metric_sum(metrics, prefix, label) - metric_sum(metrics_before, prefix, label)
+
+    ok = statuses.get(200, 0)
+    others = " ".join(f"{status}={count}" for status, count in sorted(statuses.items()) if status != 200)
+    print(
+        f"{config:<6} ok={ok / args.requests * 100:5.1f}% p50={percentile(latencies, 50) * 1000:5.0f}ms "
+        f"p95={percentile(latencies, 95) * 1000:5.0f}ms p99={percentile(latencies, 99) * 1000:5.0f}ms "
+        f"upstream/request={(upstream_after - upstream_before) / args.requests:.2f} "
+        f"retries={delta('gapi_upstream_retries_total'):.0f} "
+        f"hedges={delta('gapi_upstream_hedges_total', 'fired'):.0f}"
+        f"(won={delta('gapi_upstream_hedges_total', 'won'):.0f}) {others}"
+    )
+
+
+async def main_async(args):
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    upstream = spawn([
+        "-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port), "--latency-ms", "50",
+        "--tail-rate", str(args.tail_rate), "--tail-latency-ms", str(args.tail_ms),
+        "--error-rate", str(args.error_rate), "--error-status", "503",
+    ])
+    try:
+        await wait_ready(f"{upstream_url}/stats")
+        for config, env in CONFIGS.items():
+            proxy = spawn(
+                ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+                {"UPSTREAM_BASE_URL": upstream_url, **env}
+            )
+            try:
+                await wait_ready(f"{proxy_url}/health")
+                await run(config, args, proxy_url, upstream_url)
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--deadline-ms", type=int, default=1500)
+    parser.add_argument("--tail-rate", type=float, default=0.03)
+    parser.add_argument("--tail-ms", type=float, default=3000.0)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9160)
+    parser.add_argument("--proxy-port", type=int, default=9161)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
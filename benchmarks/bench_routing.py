@@ -0,0 +1,148 @@
+"""
+多上游路由：在延迟和故障各不相同的多个模拟上游之间，检查目标选择、故障摘除、恢复和模型回退。
+
+启动三个模拟上游端点：
+  fast   首字节延迟 20ms
+  slow   首字节延迟 150ms
+  flaky  首字节延迟 20ms，30% 的请求返回503
+三个端点上的 gemini-pro-fake 模型都总是返回503（模拟模型过载）。路由规则：
+  gemini-fake      = fast | slow | flaky
+  gemini-pro-fake  = fast | slow | fast:gemini-fake
+依次运行以下阶段，统计客户端成功率、延迟和各端点收到的请求数：
+  baseline  对照：代理只指向 flaky（单上游，无回退）
+  steady    正常情况下的选择（应主要落在 fast，flaky 的错误被回退掩盖）
+  outage    fast 故障（所有接口返回503），流量应转到其他端点
+  recovery  fast 恢复，主动健康检查通过后流量应回到 fast
+  model     请求 gemini-pro-fake，应全部回退到 gemini-fake 成功
+
+用法：python -m benchmarks.bench_routing [--requests 400] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.bench_disconnect import parse_metrics
+from benchmarks.loadgen import percentile, spawn, wait_ready
+
+UPSTREAMS = {
+    "fast": ["--latency-ms", "20"],
+    "slow": ["--latency-ms", "150"],
+    "flaky": ["--latency-ms", "20", "--error-rate", "0.3", "--error-status", "503"],
+}
+
+
+async def upstream_requests(client: httpx.AsyncClient, urls: Dict[str, str]) -> Dict[str, int]:
+    return {name: (await client.get(f"{url}/stats")).json()["requests"] for name, url in urls.items()}
+
+
+async def run_phase(name: str, model: str, args, proxy_url: str, urls: Dict[str, str], monitor: httpx.AsyncClient):
+    headers = {"authorization": f"Bearer {args.api_key}"}
+    body = {"model": model, "messages": [{"role": "user", "content": "hello"}]}
+    latencies: List[float] = []
+    served_models = set()
+    errors = 0
+    remaining = args.requests
+    before = await upstream_requests(monitor, urls)
+    metrics_before = parse_metrics((await monitor.get(f"{proxy_url}/metrics")).text)
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            begin = time.perf_counter()
+            response = await client.post("/v1/chat/completions", json=body, headers=headers)
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - begin)
+                served_models.add(response.json()["model"])
+            else:
+                errors += 1
+
+    async with httpx.AsyncClient(base_url=proxy_url, timeout=60.0) as client:
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+
+    after = await upstream_requests(monitor, urls)
+    metrics_after = parse_metrics((await monitor.get(f"{proxy_url}/metrics")).text)
+    fallbacks = sum(
+        value - metrics_before.get(key, 0) for key, value in metrics_after.items()
+        if key.startswith("gapi_upstream_fallbacks_total")
+    )
+    distribution = " ".join(f"{upstream}={after[upstream] - before[upstream]}" for upstream in urls)
+    p50 = percentile(latencies, 50) or 0.0
+    p99 = percentile(latencies, 99) or 0.0
+    print(
+        f"{name:<9} ok={len(latencies)}/{args.requests} p50={p50 * 1000:.0f}ms p99={p99 * 1000:.0f}ms "
+        f"fallbacks={fallbacks:.0f} upstream[{distribution}] model={','.join(sorted(served_models))}"
+    )
+    return errors
+
+
+async def main_async(args):
+    urls = {name: f"http://127.0.0.1:{args.upstream_port + index}" for index, name in enumerate(UPSTREAMS)}
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    processes = [
+        spawn(["-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port + index),
+               "--failing-models", "gemini-pro-fake", *extra])
+        for index, extra in enumerate(UPSTREAMS.values())
+    ]
+    routing_env = {
+        "UPSTREAM_BASE_URL": urls["fast"],
+        "UPSTREAM_ENDPOINTS": ",".join(f"{name}={url}" for name, url in urls.items()),
+        "MODEL_ROUTES": "gemini-fake=fast|slow|flaky;gemini-pro-fake=fast|slow|fast:gemini-fake",
+        "UPSTREAM_HEALTH_CHECK_INTERVAL": "1",
+        "UPSTREAM_EJECT_SECONDS": "2",
+    }
+    try:
+        async with httpx.AsyncClient(timeout=10.0) as monitor:
+            for url in urls.values():
+                await wait_ready(f"{url}/stats")
+
+            proxy = spawn(
+                ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+                {"UPSTREAM_BASE_URL": urls["flaky"]}
+            )
+            try:
+                await wait_ready(f"{proxy_url}/health")
+                await run_phase("baseline", "gemini-fake", args, proxy_url, urls, monitor)
+            finally:
+                proxy.terminate()
+                proxy.wait()
+
+            proxy = spawn(
+                ["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"],
+                routing_env
+            )
+            try:
+                await wait_ready(f"{proxy_url}/health")
+                await run_phase("steady", "gemini-fake", args, proxy_url, urls, monitor)
+                await monitor.patch(f"{urls['fast']}/config", json={"down": True})
+                await run_phase("outage", "gemini-fake", args, proxy_url, urls, monitor)
+                await monitor.patch(f"{urls['fast']}/config", json={"down": False})
+                # 等待主动健康检查和被动摘除到期
+                await asyncio.sleep(3.0)
+                await run_phase("recovery", "gemini-fake", args, proxy_url, urls, monitor)
+                await run_phase("model", "gemini-pro-fake", args, proxy_url, urls, monitor)
+            finally:
+                proxy.terminate()
+                proxy.wait()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400, help="每个阶段的请求数")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--upstream-port", type=int, default=9140, help="三个模拟上游依次使用从该端口开始的端口")
+    parser.add_argument("--proxy-port", type=int, default=9150)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
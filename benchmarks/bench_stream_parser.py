@@ -0,0 +1,105 @@
+"""
+对比旧的缓冲区重扫描循环与增量解析器在多MB流上的耗时。
+
+用法：python -m benchmarks.bench_stream_parser [--size-mb 4] [--chunk 512]
+"""
+import argparse
+import json
+import time
+
+from app.services.stream_parser import JSONArrayStreamParser, SSEStreamParser
+
+
+def legacy_parse(chunks):
+    """旧版 stream_generator 中的解析循环（仅保留解析部分）。"""
+    count = 0
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            start = buffer.find('{')
+            if start == -1:
+                break
+            brace_count = 0
+            end = -1
+            for i, char in enumerate(buffer[start:], start):
+                if char == '{':
+                    brace_count += 1
+                elif char == '}':
+                    brace_count -= 1
+                    if brace_count == 0:
+                        end = i + 1
+                        break
+            if end != -1:
+                json_str = buffer[start:end]
+                buffer = buffer[end:]
+                try:
+                    json.loads(json_str)
+                    count += 1
+                except json.JSONDecodeError:
+                    pass
+            else:
+                break
+    return count
+
+
+def incremental_parse(chunks, parser_cls=JSONArrayStreamParser):
+    parser = parser_cls()
+    count = 0
+    for chunk in chunks:
+        count += len(parser.feed(chunk))
+    return count
+
+
+def make_stream(size_mb, text_len, sse=False):
+    """生成模拟的上游响应：每个对象携带一段包含括号和转义的文本。"""
+    text = ("def f(x): return {'a': [x]}  # \"quoted\" \\ " * (text_len // 40 + 1))[:text_len]
+    obj = json.dumps({
+        "candidates": [{
+            "content": {"parts": [{"text": text}], "role": "model"},
+            "index": 0
+        }]
+    })
+    target = size_mb * 1024 * 1024
+    if sse:
+        frame = f"data: {obj}\r\n\r\n"
+        return frame * max(1, target // len(frame))
+    n = max(1, target // (len(obj) + 3))
+    return "[" + ",\r\n".join([obj] * n) + "]", n
+
+
+def split(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def bench(name, fn, chunks, total_bytes):
+    begin = time.perf_counter()
+    count = fn(chunks)
+    elapsed = time.perf_counter() - begin
+    print(f"{name:<14} objects={count:<8} {elapsed * 1000:9.1f} ms  "
+          f"{total_bytes / elapsed / 1024 / 1024:8.1f} MB/s")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=4)
+    parser.add_argument("--chunk", type=int, default=512, help="上游分块大小（字符）")
+    parser.add_argument("--text-len", type=int, default=64 * 1024, help="每个对象的文本长度")
+    args = parser.parse_args()
+
+    data, expected = make_stream(args.size_mb, args.text_len)
+    chunks = split(data, args.chunk)
+    print(f"JSON数组流: {len(data) / 1024 / 1024:.1f} MB, {len(chunks)} 个分块, {expected} 个对象")
+    bench("legacy", legacy_parse, chunks, len(data))
+    got = bench("incremental", incremental_parse, chunks, len(data))
+    assert got == expected, f"incremental parser returned {got} objects, expected {expected}"
+
+    sse_data = make_stream(args.size_mb, args.text_len, sse=True)
+    sse_chunks = split(sse_data, args.chunk)
+    print(f"SSE流: {len(sse_data) / 1024 / 1024:.1f} MB, {len(sse_chunks)} 个分块")
+    bench("sse", lambda c: incremental_parse(c, SSEStreamParser), sse_chunks, len(sse_data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+本地模拟的 generativelanguage.googleapis.com，用于基准测试和故障注入。
+实现了模型列表、generateContent/streamGenerateContent、batchEmbedContents、cachedContents
+和 Files API（可恢复上传、查询、删除）接口。PATCH /config 可在运行中修改延迟、错误注入等参数，
+down 为真时所有接口（包括健康检查用的 /）返回503。
+
+用法：python -m benchmarks.fake_upstream --port 9000 --latency-ms 200 --chunks 50 --chunk-interval-ms 20
+然后以 UPSTREAM_BASE_URL=http://127.0.0.1:9000 启动代理。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Set
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+@dataclass
+class UpstreamConfig:
+    # 首字节前的延迟；按 tail_rate 的概率改为 tail_latency_ms（模拟长尾）
+    latency_ms: float = 50.0
+    tail_rate: float = 0.0
+    tail_latency_ms: float = 1000.0
+    # 流式响应的分块数与分块间隔
+    chunks: int = 20
+    chunk_interval_ms: float = 10.0
+    # 每个分块（及非流式响应）携带的文本长度
+    chunk_chars: int = 64
+    # 按概率注入错误
+    error_rate: float = 0.0
+    error_status: int = 429
+    # 嵌入向量维度
+    embedding_dims: int = 768
+    # 这些密钥总是返回429
+    exhausted_keys: Set[str] = field(default_factory=set)
+    # 这些模型总是返回503（模拟单个模型过载）
+    failing_models: Set[str] = field(default_factory=set)
+    # 模拟端点故障：所有接口返回503
+    down: bool = False
+    models: int = 20
+    # 文本内容：x 为重复字符（极易压缩），words 为随机单词（压缩率接近真实文本）
+    text: str = "x"
+    # 客户端接受 gzip 时压缩响应（与真实上游一致）
+    gzip: bool = False
+
+
+def _candidate(text: str, finish: bool = False) -> dict:
+    candidate = {
+        "content": {"parts": [{"text": text}], "role": "model"},
+        "index": 0
+    }
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate]}
+
+
+_WORDS = (
+    "the model returns a response with several candidates and each candidate contains parts "
+    "that describe text function calls safety ratings citations tokens usage metadata for "
+    "request prompt output streaming latency proxy upstream gemini openai compatible json"
+).split()
+
+
+def _filler(config: UpstreamConfig) -> str:
+    """预先生成响应文本，按需截取。"""
+    length = config.chunk_chars * max(1, config.chunks)
+    if config.text != "words":
+        return "x" * length
+    rng = random.Random(0)
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(_WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+
+def _error(status: int) -> JSONResponse:
+    reason = "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"code": status, "message": "injected error", "status": reason}}
+    )
+
+
+def create_app(config: UpstreamConfig) -> FastAPI:
+    app = FastAPI()
+    app.state.config = config
+    if config.gzip:
+        from starlette.middleware.gzip import GZipMiddleware
+        app.add_middleware(GZipMiddleware, minimum_size=500)
+    filler = _filler(config)
+    app.state.requests = 0
+    app.state.embedded = 0
+    # 正在输出的流式响应数，用于确认代理在客户端断开后关闭了上游连接
+    app.state.streaming = 0
+    # cachedContents 资源：name -> (资源内容, 过期时间)
+    app.state.cached_contents = {}
+    # Files API：进行中的可恢复上传和已上传文件的元数据（不保存文件内容）
+    app.state.uploads = {}
+    app.state.files = {}
+    app.state.uploaded_bytes = 0
+    # 生成请求的请求体字节数，用于比较发往上游的负载大小
+    app.state.request_bytes = 0
+
+    def first_byte_delay() -> float:
+        if config.tail_rate and random.random() < config.tail_rate:
+            return config.tail_latency_ms / 1000
+        return config.latency_ms / 1000
+
+    def injected_error(request: Request, model: str = None):
+        app.state.requests += 1
+        if config.down or model in config.failing_models:
+            return _error(503)
+        key = request.headers.get("x-goog-api-key") or request.query_params.get("key")
+        if key in config.exhausted_keys:
+            return _error(429)
+        if config.error_rate and random.random() < config.error_rate:
+            return _error(config.error_status)
+        return None
+
+    @app.get("/v1beta/models")
+    async def list_models(request: Request):
+        error = injected_error(request)
+        if error is not None:
+            return error
+        await asyncio.sleep(config.latency_ms / 1000)
+        return {"models": [{"name": f"models/gemini-fake-{i}"} for i in range(config.models)]}
+
+    def missing_reference(body: bytes):
+        """请求引用了不存在或已过期的 cachedContent 时返回404，引用了不存在的文件时返回403（与真实上游一致）。"""
+        app.state.request_bytes += len(body)
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return None
+        name = payload.get("cachedContent")
+        if name is not None:
+            entry = app.state.cached_contents.get(name)
+            if entry is None or entry[1] < time.time():
+                return JSONResponse(status_code=404, content={"error": {"code": 404, "message": f"{name} not found", "status": "NOT_FOUND"}})
+        for content in payload.get("contents") or ():
+            for part in content.get("parts") or ():
+                file_data = part.get("file_data") or part.get("fileData")
+                if file_data is None:
+                    continue
+                uri = file_data.get("file_uri") or file_data.get("fileUri") or ""
+                if uri.split("/v1beta/", 1)[-1] not in app.state.files:
+                    return JSONResponse(status_code=403, content={"error": {
+                        "code": 403, "message": f"You do not have permission to access the File {uri} or it may not exist.",
+                        "status": "PERMISSION_DENIED"
+                    }})
+        return None
+
+    def parse_ttl(value) -> float:
+        return float(str(value or "3600s").rstrip("s"))
+
+    @app.post("/v1beta/cachedContents")
+    async def create_cached_content(request: Request):
+        error = injected_error(request)
+        if error is not None:
+            return error
+        body = await request.json()
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        expires_at = time.time() + parse_ttl(body.get("ttl"))
+        app.state.cached_contents[name] = (body, expires_at)
+        return {"name": name, "model": body.get("model"), "expireTime": expires_at}
+
+    @app.patch("/v1beta/cachedContents/{cache_id}")
+    async def update_cached_content(cache_id: str, request: Request):
+        name = f"cachedContents/{cache_id}"
+        if name not in app.state.cached_contents:
+            return _error(404)
+        body = await request.json()
+        content, _ = app.state.cached_contents[name]
+        expires_at = time.time() + parse_ttl(body.get("ttl"))
+        app.state.cached_contents[name] = (content, expires_at)
+        return {"name": name, "expireTime": expires_at}
+
+    @app.get("/v1beta/cachedContents/{cache_id}")
+    async def get_cached_content(cache_id: str):
+        name = f"cachedContents/{cache_id}"
+        if name not in app.state.cached_contents:
+            return _error(404)
+        content, expires_at = app.state.cached_contents[name]
+        return {"name": name, "model": content.get("model"), "expireTime": expires_at}
+
+    @app.delete("/v1beta/cachedContents/{cache_id}")
+    async def delete_cached_content(cache_id: str):
+        app.state.cached_contents.pop(f"cachedContents/{cache_id}", None)
+        return {}
+
+    @app.post("/upload/v1beta/files")
+    async def upload_file(request: Request):
+        """可恢复上传：start 返回上传地址，upload, finalize 一次提交全部内容。"""
+        error = injected_error(request)
+        if error is not None:
+            return error
+        command = request.headers.get("x-goog-upload-command", "")
+        if command == "start":
+            upload_id = uuid.uuid4().hex
+            app.state.uploads[upload_id] = {
+                "mime_type": request.headers.get("x-goog-upload-header-content-type", "application/octet-stream"),
+                "size": int(request.headers.get("x-goog-upload-header-content-length") or 0),
+            }
+            upload_url = str(request.url.replace(query=f"upload_id={upload_id}&upload_protocol=resumable"))
+            return Response(headers={"x-goog-upload-url": upload_url, "x-goog-upload-status": "active"})
+        if "upload" in command and "finalize" in command:
+            upload = app.state.uploads.pop(request.query_params.get("upload_id"), None)
+            if upload is None:
+                return _error(404)
+            data = await request.body()
+            if len(data) != upload["size"]:
+                return JSONResponse(status_code=400, content={"error": {"code": 400, "message": "size mismatch", "status": "INVALID_ARGUMENT"}})
+            name = f"files/{uuid.uuid4().hex[:12]}"
+            expires = time.gmtime(time.time() + 48 * 3600)
+            app.state.files[name] = {
+                "name": name,
+                "mimeType": upload["mime_type"],
+                "sizeBytes": str(len(data)),
+                "uri": f"{request.base_url}v1beta/{name}",
+                "state": "ACTIVE",
+                "expirationTime": time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", expires),
+            }
+            app.state.uploaded_bytes += len(data)
+            return {"file": app.state.files[name]}
+        return JSONResponse(status_code=400, content={"error": {"code": 400, "message": f"unsupported command {command!r}", "status": "INVALID_ARGUMENT"}})
+
+    @app.get("/v1beta/files/{file_id}")
+    async def get_file(file_id: str):
+        file = app.state.files.get(f"files/{file_id}")
+        if file is None:
+            return _error(404)
+        return file
+
+    @app.delete("/v1beta/files/{file_id}")
+    async def delete_file(file_id: str):
+        app.state.files.pop(f"files/{file_id}", None)
+        return {}
+
+    @app.post("/v1beta/models/{model}:generateContent")
+    async def generate_content(model: str, request: Request):
+        body = await request.body()
+        missing = missing_reference(body)
+        if missing is not None:
+            return missing
+        error = injected_error(request, model)
+        if error is not None:
+            return error
+        await asyncio.sleep(first_byte_delay())
+        return _candidate(filler[:config.chunk_chars * config.chunks], finish=True)
+
+    @app.post("/v1beta/models/{model}:streamGenerateContent")
+    async def stream_generate_content(model: str, request: Request):
+        body = await request.body()
+        missing = missing_reference(body)
+        if missing is not None:
+            return missing
+        error = injected_error(request, model)
+        if error is not None:
+            return error
+        sse = request.query_params.get("alt") == "sse"
+
+        async def body():
+            app.state.streaming += 1
+            try:
+                await asyncio.sleep(first_byte_delay())
+                if not sse:
+                    yield "["
+                for i in range(config.chunks):
+                    if i:
+                        await asyncio.sleep(config.chunk_interval_ms / 1000)
+                    start = (i * config.chunk_chars) % max(1, len(filler) - config.chunk_chars + 1)
+                    text = filler[start:start + config.chunk_chars]
+                    obj = json.dumps(_candidate(text, finish=i == config.chunks - 1))
+                    if sse:
+                        yield f"data: {obj}\r\n\r\n"
+                    else:
+                        yield obj if i == 0 else f",\r\n{obj}"
+                if not sse:
+                    yield "]"
+            finally:
+                app.state.streaming -= 1
+
+        media_type = "text/event-stream" if sse else "application/json"
+        return StreamingResponse(body(), media_type=media_type)
+
+    @app.post("/v1beta/models/{model}:batchEmbedContents")
+    async def batch_embed_contents(model: str, request: Request):
+        body = await request.json()
+        error = injected_error(request)
+        if error is not None:
+            return error
+        await asyncio.sleep(config.latency_ms / 1000)
+        app.state.embedded += len(body["requests"])
+        embeddings = []
+        for item in body["requests"]:
+            dims = item.get("outputDimensionality") or config.embedding_dims
+            seed = float(len(item["content"]["parts"][0].get("text", "")))
+            embeddings.append({"values": [seed] * dims})
+        return {"embeddings": embeddings}
+
+    @app.api_route("/", methods=["GET", "HEAD"])
+    async def root():
+        return Response(status_code=503 if config.down else 200)
+
+    @app.patch("/config")
+    async def update_config(request: Request):
+        """修改运行中的参数，例如 {"latency_ms": 200, "error_rate": 0.5, "down": true}。"""
+        for name, value in (await request.json()).items():
+            if name in ("exhausted_keys", "failing_models"):
+                value = set(value)
+            setattr(config, name, value)
+        return {}
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            "requests": app.state.requests,
+            "embedded": app.state.embedded,
+            "streaming": app.state.streaming,
+            "cached_contents": len(app.state.cached_contents),
+            "files": len(app.state.files),
+            "uploaded_bytes": app.state.uploaded_bytes,
+            "request_bytes": app.state.request_bytes,
+        }
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="首字节延迟为 --tail-latency-ms 的请求比例")
+    parser.add_argument("--tail-latency-ms", type=float, default=1000.0)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-interval-ms", type=float, default=10.0)
+    parser.add_argument("--chunk-chars", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--exhausted-keys", default="", help="逗号分隔，总是返回429的密钥")
+    parser.add_argument("--failing-models", default="", help="逗号分隔，总是返回503的模型")
+    parser.add_argument("--text", choices=("x", "words"), default="x", help="响应文本：重复字符或随机单词")
+    parser.add_argument("--gzip", action="store_true", help="客户端接受时gzip压缩响应")
+
+
+def config_from_args(args: argparse.Namespace) -> UpstreamConfig:
+    return UpstreamConfig(
+        latency_ms=args.latency_ms,
+        tail_rate=args.tail_rate,
+        tail_latency_ms=args.tail_latency_ms,
+        chunks=args.chunks,
+        chunk_interval_ms=args.chunk_interval_ms,
+        chunk_chars=args.chunk_chars,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        exhausted_keys={key for key in args.exhausted_keys.split(",") if key},
+        failing_models={model for model in args.failing_models.split(",") if model},
+        text=args.text,
+        gzip=args.gzip,
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    # 空闲连接保持时间长于代理连接池的 UPSTREAM_KEEPALIVE_EXPIRY（与真实上游一致），
+    # 否则代理复用恰好被上游关闭的空闲连接时会偶发 ReadError
+    uvicorn.run(
+        create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning", timeout_keep_alive=75
+    )
+
+
+if __name__ == "__main__":
+    main()
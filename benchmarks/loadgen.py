@@ -0,0 +1,339 @@
+"""
+代理负载测试。
+
+启动本地模拟上游和代理进程（UPSTREAM_BASE_URL 指向模拟上游），按固定并发级别
+运行各场景，输出 req/s、p50/p99 延迟、首字节时间、代理每请求CPU时间和RSS。
+
+用法：
+    python -m benchmarks.loadgen --concurrency 1,10,100 --duration 10 --output results.json
+    python -m benchmarks.loadgen --baseline results.json   # 与上次结果对比，退化时退出码为1
+    python -m benchmarks.loadgen --scenarios chat --tenant-mix heavy=200,light=5 \
+        --proxy-env ADMISSION_ENABLED=true        # 多租户同时压测，分别统计各租户延迟
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.fake_upstream import add_arguments as add_upstream_arguments
+
+SCENARIOS = {
+    "chat": {
+        "method": "POST",
+        "path": "/v1/chat/completions",
+        "json": {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}]},
+    },
+    "chat-stream": {
+        "method": "POST",
+        "path": "/v1/chat/completions",
+        "json": {"model": "gemini-fake", "messages": [{"role": "user", "content": "hello"}], "stream": True},
+    },
+    "passthrough": {
+        "method": "POST",
+        "path": "/v1beta/models/gemini-fake:generateContent",
+        "json": {"contents": [{"role": "user", "parts": [{"text": "hello"}]}]},
+    },
+    # 单条短文本的嵌入请求，代理会把并发请求合并为批量调用
+    "embeddings": {
+        "method": "POST",
+        "path": "/v1/embeddings",
+        "json": {"model": "text-embedding-004", "input": "a short text to embed"},
+    },
+    "models": {
+        "method": "GET",
+        "path": "/v1/models",
+        "json": None,
+    },
+    # 大请求体透传（例如内联视频/PDF），请求体大小由 --upload-mb 控制
+    "upload": {
+        "method": "POST",
+        "path": "/v1beta/models/gemini-fake:generateContent",
+        "json": None,
+    },
+}
+
+
+def build_upload_body(size_mb: float) -> bytes:
+    data = "A" * int(size_mb * 1024 * 1024)
+    return json.dumps({
+        "contents": [{"role": "user", "parts": [{"inline_data": {"mime_type": "application/pdf", "data": data}}]}]
+    }).encode()
+
+# 对比基线时检查的指标及其方向（True 表示越大越好）
+REGRESSION_METRICS = {"rps": True, "p99_ms": False, "ttfb_p99_ms": False, "cpu_ms_per_req": False}
+
+
+class ProcessSampler:
+    """通过 /proc 读取进程CPU时间和RSS（仅Linux）。"""
+
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self) -> Optional[float]:
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                # 进程名可能包含空格，从右括号之后开始切分
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / self._ticks
+
+    def rss_mb(self) -> Optional[float]:
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+        return None
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_scenario(client: httpx.AsyncClient, name: str, concurrency: int, duration: float,
+                       sampler: ProcessSampler, api_key: str, tenant: Optional[str] = None) -> Dict:
+    scenario = SCENARIOS[name]
+    headers = {"Authorization": f"Bearer {api_key}", **scenario.get("headers", {})}
+    if tenant is not None:
+        headers["x-tenant-id"] = tenant
+    latencies: List[float] = []
+    ttfbs: List[float] = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            begin = time.perf_counter()
+            ttfb = None
+            try:
+                async with client.stream(scenario["method"], scenario["path"], json=scenario["json"],
+                                         content=scenario.get("content"), headers=headers) as response:
+                    async for _ in response.aiter_raw():
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - begin
+                    ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            if not ok:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - begin)
+            if ttfb is not None:
+                ttfbs.append(ttfb)
+
+    cpu_before = sampler.cpu_seconds()
+    begin = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - begin
+    cpu_after = sampler.cpu_seconds()
+
+    rss = sampler.rss_mb()
+    completed = len(latencies)
+    cpu_ms = None
+    if cpu_before is not None and cpu_after is not None and completed:
+        cpu_ms = (cpu_after - cpu_before) * 1000 / completed
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "scenario": name if tenant is None else f"{name}[{tenant}]",
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": errors,
+        "rps": round(completed / elapsed, 2),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "ttfb_p50_ms": ms(percentile(ttfbs, 50)),
+        "ttfb_p99_ms": ms(percentile(ttfbs, 99)),
+        "cpu_ms_per_req": round(cpu_ms, 3) if cpu_ms is not None else None,
+        "rss_mb": round(rss, 1) if rss is not None else None,
+    }
+
+
+async def wait_ready(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} 未能在 {timeout} 秒内就绪")
+
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        base = baseline.get((result["scenario"], result["concurrency"]))
+        if base is None:
+            continue
+        for metric, higher_is_better in REGRESSION_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(
+                    f"{result['scenario']}@{result['concurrency']} {metric}: {old} -> {new} ({change:+.1%})"
+                )
+    return regressions
+
+
+def parse_tenant_mix(value: str) -> Dict[str, int]:
+    """"heavy=200,light=5" -> 各租户的并发数。"""
+    mix = {}
+    for item in value.split(","):
+        tenant, _, concurrency = item.partition("=")
+        if tenant.strip():
+            mix[tenant.strip()] = int(concurrency)
+    return mix
+
+
+def report(result: Dict):
+    print(
+        f"{result['scenario']:<12} c={result['concurrency']:<4} rps={result['rps']:<9} "
+        f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms "
+        f"ttfb_p50={result['ttfb_p50_ms']}ms cpu/req={result['cpu_ms_per_req']}ms "
+        f"rss={result['rss_mb']}MB errors={result['errors']}"
+    )
+
+
+def spawn(args: List[str], env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], env={**os.environ, **(env or {})})
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    processes = []
+    try:
+        upstream_url = args.upstream_url
+        if upstream_url is None:
+            upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+            upstream_args = [
+                "-m", "benchmarks.fake_upstream", "--port", str(args.upstream_port),
+                "--latency-ms", str(args.latency_ms), "--chunks", str(args.chunks),
+                "--chunk-interval-ms", str(args.chunk_interval_ms), "--chunk-chars", str(args.chunk_chars),
+                "--error-rate", str(args.error_rate), "--error-status", str(args.error_status),
+                "--exhausted-keys", args.exhausted_keys, "--text", args.text,
+            ]
+            if args.gzip:
+                upstream_args.append("--gzip")
+            processes.append(spawn(upstream_args))
+            await wait_ready(f"{upstream_url}/stats")
+
+        proxy_url = args.proxy_url
+        proxy_pid = args.proxy_pid
+        if proxy_url is None:
+            proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+            env = {"UPSTREAM_BASE_URL": upstream_url}
+            for item in args.proxy_env:
+                key, _, value = item.partition("=")
+                env[key] = value
+            proxy = spawn(["-m", "uvicorn", "main:app", "--port", str(args.proxy_port), "--log-level", "warning"], env)
+            processes.append(proxy)
+            proxy_pid = proxy.pid
+            await wait_ready(f"{proxy_url}/health")
+
+        if "upload" in args.scenarios.split(","):
+            SCENARIOS["upload"]["content"] = build_upload_body(args.upload_mb)
+            SCENARIOS["upload"]["headers"] = {"content-type": "application/json"}
+
+        sampler = ProcessSampler(proxy_pid)
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        results = []
+        async with httpx.AsyncClient(base_url=proxy_url, limits=limits, timeout=120.0) as client:
+            for name in args.scenarios.split(","):
+                if args.tenant_mix:
+                    # 各租户同时运行；CPU时间是整个代理进程的，不按租户拆分
+                    mix = parse_tenant_mix(args.tenant_mix)
+                    tenant_results = await asyncio.gather(*(
+                        run_scenario(client, name, concurrency, args.duration, sampler, args.api_key, tenant)
+                        for tenant, concurrency in mix.items()
+                    ))
+                    for result in tenant_results:
+                        results.append(result)
+                        report(result)
+                    continue
+                for concurrency in (int(c) for c in args.concurrency.split(",")):
+                    result = await run_scenario(client, name, concurrency, args.duration, sampler, args.api_key)
+                    results.append(result)
+                    report(result)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": int(time.time()),
+                    "python": platform.python_version(),
+                    "duration": args.duration,
+                    "upstream": {
+                        "latency_ms": args.latency_ms,
+                        "chunks": args.chunks,
+                        "chunk_interval_ms": args.chunk_interval_ms,
+                        "chunk_chars": args.chunk_chars,
+                        "error_rate": args.error_rate,
+                    },
+                },
+                "results": results,
+            }, f, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="chat,chat-stream,passthrough,models")
+    parser.add_argument("--concurrency", default="1,10,100")
+    parser.add_argument("--duration", type=float, default=10.0, help="每个场景/并发级别的运行时长（秒）")
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--tenant-mix", help="多租户压测，如 heavy=200,light=5（租户=并发数，通过 x-tenant-id 区分）")
+    parser.add_argument("--upload-mb", type=float, default=20.0, help="upload 场景的请求体大小（MB）")
+    parser.add_argument("--proxy-url", help="压测已运行的代理，而不是启动新进程")
+    parser.add_argument("--proxy-pid", type=int, help="配合 --proxy-url 采集CPU和RSS")
+    parser.add_argument("--proxy-port", type=int, default=8100)
+    parser.add_argument("--proxy-env", action="append", default=[], help="传给代理进程的环境变量，KEY=VALUE")
+    parser.add_argument("--upstream-url", help="使用已运行的上游，而不是启动模拟上游")
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    add_upstream_arguments(parser)
+    parser.add_argument("--output", help="将结果写入JSON文件")
+    parser.add_argument("--baseline", help="与之前的JSON结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="允许的相对退化幅度")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
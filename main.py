@@ -1,19 +1,50 @@
 from fastapi import FastAPI
 from app.api.routes import router as api_router
 from app.core.config import settings
+from app.core.metrics import MetricsMiddleware
+from app.core.admission import AdmissionMiddleware
+from app.core.drain import DrainMiddleware, drain_controller
+from app.core.tracing import TracingMiddleware, tracing_exporter
 
 from contextlib import asynccontextmanager
 from app.services.proxy_service import proxy_service
+from app.services.media_fetcher import media_fetcher
+from app.services.response_cache import response_cache
+from app.services.upstream_router import upstream_router
+from app.services.config_reload import config_reloader
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动
+    await proxy_service.warmup()
+    await upstream_router.warmup()
+    upstream_router.start()
+    # SIGTERM 先排空再退出，SIGHUP 热加载配置
+    drain_controller.install()
+    config_reloader.install()
     yield
-    # 关闭
+    # 关闭（排空已结束或超时，之后才关闭上游连接池）
+    await upstream_router.close()
     await proxy_service.close()
+    await media_fetcher.close()
+    response_cache.close()
 
 app = FastAPI(title="Gemini Proxy", lifespan=lifespan)
 
+# 后添加的中间件在外层：指标中间件需要能记录被准入控制拒绝的请求
+if settings.ADMISSION_ENABLED:
+    app.add_middleware(AdmissionMiddleware)
+
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# 追踪在最外层，总耗时包含准入排队
+if settings.TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware, exporter=tracing_exporter)
+
+# 排空在最外层：关闭期间直接拒绝新请求，在途请求包括准入排队中的请求
+app.add_middleware(DrainMiddleware)
+
 app.include_router(api_router)
 
 if __name__ == "__main__":